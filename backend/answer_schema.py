@@ -0,0 +1,74 @@
+import json
+import re
+from typing import Optional
+
+
+ANSWER_MODES = ("full", "xpath_only")
+
+_FENCE = re.compile(r"```(?:json)?", re.IGNORECASE)
+_PRIMARY_FIELD = re.compile(r'"primary_xpath"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def answer_schema(mode: str = "full", explanation_max_chars: int = 200, xpath_max_chars: int = 300) -> dict:
+    """JSON schema of the answer object, used to constrain decoding.
+
+    llama.cpp turns it into a grammar (``json_schema``), Ollama accepts it as
+    ``format``. The model can then only emit the object itself: no markdown,
+    no commentary, and an explanation no longer than ``explanation_max_chars``.
+    In "xpath_only" mode the object holds just ``primary_xpath``.
+    """
+    if mode not in ANSWER_MODES:
+        raise ValueError(f"Unknown answer mode: {mode}")
+    xpath = {"type": "string", "minLength": 1, "maxLength": xpath_max_chars}
+    if mode == "xpath_only":
+        return {
+            "type": "object",
+            "properties": {"primary_xpath": xpath},
+            "required": ["primary_xpath"],
+            "additionalProperties": False,
+        }
+    return {
+        "type": "object",
+        "properties": {
+            "primary_xpath": xpath,
+            "alternative_xpath": {"type": "string", "maxLength": xpath_max_chars},
+            "explanation": {"type": "string", "maxLength": explanation_max_chars},
+        },
+        "required": ["primary_xpath", "alternative_xpath", "explanation"],
+        "additionalProperties": False,
+    }
+
+
+def parse_answer(text: str) -> Optional[dict]:
+    """Extract the answer object from model output, tolerating markdown fences and trailing chatter."""
+    cleaned = _FENCE.sub("", text or "").strip()
+    start = cleaned.find("{")
+    if start >= 0:
+        try:
+            answer, _ = json.JSONDecoder().raw_decode(cleaned[start:])
+            if isinstance(answer, dict) and isinstance(answer.get("primary_xpath"), str):
+                return answer
+        except ValueError:
+            pass
+    # Truncated or malformed JSON: the primary field alone is still worth checking
+    match = _PRIMARY_FIELD.search(cleaned)
+    if match:
+        try:
+            return {"primary_xpath": json.loads(f'"{match.group(1)}"')}
+        except ValueError:
+            return None
+    return None
+
+
+def structured_answer(text: str) -> Optional[dict]:
+    """The answer as the extension consumes it: all three fields, empty alternatives as None."""
+    answer = parse_answer(text)
+    if answer is None:
+        return None
+    alternative = answer.get("alternative_xpath")
+    explanation = answer.get("explanation")
+    return {
+        "primary_xpath": answer["primary_xpath"].strip(),
+        "alternative_xpath": (alternative.strip() or None) if isinstance(alternative, str) else None,
+        "explanation": explanation.strip() if isinstance(explanation, str) else "",
+    }
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Stand-in for llama-server and Ollama with configurable prefill and decode latency.
+
+Needs no model and no GPU. It accepts llama-server's command line, so the
+backend can launch it in place of the real binary::
+
+    XPATH_LLAMACPP_BINARY=$PWD/bench/fake_llm.py XPATH_MODELS_DIR=/tmp/fake-models uvicorn main:app
+
+Latency is modelled per token: prefill costs ``--prefill-ms`` per prompt token
+not already held in the slot's cache (as with ``cache_prompt``), decode costs
+``--decode-ms`` per generated token. At most ``--parallel`` requests are
+processed at a time, one per slot. Without a JSON schema the answer is
+followed by rambling text, so early stopping shows up in the numbers.
+
+With ``--model-draft`` the fake models speculative decoding: a share
+``--draft-acceptance`` of the tokens comes from accepted drafts, which cost
+``--draft-ms`` instead of a full decode step, and ``timings`` report
+``draft_n``/``draft_n_accepted`` like llama-server.
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+from time import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+ANSWER = {
+    "primary_xpath": "//button[@data-testid='submit']",
+    "alternative_xpath": "//form//button[normalize-space()='Submit']",
+    "explanation": "Stable test attribute first, text inside the form as a fallback.",
+}
+RAMBLING = "\n\nNote: the XPath above relies on a test attribute, which is usually stable across releases. "
+
+
+class FakeConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.prefill_ms = args.prefill_ms
+        self.decode_ms = args.decode_ms
+        self.chars_per_token = args.chars_per_token
+        self.parallel = max(1, args.parallel)
+        self.ctx_size = args.ctx_size
+        self.load_seconds = args.load_seconds
+        self.trailing_tokens = args.trailing_tokens
+        self.model = os.path.basename(args.model) if args.model else "fake.gguf"
+        self.draft = bool(args.model_draft)
+        self.draft_acceptance = min(max(args.draft_acceptance, 0.0), 1.0) if self.draft else 0.0
+        self.draft_ms = args.draft_ms
+
+    def token_ms(self) -> float:
+        """Average decode cost of a token: accepted drafts skip the full decode step."""
+        return self.decode_ms * (1 - self.draft_acceptance) + self.draft_ms * self.draft_acceptance
+
+    def drafted(self, predicted: int) -> Tuple[int, int]:
+        """(drafted, accepted) tokens behind ``predicted`` generated tokens."""
+        if not self.draft or not predicted:
+            return 0, 0
+        accepted = int(predicted * self.draft_acceptance)
+        drafted = round(accepted / self.draft_acceptance) if self.draft_acceptance else predicted
+        return drafted, accepted
+
+
+class Slots:
+    """llama-server slots: one request each, remembering the last prompt for prefix reuse."""
+    def __init__(self, n_slots: int):
+        self.locks = [asyncio.Lock() for _ in range(n_slots)]
+        self.prompts = [""] * n_slots
+
+    async def acquire(self, slot: int) -> int:
+        if 0 <= slot < len(self.locks):
+            await self.locks[slot].acquire()
+            return slot
+        while True:
+            for i, lock in enumerate(self.locks):
+                if not lock.locked():
+                    await lock.acquire()
+                    return i
+            await asyncio.sleep(0.002)
+
+    def release(self, slot: int):
+        self.locks[slot].release()
+
+    def cached_chars(self, slot: int, prompt: str) -> int:
+        """Length of the prefix the slot already holds."""
+        previous = self.prompts[slot]
+        n = min(len(previous), len(prompt))
+        i = 0
+        while i < n and previous[i] == prompt[i]:
+            i += 1
+        return i
+
+
+def count_tokens(text: str, chars_per_token: float) -> int:
+    return max(1, int(len(text) / chars_per_token)) if text else 0
+
+
+def answer_text(schema: Optional[dict], trailing_tokens: int, chars_per_token: float) -> str:
+    if schema and set(schema.get("properties", {})) == {"primary_xpath"}:
+        return json.dumps({"primary_xpath": ANSWER["primary_xpath"]})
+    text = json.dumps(ANSWER, indent=2)
+    if schema is None and trailing_tokens:
+        text += (RAMBLING * 10)[:int(trailing_tokens * chars_per_token)]
+    return text
+
+
+def split_tokens(text: str, chars_per_token: float) -> List[str]:
+    step = max(1, int(round(chars_per_token)))
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+async def until_disconnected(request: Request, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Stop decoding once the client has gone, as llama-server and Ollama do."""
+    async for token in tokens:
+        if await request.is_disconnected():
+            return
+        yield token
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI(title="Fake llama-server / Ollama")
+    slots = Slots(config.parallel)
+    started = time()
+
+    async def run(prompt: str, slot: int, schema: Optional[dict],
+                  max_tokens: int) -> Tuple[int, int, AsyncIterator[str]]:
+        """Sleep for prefill and return (prompt tokens, evaluated tokens, token stream)."""
+        cached = slots.cached_chars(slot, prompt)
+        prompt_tokens = count_tokens(prompt, config.chars_per_token)
+        evaluated = count_tokens(prompt[cached:], config.chars_per_token)
+        await asyncio.sleep(evaluated * config.prefill_ms / 1000)
+        slots.prompts[slot] = prompt
+        tokens = split_tokens(answer_text(schema, config.trailing_tokens, config.chars_per_token),
+                              config.chars_per_token)[:max(1, max_tokens)]
+
+        async def decode() -> AsyncIterator[str]:
+            for token in tokens:
+                await asyncio.sleep(config.token_ms() / 1000)
+                yield token
+        return prompt_tokens, evaluated, decode()
+
+    def timings(evaluated: int, predicted: int, prefill_s: float, decode_s: float) -> dict:
+        result = {"prompt_n": evaluated, "prompt_ms": prefill_s * 1000,
+                  "predicted_n": predicted, "predicted_ms": decode_s * 1000}
+        if config.draft:
+            result["draft_n"], result["draft_n_accepted"] = config.drafted(predicted)
+        return result
+
+    @app.get("/health")
+    async def health():
+        if time() - started < config.load_seconds:
+            return JSONResponse({"error": {"message": "Loading model"}}, status_code=503)
+        return {"status": "ok"}
+
+    @app.get("/props")
+    async def props():
+        return {"default_generation_settings": {"n_ctx": config.ctx_size // config.parallel},
+                "total_slots": config.parallel}
+
+    @app.post("/tokenize")
+    async def tokenize(request: Request):
+        body = await request.json()
+        return {"tokens": list(range(count_tokens(body.get("content", ""), config.chars_per_token)))}
+
+    @app.post("/completion")
+    async def completion(request: Request):
+        body = await request.json()
+        slot = await slots.acquire(body.get("id_slot", -1))
+        t0 = time()
+        try:
+            _, evaluated, tokens = await run(body.get("prompt", ""), slot, body.get("json_schema"),
+                                             body.get("n_predict", 512))
+            tokens = until_disconnected(request, tokens)
+        except BaseException:
+            slots.release(slot)
+            raise
+        prefill_s = time() - t0
+
+        if not body.get("stream"):
+            try:
+                parts = [token async for token in tokens]
+            finally:
+                slots.release(slot)
+            return {"content": "".join(parts), "stop": True, "id_slot": slot,
+                    "timings": timings(evaluated, len(parts), prefill_s, time() - t0 - prefill_s)}
+
+        async def events() -> AsyncIterator[str]:
+            predicted = 0
+            try:
+                async for token in tokens:
+                    predicted += 1
+                    chunk = {"content": token, "stop": False,
+                             "timings": timings(evaluated, predicted, prefill_s, time() - t0 - prefill_s)}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                final = {"content": "", "stop": True,
+                         "timings": timings(evaluated, predicted, prefill_s, time() - t0 - prefill_s)}
+                yield f"data: {json.dumps(final)}\n\n"
+            finally:
+                # Reached on early disconnect too: the slot is free again, like llama-server
+                slots.release(slot)
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": config.model, "size": 0}]}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        options = body.get("options", {})
+        schema = body.get("format") if isinstance(body.get("format"), dict) else None
+        prompt = body.get("prompt", "")
+        if not prompt:
+            # keep_alive / warm-up requests load the model and return immediately
+            return {"model": body.get("model"), "response": "", "done": True, "load_duration": 0}
+        slot = await slots.acquire(-1)
+        t0 = time()
+        try:
+            prompt_tokens, evaluated, tokens = await run(prompt, slot, schema, options.get("num_predict", 512))
+            tokens = until_disconnected(request, tokens)
+        except BaseException:
+            slots.release(slot)
+            raise
+        prefill_ns = int((time() - t0) * 1e9)
+
+        def final(count: int) -> dict:
+            return {"model": body.get("model"), "response": "", "done": True,
+                    "prompt_eval_count": evaluated, "prompt_eval_duration": prefill_ns,
+                    "eval_count": count, "eval_duration": int((time() - t0) * 1e9) - prefill_ns}
+
+        if not body.get("stream", True):
+            try:
+                parts = [token async for token in tokens]
+            finally:
+                slots.release(slot)
+            result = final(len(parts))
+            result["response"] = "".join(parts)
+            return result
+
+        async def lines() -> AsyncIterator[str]:
+            count = 0
+            try:
+                async for token in tokens:
+                    count += 1
+                    yield json.dumps({"model": body.get("model"), "response": token, "done": False}) + "\n"
+                yield json.dumps(final(count)) + "\n"
+            finally:
+                slots.release(slot)
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/metrics")
+    async def metrics():
+        return Response("", media_type="text/plain")
+
+    return app
+
+
+def write_stub_model(path: str):
+    """Write a header-only GGUF file (no metadata, no tensors) so the backend lists a model."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, 0, 0))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    # llama-server flags passed by the backend; unknown ones are ignored
+    parser.add_argument("-m", "--model", default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--parallel", "-np", type=int, default=int(env("FAKE_PARALLEL", "4")))
+    parser.add_argument("-c", "--ctx-size", type=int, default=32768)
+    # Latency model; environment variables apply when the backend launches the fake
+    parser.add_argument("--prefill-ms", type=float, default=float(env("FAKE_PREFILL_MS", "0.2")),
+                        help="milliseconds per evaluated prompt token")
+    parser.add_argument("--decode-ms", type=float, default=float(env("FAKE_DECODE_MS", "15")),
+                        help="milliseconds per generated token")
+    parser.add_argument("--chars-per-token", type=float, default=float(env("FAKE_CHARS_PER_TOKEN", "4")))
+    parser.add_argument("--load-seconds", type=float, default=float(env("FAKE_LOAD_SECONDS", "0")),
+                        help="answer /health with 503 for this long after start")
+    parser.add_argument("--trailing-tokens", type=int, default=int(env("FAKE_TRAILING_TOKENS", "64")),
+                        help="tokens generated after the JSON answer when no schema is given")
+    parser.add_argument("-md", "--model-draft", default=None)
+    parser.add_argument("--draft-acceptance", type=float, default=float(env("FAKE_DRAFT_ACCEPTANCE", "0.7")),
+                        help="share of generated tokens that come from accepted drafts")
+    parser.add_argument("--draft-ms", type=float, default=float(env("FAKE_DRAFT_MS", "2")),
+                        help="milliseconds per accepted draft token")
+    parser.add_argument("--write-model", metavar="PATH", help="write a stub GGUF file and exit")
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.write_model:
+        write_stub_model(args.write_model)
+        return
+    uvicorn.run(create_app(FakeConfig(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""DOM fixtures of realistic shape and size for the load generator.
+
+Pages are generated deterministically (seeded) instead of stored: hashed CSS
+class names, repeated cards and rows, navigation chrome and inline noise, as
+cleaned by the extension before sending. The target element has no id or test
+attribute, so the model has to work for it.
+"""
+import random
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+
+@dataclass
+class Fixture:
+    name: str
+    dom: str
+    element_html: str
+    tag: str
+
+    @property
+    def size_kb(self) -> float:
+        return round(len(self.dom) / 1024, 1)
+
+
+def _hashed(rng: random.Random, prefix: str) -> str:
+    """CSS-in-JS style class name, e.g. "card_x7Kp2"."""
+    return f"{prefix}_{''.join(rng.choice('abcdefghijkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(5))}"
+
+
+def _page(rng: random.Random, title: str, body: str) -> str:
+    nav = "".join(f'<li class="{_hashed(rng, "nav")}"><a href="/section/{i}">Section {i}</a></li>' for i in range(12))
+    return (f'<html><head><title>{title}</title></head><body>'
+            f'<header class="{_hashed(rng, "header")}"><a href="/" aria-label="Home">Logo</a>'
+            f'<nav><ul>{nav}</ul></nav><input type="search" placeholder="Search"></header>'
+            f'<main class="{_hashed(rng, "main")}">{body}</main>'
+            f'<footer class="{_hashed(rng, "footer")}"><p>Copyright</p></footer></body></html>')
+
+
+def login_form(rng: random.Random) -> Fixture:
+    target = f'<button class="{_hashed(rng, "btn")} primary" type="submit">Sign in</button>'
+    body = (f'<section class="{_hashed(rng, "auth")}"><h1>Welcome back</h1><form method="post">'
+            f'<label>Email<input type="email" class="{_hashed(rng, "input")}"></label>'
+            f'<label>Password<input type="password" class="{_hashed(rng, "input")}"></label>'
+            f'<label><input type="checkbox"> Remember me</label>'
+            f'<button class="{_hashed(rng, "btn")}" type="button">Cancel</button>{target}'
+            f'<a href="/reset">Forgot password?</a></form></section>')
+    return Fixture("login_form", _page(rng, "Sign in", body), target, "button")
+
+
+def product_grid(rng: random.Random, cards: int = 48, target_index: int = 17) -> Fixture:
+    card_class, target = _hashed(rng, "card"), ""
+    items = []
+    for i in range(cards):
+        button = f'<button class="{_hashed(rng, "btn")}">Add to cart</button>'
+        if i == target_index:
+            button = f'<button class="{_hashed(rng, "btn")} accent">Add to cart</button>'
+            target = button
+        items.append(
+            f'<article class="{card_class}"><a href="/product/{1000 + i}"><img src="/img/{1000 + i}.jpg" alt="Product {i}"></a>'
+            f'<h3 class="{_hashed(rng, "title")}">Product {i} {rng.choice(["Pro", "Lite", "Max", "Mini"])}</h3>'
+            f'<div class="{_hashed(rng, "price")}"><span>{rng.randint(5, 500)}.99</span><s>{rng.randint(500, 900)}.00</s></div>'
+            f'<p>{" ".join(rng.choice(["fast", "durable", "light", "new", "eco", "compact"]) for _ in range(20))}</p>'
+            f'<div class="{_hashed(rng, "actions")}">{button}<button aria-label="Add to wishlist">&#9825;</button></div></article>')
+    body = f'<h1>Catalog</h1><div class="{_hashed(rng, "grid")}">{"".join(items)}</div>'
+    return Fixture("product_grid", _page(rng, "Catalog", body), target, "button")
+
+
+def data_table(rng: random.Random, rows: int = 400, target_row: int = 233) -> Fixture:
+    target = ""
+    lines = []
+    for i in range(rows):
+        link = f'<a class="{_hashed(rng, "link")}" href="#">Edit</a>'
+        if i == target_row:
+            link = f'<a class="{_hashed(rng, "link")}" href="#" title="Edit order {50000 + i}">Edit</a>'
+            target = link
+        cells = "".join(f"<td>{rng.choice(['pending', 'paid', 'shipped'])}</td>" if c == 3 else
+                        f"<td>{rng.randint(1, 99999)}</td>" for c in range(7))
+        lines.append(f'<tr class="{_hashed(rng, "row")}"><td>{50000 + i}</td>{cells}<td>{link}</td></tr>')
+    header = "".join(f"<th>Column {c}</th>" for c in range(9))
+    body = f'<h1>Orders</h1><table class="{_hashed(rng, "table")}"><thead><tr>{header}</tr></thead><tbody>{"".join(lines)}</tbody></table>'
+    return Fixture("data_table", _page(rng, "Orders", body), target, "a")
+
+
+def app_shell(rng: random.Random, posts: int = 300, target_post: int = 120) -> Fixture:
+    target = ""
+    sidebar = "".join(f'<li><a href="/group/{i}" class="{_hashed(rng, "side")}">Group {i}</a></li>' for i in range(60))
+    feed = []
+    for i in range(posts):
+        reply = f'<button class="{_hashed(rng, "action")}">Reply</button>'
+        if i == target_post:
+            reply = f'<button class="{_hashed(rng, "action")} highlighted">Reply</button>'
+            target = reply
+        comments = "".join(f'<li class="{_hashed(rng, "comment")}"><b>user{rng.randint(1, 9999)}</b> '
+                           f'{" ".join(rng.choice(["nice", "agree", "thanks", "+1", "why", "great"]) for _ in range(8))}</li>'
+                           for _ in range(rng.randint(0, 4)))
+        feed.append(f'<div class="{_hashed(rng, "post")}"><div class="{_hashed(rng, "author")}"><img src="/a/{i}.png" alt="">'
+                    f'<span>Author {i}</span><time>{rng.randint(1, 59)} min</time></div>'
+                    f'<p>{" ".join(rng.choice(["update", "release", "meeting", "deploy", "coffee", "bug"]) for _ in range(30))}</p>'
+                    f'<div class="{_hashed(rng, "bar")}"><button class="{_hashed(rng, "action")}">Like</button>{reply}'
+                    f'<button class="{_hashed(rng, "action")}">Share</button></div><ul>{comments}</ul></div>')
+    body = (f'<aside class="{_hashed(rng, "sidebar")}"><ul>{sidebar}</ul></aside>'
+            f'<section class="{_hashed(rng, "feed")}">{"".join(feed)}</section>'
+            f'<div role="dialog" aria-label="Settings" hidden><button>Close</button></div>')
+    return Fixture("app_shell", _page(rng, "Feed", body), target, "button")
+
+
+BUILDERS: Dict[str, Callable[[random.Random], Fixture]] = {
+    "login_form": login_form,
+    "product_grid": product_grid,
+    "data_table": data_table,
+    "app_shell": app_shell,
+}
+
+
+def load_fixtures(names: List[str] = None, seed: int = 7) -> List[Fixture]:
+    """Build the named fixtures (all by default), identical for the same seed."""
+    names = names or list(BUILDERS)
+    unknown = [name for name in names if name not in BUILDERS]
+    if unknown:
+        raise ValueError(f"Unknown fixtures: {unknown}. Available: {list(BUILDERS)}")
+    return [BUILDERS[name](random.Random(f"{seed}:{name}")) for name in names]
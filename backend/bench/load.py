@@ -0,0 +1,310 @@
+"""Load generator for /generate-xpath.
+
+Drives the backend with the DOM fixtures either at a fixed concurrency
+(closed loop: each worker sends its next request when the previous one
+returns) or at a fixed arrival rate (open loop: Poisson arrivals, so queueing
+shows up as latency). Reports p50/p95/p99 latency, throughput and the
+overhead the backend adds on top of the model time it reports in ``timings``,
+and writes everything to JSON so runs can be compared::
+
+    python -m bench.load --url http://localhost:8000 --concurrency 8 --requests 200 --output runs/base.json
+    python -m bench.load --url http://localhost:8000 --rate 4 --duration 60 --compare runs/base.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.fixtures import Fixture, load_fixtures
+
+
+DEFAULT_TEMPLATE = Path(__file__).resolve().parent.parent / "default_template.txt"
+
+
+@dataclass
+class Sample:
+    fixture: str
+    status: int
+    latency: float
+    first_byte: Optional[float] = None
+    model_seconds: Optional[float] = None
+    queue_seconds: Optional[float] = None
+    cached: bool = False
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200 and self.error is None
+
+    @property
+    def overhead(self) -> Optional[float]:
+        """Latency not explained by the model server's own prefill and decode time or queueing."""
+        if self.model_seconds is None:
+            return None
+        return max(0.0, self.latency - self.model_seconds - (self.queue_seconds or 0.0))
+
+
+@dataclass
+class RunConfig:
+    url: str
+    payload: str
+    concurrency: int
+    rate: Optional[float]
+    requests: Optional[int]
+    duration: Optional[float]
+    warmup: int
+    stream: bool
+    fixtures: List[str]
+    extra: Dict = field(default_factory=dict)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Linear-interpolated percentile, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def distribution(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def summarize(samples: List[Sample], elapsed: float) -> dict:
+    ok = [s for s in samples if s.ok]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if not s.ok:
+            key = str(s.status) if s.status else "transport"
+            errors[key] = errors.get(key, 0) + 1
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": errors,
+        "cached": sum(1 for s in ok if s.cached),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        "latency_seconds": distribution([s.latency for s in ok]),
+        "first_byte_seconds": distribution([s.first_byte for s in ok if s.first_byte is not None]),
+        "model_seconds": distribution([s.model_seconds for s in ok if s.model_seconds is not None]),
+        "queue_seconds": distribution([s.queue_seconds for s in ok if s.queue_seconds is not None]),
+        "overhead_seconds": distribution([s.overhead for s in ok if s.overhead is not None]),
+    }
+
+
+def build_payload(fixture: Fixture, config: RunConfig, template: str) -> dict:
+    """Request body as the extension sends it: server-side DOM windowing, or a client-built prompt."""
+    payload = {"stream": config.stream, "max_tokens": 512, "temperature": 0.0,
+               "cache": False, "fast_path": False, "validate_xpath": False}
+    if config.payload == "server":
+        payload.update(template_id="default", messages=[], dom=fixture.dom,
+                       element={"html": fixture.element_html, "tag": fixture.tag, "attributes": []})
+    else:
+        prompt = template.replace("{element}", fixture.element_html).replace("{dom}", fixture.dom)
+        payload["messages"] = [{"role": "user", "content": prompt}]
+    payload.update(config.extra)
+    return payload
+
+
+def _model_timings(body: dict, sample: Sample):
+    timings = body.get("timings") or {}
+    if timings.get("prefill_seconds") is not None or timings.get("decode_seconds") is not None:
+        sample.model_seconds = (timings.get("prefill_seconds") or 0.0) + (timings.get("decode_seconds") or 0.0)
+    sample.queue_seconds = timings.get("queue_seconds")
+    sample.cached = bool(body.get("cached") or body.get("fast_path"))
+
+
+async def send(client: httpx.AsyncClient, url: str, fixture: Fixture, payload: dict) -> Sample:
+    started = perf_counter()
+    sample = Sample(fixture=fixture.name, status=0, latency=0.0)
+    try:
+        if not payload.get("stream"):
+            response = await client.post(url, json=payload)
+            sample.status = response.status_code
+            if response.status_code == 200:
+                _model_timings(response.json(), sample)
+            else:
+                sample.error = response.text[:200]
+        else:
+            async with client.stream("POST", url, json=payload) as response:
+                sample.status = response.status_code
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    if sample.first_byte is None:
+                        sample.first_byte = perf_counter() - started
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    if "error" in event:
+                        sample.error = event["error"].get("message")
+                        sample.status = event["error"].get("code", sample.status)
+                    elif event.get("choices") and event["choices"][0].get("finish_reason"):
+                        _model_timings(event, sample)
+    except (httpx.HTTPError, ValueError) as e:
+        sample.error = f"{type(e).__name__}: {e}"
+    sample.latency = perf_counter() - started
+    return sample
+
+
+async def run_load(config: RunConfig, fixtures: List[Fixture], seed: int = 1) -> dict:
+    template = DEFAULT_TEMPLATE.read_text(encoding="utf-8")
+    payloads = [(fixture, build_payload(fixture, config, template)) for fixture in fixtures]
+    url = config.url.rstrip("/") + "/generate-xpath"
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=max(config.concurrency, 64), max_keepalive_connections=max(config.concurrency, 64))
+    samples: List[Sample] = []
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(600.0, connect=10.0), limits=limits) as client:
+        for i in range(config.warmup):
+            fixture, payload = payloads[i % len(payloads)]
+            await send(client, url, fixture, payload)
+
+        started = perf_counter()
+        deadline = started + config.duration if config.duration else None
+        total = config.requests
+
+        def more(issued: int) -> bool:
+            if total is not None and issued >= total:
+                return False
+            return deadline is None or perf_counter() < deadline
+
+        if config.rate:
+            # Open loop: arrivals do not wait for earlier requests to finish
+            tasks = []
+            issued = 0
+            while more(issued):
+                fixture, payload = rng.choice(payloads)
+                tasks.append(asyncio.create_task(send(client, url, fixture, payload)))
+                issued += 1
+                await asyncio.sleep(rng.expovariate(config.rate))
+            samples = list(await asyncio.gather(*tasks))
+        else:
+            counter = {"issued": 0}
+
+            async def worker():
+                while more(counter["issued"]):
+                    counter["issued"] += 1
+                    fixture, payload = rng.choice(payloads)
+                    samples.append(await send(client, url, fixture, payload))
+            await asyncio.gather(*(worker() for _ in range(config.concurrency)))
+        elapsed = perf_counter() - started
+
+    return {
+        "summary": summarize(samples, elapsed),
+        "fixtures": {f.name: summarize([s for s in samples if s.fixture == f.name], elapsed) for f in fixtures},
+        "elapsed_seconds": round(elapsed, 3),
+        "samples": [asdict(s) for s in samples],
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current: dict, baseline: dict) -> List[str]:
+    """Human-readable deltas of the headline numbers against a previous run."""
+    lines = []
+    for section, key in (("latency_seconds", "p50"), ("latency_seconds", "p95"), ("latency_seconds", "p99"),
+                         ("overhead_seconds", "p50"), ("overhead_seconds", "p95")):
+        now = (current["summary"].get(section) or {}).get(key)
+        before = (baseline["summary"].get(section) or {}).get(key)
+        if now is not None and before:
+            lines.append(f"{section} {key}: {before:.3f}s -> {now:.3f}s ({(now - before) / before * 100:+.1f}%)")
+    now, before = current["summary"]["throughput_rps"], baseline["summary"]["throughput_rps"]
+    if now is not None and before:
+        lines.append(f"throughput: {before:.2f} -> {now:.2f} req/s ({(now - before) / before * 100:+.1f}%)")
+    return lines
+
+
+def print_report(result: dict):
+    def fmt(dist: Optional[dict]) -> str:
+        if not dist:
+            return "-"
+        return f"p50 {dist['p50'] * 1000:.0f}ms  p95 {dist['p95'] * 1000:.0f}ms  p99 {dist['p99'] * 1000:.0f}ms"
+    for name, summary in [("all", result["summary"]), *result["fixtures"].items()]:
+        print(f"{name:>14}: {summary['ok']}/{summary['requests']} ok, {summary['throughput_rps']} req/s")
+        print(f"{'':>14}  latency   {fmt(summary['latency_seconds'])}")
+        print(f"{'':>14}  overhead  {fmt(summary['overhead_seconds'])}")
+        if summary["errors"]:
+            print(f"{'':>14}  errors    {summary['errors']}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load generator for /generate-xpath")
+    parser.add_argument("--url", default="http://localhost:8000", help="backend base URL")
+    parser.add_argument("--payload", choices=("server", "client"), default="server",
+                        help="send dom/element for server-side windowing, or a full prompt (Ollama backend)")
+    parser.add_argument("--concurrency", type=int, default=4, help="closed-loop workers")
+    parser.add_argument("--rate", type=float, help="open-loop arrival rate in requests per second")
+    parser.add_argument("--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, help="stop issuing requests after this many seconds")
+    parser.add_argument("--warmup", type=int, default=2, help="requests sent before measuring")
+    parser.add_argument("--stream", action="store_true", help="use streaming responses (measures first byte)")
+    parser.add_argument("--fixtures", nargs="*", help="fixture names (default: all)")
+    parser.add_argument("--extra", type=json.loads, default={}, help="JSON merged into every request body")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", help="name stored with the results")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+    return args
+
+
+def main():
+    args = parse_args()
+    fixtures = load_fixtures(args.fixtures)
+    config = RunConfig(url=args.url, payload=args.payload, concurrency=args.concurrency, rate=args.rate,
+                       requests=args.requests, duration=args.duration, warmup=args.warmup, stream=args.stream,
+                       fixtures=[f.name for f in fixtures], extra=args.extra)
+    print(f"Fixtures: {', '.join(f'{f.name} ({f.size_kb} KB)' for f in fixtures)}")
+    result = asyncio.run(run_load(config, fixtures, args.seed))
+    result = {
+        "label": args.label,
+        "timestamp": time(),
+        "git_revision": _git_revision(),
+        "host": {"platform": platform.platform(), "python": sys.version.split()[0], "cpus": os.cpu_count()},
+        "config": asdict(config),
+        **result,
+    }
+    print_report(result)
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print(f"Compared with {baseline.get('label') or args.compare}:")
+        for line in compare(result, baseline):
+            print(f"  {line}")
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(result, indent=2), encoding="utf-8")
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time
+from typing import Optional
+
+from metrics import CANCELLED_GENERATIONS
+
+
+class RequestScope:
+    """When the current request's answer stops being useful, and why its work was stopped."""
+    def __init__(self, deadline: Optional[float]):
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time()
+
+
+_current: ContextVar[Optional[RequestScope]] = ContextVar("request_scope", default=None)
+
+
+def current_scope() -> Optional[RequestScope]:
+    return _current.get()
+
+
+def cancel_reason() -> str:
+    """Why the current request was cancelled: "disconnect", "deadline" or "cancelled" (shutdown)."""
+    scope = _current.get()
+    return scope.reason if scope is not None and scope.reason else "cancelled"
+
+
+@contextmanager
+def count_cancelled(backend: str):
+    """Count a generation abandoned before it finished (the client left or its deadline passed).
+
+    GeneratorExit covers streaming generators that are closed instead of cancelled.
+    """
+    try:
+        yield
+    except (asyncio.CancelledError, GeneratorExit):
+        CANCELLED_GENERATIONS.labels(backend, cancel_reason()).inc()
+        raise
+
+
+class CancellationMiddleware:
+    """ASGI middleware stopping a request's work as soon as nobody can use the answer.
+
+    FastAPI keeps running a handler after its client has gone, so an aborted
+    fetch still held a llama.cpp slot until the generation ended. Here the
+    handler runs as a task that is cancelled when the client disconnects or the
+    request's deadline passes; the cancellation reaches the upstream request,
+    whose closed connection makes llama.cpp or Ollama stop decoding.
+
+    The deadline is the ``X-Request-Timeout`` header (seconds), else
+    ``default_timeout`` (0 means none). A request past its deadline gets 504
+    if its response has not started; a started stream is ended.
+    """
+    def __init__(self, app, default_timeout: float = 0.0):
+        self.app = app
+        self.default_timeout = default_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timeout = _header_timeout(scope) or self.default_timeout
+        request = RequestScope(time() + timeout if timeout > 0 else None)
+        messages: asyncio.Queue = asyncio.Queue()
+        response = {"started": False, "complete": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                response["complete"] = True
+            await send(message)
+
+        token = _current.set(request)
+        try:
+            task = asyncio.create_task(self.app(scope, messages.get, send_wrapper))
+        finally:
+            _current.reset(token)
+
+        async def watch():
+            # The handler reads the body through the queue; after it only a disconnect can arrive
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    if not response["complete"] and not task.done():
+                        request.reason = "disconnect"
+                        task.cancel()
+                    await messages.put(message)
+                    return
+                await messages.put(message)
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await asyncio.wait({task}, timeout=request.remaining())
+            if not task.done():
+                request.reason = "deadline"
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                if request.reason is None:
+                    raise
+                await self._cancelled(request, timeout, response, send)
+        finally:
+            watcher.cancel()
+            if not task.done():
+                task.cancel()
+
+    async def _cancelled(self, request: RequestScope, timeout: float, response: dict, send):
+        logging.info(f"Request cancelled ({request.reason}), upstream generation stopped")
+        if response["started"]:
+            if not response["complete"]:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        # Nobody reads a response to a disconnected client; the status still shows up in the metrics
+        status, detail = (504, f"Request deadline of {timeout:g}s exceeded") if request.reason == "deadline" \
+            else (499, "Client closed request")
+        body = json.dumps({"detail": detail}).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def _header_timeout(scope) -> Optional[float]:
+    for key, value in scope["headers"]:
+        if key == b"x-request-timeout":
+            try:
+                timeout = float(value.decode("latin-1"))
+            except ValueError:
+                return None
+            return timeout if timeout > 0 else None
+    return None
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import json
+import logging
+import zlib
+from typing import Callable, Dict, Optional
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are rejected with 415 without the package
+    zstandard = None
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def _inflate(body: bytes, limit: int) -> bytes:
+    # wbits 47: zlib or gzip header, detected automatically
+    decoder = zlib.decompressobj(wbits=47)
+    data = decoder.decompress(body, limit + 1)
+    if len(data) > limit or decoder.unconsumed_tail:
+        raise BodyTooLarge()
+    if not decoder.eof:
+        raise zlib.error("truncated stream")
+    return data
+
+
+def _unzstd(body: bytes, limit: int) -> bytes:
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+        data = reader.read(limit + 1)
+    if len(data) > limit:
+        raise BodyTooLarge()
+    return data
+
+
+def decoders() -> Dict[str, Callable[[bytes, int], bytes]]:
+    available = {"gzip": _inflate, "x-gzip": _inflate, "deflate": _inflate}
+    if zstandard is not None:
+        available["zstd"] = _unzstd
+    return available
+
+
+class DecompressionMiddleware:
+    """ASGI middleware accepting gzip, deflate and zstd request bodies (``Content-Encoding``).
+
+    A page DOM compresses about tenfold, so the extension can send it
+    compressed. The body is decoded before FastAPI parses it, with the decoded
+    size capped at ``max_bytes`` so a small compressed body cannot expand
+    without bound. Unknown encodings get 415, corrupt bodies 400. Bodies larger
+    than ``thread_threshold`` compressed bytes are decoded in a worker thread.
+    Register it inside CORSMiddleware so its errors carry CORS headers.
+    """
+    def __init__(self, app, max_bytes: int = 32 * 1024 * 1024, thread_threshold: int = 64 * 1024):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.thread_threshold = thread_threshold
+        self.decoders = decoders()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = _header(scope, b"content-encoding")
+        if not encoding or encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        decode = self.decoders.get(encoding)
+        if decode is None:
+            await _error(send, 415, f"Unsupported Content-Encoding: {encoding}. Supported: {sorted(self.decoders)}")
+            return
+        chunks, received = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            received += len(chunks[-1])
+            if received > self.max_bytes:
+                await _error(send, 413, "Request body too large")
+                return
+            if not message.get("more_body"):
+                break
+        compressed = b"".join(chunks)
+        try:
+            if len(compressed) > self.thread_threshold:
+                body = await asyncio.to_thread(decode, compressed, self.max_bytes)
+            else:
+                body = decode(compressed, self.max_bytes)
+        except BodyTooLarge:
+            await _error(send, 413, f"Decompressed request body exceeds {self.max_bytes} bytes")
+            return
+        except Exception as e:
+            logging.warning(f"Could not decode {encoding} request body: {e}")
+            await _error(send, 400, f"Invalid {encoding} request body")
+            return
+
+        headers = [(name, value) for name, value in scope["headers"]
+                   if name not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Later reads wait for the disconnect, as with an uncompressed body
+            return await receive()
+
+        await self.app({**scope, "headers": headers}, replay, send)
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1").strip().lower()
+    return None
+
+
+async def _error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
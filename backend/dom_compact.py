@@ -0,0 +1,174 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+from lxml import etree
+
+
+# Attributes that never contribute to a locator and only cost tokens
+DROPPED_ATTRIBUTES = {
+    "style", "srcset", "sizes", "integrity", "nonce", "crossorigin", "referrerpolicy",
+    "loading", "decoding", "fetchpriority", "tabindex", "draggable", "spellcheck",
+    "autocapitalize", "autocorrect", "translate", "jsaction", "jscontroller", "jsname",
+}
+
+# Attributes whose exact value an XPath may rely on; never truncated
+LOCATOR_ATTRIBUTES = {
+    "id", "name", "for", "type", "role", "value", "title", "placeholder", "alt",
+    "aria-label", "aria-labelledby", "aria-describedby",
+    "data-testid", "data-test-id", "data-test", "data-qa", "data-cy",
+}
+
+MAX_CLASSES = 3
+MAX_ATTRIBUTE_CHARS = 80
+MIN_COLLAPSE_RUN = 3
+COLLAPSED_MARKER = " {count} more similar <{tag}> siblings "
+
+_TOKEN_SPLIT = re.compile(r"[-_:.\s]+")
+_DIGIT_RUN = re.compile(r"\d{4,}")
+
+
+@dataclass
+class CompactStats:
+    """What a compaction pass removed, with before/after size estimates."""
+    chars_before: int = 0
+    chars_after: int = 0
+    collapsed_nodes: int = 0
+    dropped_attributes: int = 0
+    shortened_values: int = 0
+
+    @property
+    def tokens_before(self) -> int:
+        return self.chars_before // 4
+
+    @property
+    def tokens_after(self) -> int:
+        return self.chars_after // 4
+
+    def as_dict(self) -> dict:
+        return {
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "chars_before": self.chars_before,
+            "chars_after": self.chars_after,
+            "collapsed_nodes": self.collapsed_nodes,
+            "dropped_attributes": self.dropped_attributes,
+            "shortened_values": self.shortened_values,
+        }
+
+
+def is_stable_value(value: str) -> bool:
+    """Heuristic: generated hashes and long numeric ids make poor locators."""
+    if not value or len(value) > 64:
+        return False
+    for token in _TOKEN_SPLIT.split(value):
+        if _DIGIT_RUN.search(token):
+            return False
+        digits = sum(c.isdigit() for c in token)
+        if len(token) >= 5 and digits >= 2 and digits < len(token):
+            return False
+        if len(token) >= 5 and digits and not token.islower() and not token.isupper():
+            return False
+    return True
+
+
+def is_collapsed_marker(node) -> bool:
+    return node.tag is etree.Comment and (node.text or "").endswith("siblings ")
+
+
+def compact_tree(root: etree._Element, protect: Optional[Set[etree._Element]] = None) -> CompactStats:
+    """Shrink a parsed DOM in place without losing what a locator could use.
+
+    - runs of structurally identical siblings collapse into one exemplar and a count marker
+    - class lists keep at most a few stable names, data URIs and hashed values are shortened
+    - attributes that cannot help build a locator are dropped
+
+    Nodes in ``protect`` (the target and its ancestors) are never collapsed away.
+    """
+    protect = protect or set()
+    stats = CompactStats()
+    for node in root.iter(etree.Element):
+        _compact_attributes(node, stats)
+    _collapse_runs(root, protect, stats)
+    return stats
+
+
+def _compact_attributes(node: etree._Element, stats: CompactStats):
+    attrib = node.attrib
+    for name in list(attrib):
+        value = attrib[name]
+        if name in DROPPED_ATTRIBUTES or name.startswith("on") or not is_stable_value(name):
+            del attrib[name]
+            stats.dropped_attributes += 1
+        elif name == "class":
+            shortened = _shorten_classes(value)
+            if shortened != value:
+                attrib[name] = shortened
+                stats.shortened_values += 1
+        elif value.startswith("data:"):
+            attrib[name] = value.split(",", 1)[0][:32] + ",..."
+            stats.shortened_values += 1
+        elif name not in LOCATOR_ATTRIBUTES and len(value) > MAX_ATTRIBUTE_CHARS:
+            attrib[name] = value[:MAX_ATTRIBUTE_CHARS] + "..."
+            stats.shortened_values += 1
+
+
+def _shorten_classes(value: str) -> str:
+    classes = value.split()
+    stable = [c for c in classes if is_stable_value(c)]
+    kept = stable[:MAX_CLASSES]
+    if len(kept) == len(classes):
+        return " ".join(kept)
+    # Mark the list as partial so the model prefers contains(@class, ...)
+    return " ".join(kept + ["..."])
+
+
+def _collapse_runs(root: etree._Element, protect: Set[etree._Element], stats: CompactStats):
+    signatures: Dict[etree._Element, Tuple] = {}
+
+    def signature(node: etree._Element) -> Tuple:
+        cached = signatures.get(node)
+        if cached is None:
+            children = tuple(signature(c) for c in node if isinstance(c.tag, str))
+            cached = (node.tag, tuple(sorted(n for n in node.attrib if n not in LOCATOR_ATTRIBUTES)), children)
+            signatures[node] = cached
+        return cached
+
+    # Walk top-down so subtrees removed by a collapse are never visited
+    stack = [root]
+    while stack:
+        parent = stack.pop()
+        children = [c for c in parent if isinstance(c.tag, str)]
+        if len(children) >= MIN_COLLAPSE_RUN:
+            run = [children[0]]
+            for child in children[1:] + [None]:
+                if child is not None and signature(child) == signature(run[0]):
+                    run.append(child)
+                    continue
+                if len(run) >= MIN_COLLAPSE_RUN:
+                    _collapse(parent, run, protect, stats)
+                run = [child]
+        stack.extend(c for c in parent if isinstance(c.tag, str))
+
+
+def _collapse(parent: etree._Element, run, protect: Set[etree._Element], stats: CompactStats):
+    """Keep the first node of a run (and any protected one), replace the rest with a marker."""
+    removed = 0
+    anchor = run[0]
+    for node in run[1:]:
+        if node in protect:
+            if removed:
+                anchor.addnext(_marker(removed, anchor.tag))
+            anchor, removed = node, 0
+            continue
+        parent.remove(node)
+        removed += 1
+    if removed:
+        anchor.addnext(_marker(removed, anchor.tag))
+    stats.collapsed_nodes += sum(1 for node in run[1:] if node not in protect)
+
+
+def _marker(count: int, tag: str) -> etree._Comment:
+    marker = etree.Comment(COLLAPSED_MARKER.format(count=count, tag=tag))
+    marker.tail = None
+    return marker
@@ -0,0 +1,155 @@
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Optional
+
+from lxml import etree
+
+from dom_window import parse_dom
+from locators import parse_page
+
+# Rough memory of a parsed lxml tree per character of HTML
+TREE_BYTES_PER_CHAR = 3
+
+
+def dom_hash(dom: str) -> str:
+    """Content address of a DOM: SHA-256 of its UTF-8 text, as the extension computes it."""
+    return hashlib.sha256(dom.encode("utf-8")).hexdigest()
+
+
+class StoredDom:
+    """A stored DOM with its parsed trees, built on first use and kept for later requests.
+
+    lxml trees are not safe to use from several threads at once, so callers
+    hold ``lock`` while reading ``page()``.
+    """
+    def __init__(self, key: str, dom: str):
+        self.key = key
+        self.dom = dom
+        self.created = time()
+        self.last_used = self.created
+        self.lock = threading.Lock()
+        self._page: Optional[etree._Element] = None
+        self._cleaned: Optional[etree._Element] = None
+        self.parses = 0
+        self.reuses = 0
+
+    def page(self) -> Optional[etree._Element]:
+        """The DOM as the browser sees it (see locators.parse_page); None if it cannot be parsed."""
+        if self._page is None:
+            try:
+                self._page = parse_page(self.dom)
+                self.parses += 1
+            except (etree.ParserError, ValueError) as e:
+                logging.warning(f"Could not parse stored DOM {self.key[:12]}: {e}")
+                return None
+        else:
+            self.reuses += 1
+        return self._page
+
+    def cleaned_copy(self, dom: str = None) -> etree._Element:
+        """A private copy of the cleaned tree (see dom_window.parse_dom) that the caller may modify.
+
+        Copying is several times faster than parsing again. Accepts and ignores
+        the DOM text so it can stand in for ``parse_dom``.
+        """
+        with self.lock:
+            if self._cleaned is None:
+                self._cleaned = parse_dom(self.dom)
+                self.parses += 1
+            else:
+                self.reuses += 1
+            return copy.deepcopy(self._cleaned)
+
+    def footprint(self) -> int:
+        trees = (self._page is not None) + (self._cleaned is not None)
+        return len(self.dom) * (1 + TREE_BYTES_PER_CHAR * trees)
+
+
+class DomStore:
+    """Content-addressed, memory-bounded LRU of page DOMs.
+
+    A client uploads a page once and refers to it by hash in every request
+    for an element of that page. Entries are evicted least recently used
+    first when ``max_entries`` or the estimated ``max_bytes`` (DOM text plus
+    parsed trees) is exceeded, and expire ``ttl`` seconds after their last use.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 256, ttl: float = 3600.0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, StoredDom]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.duplicates = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, dom: str) -> StoredDom:
+        """Store a DOM (or touch it when already stored) and return its entry."""
+        key = dom_hash(dom)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.duplicates += 1
+            else:
+                entry = StoredDom(key, dom)
+                self._entries[key] = entry
+                self.uploads += 1
+            self._touch(entry)
+            self._evict(keep=key)
+            return entry
+
+    def get(self, key: str) -> Optional[StoredDom]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time() - entry.last_used > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(entry)
+            # Trees parsed since the last call count against the budget now
+            self._evict(keep=key)
+            return entry
+
+    def _touch(self, entry: StoredDom):
+        entry.last_used = time()
+        self._entries.move_to_end(entry.key)
+
+    def _evict(self, keep: str):
+        total = sum(entry.footprint() for entry in self._entries.values())
+        while self._entries and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            total -= entry.footprint()
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            "entries": len(entries),
+            "max_entries": self.max_entries,
+            "estimated_bytes": sum(entry.footprint() for entry in entries),
+            "max_bytes": self.max_bytes,
+            "uploads": self.uploads,
+            "duplicates": self.duplicates,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "tree_parses": sum(entry.parses for entry in entries),
+            "tree_reuses": sum(entry.reuses for entry in entries),
+        }
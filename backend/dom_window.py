@@ -0,0 +1,361 @@
+import logging
+from dataclasses import dataclass, field
+from html import escape
+from typing import Callable, Dict, List, Optional, Tuple
+
+from lxml import etree, html as lxml_html
+
+from dom_compact import CompactStats, compact_tree, is_collapsed_marker, is_stable_value
+
+
+REMOVED_TAGS = ("script", "style", "noscript", "template", "svg", "canvas", "iframe", "object", "embed")
+
+# Attributes that usually survive redeploys and make good XPath anchors
+STABLE_ATTRIBUTES = (
+    "id", "data-testid", "data-test-id", "data-test", "data-qa", "data-cy",
+    "name", "aria-label", "aria-labelledby", "role", "for", "title", "placeholder",
+)
+
+OMITTED_MARKER = "<!-- {count} nodes omitted -->"
+SHELL_TEXT_LIMIT = 80
+
+
+@dataclass
+class ElementSpec:
+    """What we know about the element the user clicked."""
+    tag: Optional[str] = None
+    attributes: Dict[str, str] = field(default_factory=dict)
+    text: str = ""
+
+
+@dataclass
+class DomWindow:
+    """Result of windowing a DOM around the target element.
+
+    ``target_found`` is None when the DOM already fit the budget and was not windowed.
+    """
+    html: str
+    target_found: Optional[bool]
+    original_chars: int
+    window_chars: int
+    compaction: Optional[CompactStats] = None
+
+
+def parse_dom(dom: str) -> etree._Element:
+    """Parse page HTML once and drop nodes that never help locate an element."""
+    root = lxml_html.document_fromstring(dom)
+    for node in list(root.iter(etree.Comment, etree.ProcessingInstruction, *REMOVED_TAGS)):
+        if node.getparent() is not None:
+            node.drop_tree()
+    return root
+
+
+def parse_element(element_html: str, tag: Optional[str] = None, attributes: Optional[Dict[str, str]] = None) -> ElementSpec:
+    """Build an ElementSpec from the element outerHTML, falling back to the explicit tag/attributes."""
+    spec = ElementSpec(tag=tag.lower() if tag else None, attributes=dict(attributes or {}))
+    if element_html:
+        try:
+            fragment = lxml_html.fragment_fromstring(element_html, create_parent=False)
+            spec.tag = spec.tag or fragment.tag.lower()
+            for name, value in fragment.attrib.items():
+                spec.attributes.setdefault(name, value)
+            spec.text = _normalize_text(fragment.text_content())
+        except (etree.ParserError, ValueError, TypeError) as e:
+            logging.debug(f"Could not parse element HTML: {e}")
+    # The extension's highlight class is not part of the page
+    if "class" in spec.attributes:
+        classes = [c for c in spec.attributes["class"].split() if not c.startswith("xpath-helper-")]
+        spec.attributes["class"] = " ".join(classes)
+    return spec
+
+
+def find_target(root: etree._Element, spec: ElementSpec) -> Optional[etree._Element]:
+    """Find the element in the parsed DOM that best matches the spec (first one on ties)."""
+    element_id = spec.attributes.get("id")
+    if element_id:
+        matches = root.xpath("//*[@id=$value]", value=element_id)
+        if spec.tag:
+            matches = [m for m in matches if m.tag == spec.tag] or matches
+        if matches:
+            return matches[0]
+
+    candidates = root.iter(spec.tag) if spec.tag else root.iter(etree.Element)
+    best, best_score = None, 0
+    for node in candidates:
+        score = _match_score(node, spec)
+        if score > best_score:
+            best, best_score = node, score
+    return best
+
+
+def _match_score(node: etree._Element, spec: ElementSpec) -> int:
+    score = 1 if spec.tag and node.tag == spec.tag else 0
+    for name, value in spec.attributes.items():
+        actual = node.get(name)
+        if actual is None:
+            score -= 1
+        elif actual == value or (name == "class" and set(value.split()) <= set(actual.split())):
+            score += 3
+        else:
+            score -= 1
+    if spec.text:
+        if _normalize_text(node.text_content()) == spec.text:
+            score += 4
+    elif not spec.attributes:
+        score += 1
+    return score
+
+
+def is_anchor(node: etree._Element) -> bool:
+    """True for elements carrying an attribute that makes a stable XPath anchor."""
+    for name in STABLE_ATTRIBUTES:
+        value = node.get(name)
+        if value and (name != "id" or is_stable_value(value)):
+            return True
+    return False
+
+
+class _Windower:
+    """Selects which nodes of a parsed DOM to keep, expanding outward from the target."""
+    def __init__(self, target: etree._Element, budget: int):
+        self.target = target
+        self.budget = budget
+        self.used = 0
+        self.included: Dict[etree._Element, str] = {}  # node -> "full" | "shell"
+        self._sizes: Dict[etree._Element, int] = {}
+
+    def size(self, node: etree._Element) -> int:
+        """Approximate serialized size of a subtree, computed once per node."""
+        cached = self._sizes.get(node)
+        if cached is not None:
+            return cached
+        total = self.shell_size(node) + len(node.text or "")
+        for child in node:
+            if isinstance(child.tag, str):
+                total += self.size(child)
+            total += len(child.tail or "")
+        self._sizes[node] = total
+        return total
+
+    @staticmethod
+    def shell_size(node: etree._Element) -> int:
+        attrs = sum(len(k) + len(v) + 4 for k, v in node.attrib.items())
+        return 2 * len(node.tag) + attrs + 5 + min(len((node.text or "").strip()), SHELL_TEXT_LIMIT)
+
+    def add(self, node: etree._Element, mode: str) -> bool:
+        current = self.included.get(node)
+        if current == "full" or current == mode:
+            return True
+        cost = self.size(node) if mode == "full" else self.shell_size(node)
+        if current == "shell":
+            cost -= self.shell_size(node)
+        if self.used + cost > self.budget:
+            return False
+        self.included[node] = mode
+        self.used += cost
+        return True
+
+    def add_shell_path(self, node: etree._Element, stop: etree._Element) -> bool:
+        """Include node and its ancestors up to (excluding) stop as shells."""
+        chain = []
+        while node is not None and node is not stop:
+            chain.append(node)
+            node = node.getparent()
+        cost = sum(self.shell_size(n) for n in chain if n not in self.included)
+        if self.used + cost > self.budget:
+            return False
+        for n in chain:
+            self.add(n, "shell")
+        return True
+
+    def select(self):
+        target = self.target
+        path = [target] + list(target.iterancestors())
+
+        # Ancestors are always kept as shells: they carry the structural path
+        for ancestor in path[1:]:
+            if ancestor not in self.included:
+                self.included[ancestor] = "shell"
+                self.used += self.shell_size(ancestor)
+
+        if not self.add(target, "full"):
+            self.add(target, "shell")
+            for child in target:
+                if isinstance(child.tag, str) and not self.add(child, "full"):
+                    break
+
+        for level, node in enumerate(path[:-1]):
+            parent = path[level + 1]
+            remaining = self.budget - self.used
+            if remaining <= 0:
+                break
+            is_last = level == len(path) - 2
+            allowance = self.used + (remaining if is_last else int(remaining * 0.6))
+            for sibling, before in self._siblings_by_distance(parent, node):
+                if self.used >= allowance:
+                    break
+                if self.add(sibling, "full"):
+                    continue
+                self._add_anchors(sibling, limit=3)
+                self._add_partial(sibling, allowance, from_end=before)
+
+    def _siblings_by_distance(self, parent: etree._Element, node: etree._Element) -> List[Tuple[etree._Element, bool]]:
+        """Siblings of node ordered nearest first, flagged True when they precede node."""
+        children = [c for c in parent if isinstance(c.tag, str)]
+        index = children.index(node)
+        ordered = []
+        for distance in range(1, len(children)):
+            for i in (index - distance, index + distance):
+                if 0 <= i < len(children):
+                    ordered.append((children[i], i < index))
+        return ordered
+
+    def _add_partial(self, subtree: etree._Element, allowance: int, from_end: bool):
+        """Fill the allowance with the children of subtree closest to the target."""
+        if not self.add(subtree, "shell"):
+            return
+        children = [c for c in subtree if isinstance(c.tag, str)]
+        if from_end:
+            children.reverse()
+        for child in children:
+            if self.used >= allowance:
+                return
+            if self.used + self.size(child) <= allowance and self.add(child, "full"):
+                continue
+            self._add_partial(child, allowance, from_end)
+            return
+
+    def _add_anchors(self, subtree: etree._Element, limit: int):
+        """Keep a few stable anchors from a subtree too large to include in full."""
+        found = 0
+        for node in subtree.iter(etree.Element):
+            if found >= limit:
+                break
+            if is_anchor(node) and self.add_shell_path(node, subtree.getparent()):
+                found += 1
+        if not found:
+            self.add(subtree, "shell")
+
+
+def render(node: etree._Element, included: Dict[etree._Element, str]) -> str:
+    """Serialize the selected nodes, marking omitted runs of siblings."""
+    if included.get(node) == "full":
+        return etree.tostring(node, encoding="unicode", method="html", with_tail=False)
+
+    parts = [_start_tag(node)]
+    text = (node.text or "").strip()
+    if text:
+        parts.append(escape(_shorten(text), quote=False))
+    omitted = 0
+    previous_kept = False
+    for child in node:
+        if is_collapsed_marker(child):
+            if previous_kept:
+                parts.append(etree.tostring(child, encoding="unicode", with_tail=False))
+            continue
+        if not isinstance(child.tag, str):
+            continue
+        previous_kept = child in included
+        if previous_kept:
+            if omitted:
+                parts.append(OMITTED_MARKER.format(count=omitted))
+                omitted = 0
+            parts.append(render(child, included))
+        else:
+            omitted += 1
+    if omitted:
+        parts.append(OMITTED_MARKER.format(count=omitted))
+    parts.append(f"</{node.tag}>")
+    return "".join(parts)
+
+
+def build_window(root: etree._Element, targets: List[etree._Element], budget_chars: int) -> str:
+    """Render a budgeted window of the DOM around one or more target elements.
+
+    Each target in turn expands its neighbourhood into an equal share of the
+    budget; nodes already kept for an earlier target are not paid for twice.
+    """
+    windower = _Windower(targets[0], budget_chars)
+    for index, target in enumerate(targets):
+        windower.target = target
+        windower.budget = budget_chars * (index + 1) // len(targets)
+        windower.select()
+    return render(root, windower.included)
+
+
+def window_dom(dom: str, element_html: str, tag: Optional[str] = None,
+               attributes: Optional[Dict[str, str]] = None, budget_chars: int = 16000,
+               compact: bool = True, parse: Callable[[str], etree._Element] = parse_dom) -> DomWindow:
+    """Parse a DOM, locate the target element and cut a budgeted window around it.
+
+    The DOM is compacted first (see dom_compact); if the compacted DOM already
+    fits the budget it is used whole. Falls back to the DOM prefix when the
+    target cannot be found.
+    """
+    spec = parse_element(element_html, tag, attributes)
+    window, _ = window_dom_many(dom, [spec], budget_chars=budget_chars, compact=compact, parse=parse)
+    return window
+
+
+def window_dom_many(dom: str, specs: List[ElementSpec], budget_chars: int = 16000,
+                    compact: bool = True, parse: Callable[[str], etree._Element] = parse_dom
+                    ) -> Tuple[DomWindow, List[Optional[bool]]]:
+    """Cut one budgeted window that covers several target elements of the same DOM.
+
+    Returns the window and, per spec, whether its element was found (None when
+    the DOM fit the budget and was not searched). ``target_found`` on the window
+    is True only when every element was found. ``parse`` must return a fresh
+    tree as parse_dom does, since compaction modifies it.
+    """
+    original_chars = len(dom)
+    if original_chars <= budget_chars:
+        window = DomWindow(html=dom, target_found=None, original_chars=original_chars, window_chars=original_chars)
+        return window, [None] * len(specs)
+
+    root = parse(dom)
+    targets = [find_target(root, spec) for spec in specs]
+    found = [target is not None for target in targets]
+    located = list(dict.fromkeys(target for target in targets if target is not None))
+
+    stats = None
+    if compact:
+        protect = set()
+        for target in located:
+            protect.add(target)
+            protect.update(target.iterancestors())
+        stats = compact_tree(root, protect)
+        compacted = etree.tostring(root, encoding="unicode", method="html")
+        stats.chars_before, stats.chars_after = original_chars, len(compacted)
+        logging.debug(f"DOM compaction: ~{stats.tokens_before} -> ~{stats.tokens_after} tokens "
+                      f"({stats.collapsed_nodes} nodes collapsed)")
+        if len(compacted) <= budget_chars:
+            window = DomWindow(html=compacted, target_found=all(found), original_chars=original_chars,
+                               window_chars=len(compacted), compaction=stats)
+            return window, found
+        dom = compacted
+
+    if not located:
+        logging.warning("Target element not found in DOM, falling back to DOM prefix")
+        prefix = dom[:budget_chars]
+        window = DomWindow(html=prefix, target_found=False, original_chars=original_chars,
+                           window_chars=len(prefix), compaction=stats)
+        return window, found
+
+    html = build_window(root, located, budget_chars)
+    window = DomWindow(html=html, target_found=all(found), original_chars=original_chars,
+                       window_chars=len(html), compaction=stats)
+    return window, found
+
+
+def _start_tag(node: etree._Element) -> str:
+    attrs = "".join(f' {name}="{escape(value)}"' for name, value in node.attrib.items())
+    return f"<{node.tag}{attrs}>"
+
+
+def _shorten(text: str, limit: int = SHELL_TEXT_LIMIT) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join((text or "").split())
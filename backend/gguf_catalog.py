@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+from collections import Counter
+from dataclasses import asdict, dataclass
+from time import time
+from typing import Dict, List, Optional
+
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF metadata value types
+_SCALARS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d",
+}
+_STRING, _ARRAY = 8, 9
+
+# llama_ftype values stored in general.file_type
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+}
+
+# llama.cpp tolerates this much vocabulary padding between a model and its draft
+DRAFT_VOCAB_MAX_DIFFERENCE = 128
+
+# A draft model is only worth running when it is much cheaper than the target
+DRAFT_MAX_SIZE_RATIO = 0.25
+
+# ggml_type values of tensors, used when general.file_type is missing
+TENSOR_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 6: "Q5_0", 7: "Q5_1", 8: "Q8_0", 9: "Q8_1",
+    10: "Q2_K", 11: "Q3_K", 12: "Q4_K", 13: "Q5_K", 14: "Q6_K", 15: "Q8_K", 16: "IQ2_XXS",
+    17: "IQ2_XS", 18: "IQ3_XXS", 19: "IQ1_S", 20: "IQ4_NL", 21: "IQ3_S", 22: "IQ2_S",
+    23: "IQ4_XS", 29: "IQ1_M", 30: "BF16", 34: "TQ1_0", 35: "TQ2_0",
+}
+
+
+@dataclass
+class ModelInfo:
+    """What the GGUF header says about a model file (weights are never read)."""
+    file: str
+    size_bytes: int
+    mtime: float
+    architecture: Optional[str] = None
+    name: Optional[str] = None
+    parameter_count: Optional[int] = None
+    quantization: Optional[str] = None
+    n_layers: Optional[int] = None
+    context_length: Optional[int] = None
+    embedding_length: Optional[int] = None
+    head_count: Optional[int] = None
+    head_count_kv: Optional[int] = None
+    vocab_size: Optional[int] = None
+    tokenizer_model: Optional[str] = None
+    tokenizer_pre: Optional[str] = None
+    bos_token_id: Optional[int] = None
+    eos_token_id: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def size_mb(self) -> int:
+        return int(self.size_bytes / 2**20)
+
+    @property
+    def kv_bytes_per_token(self) -> Optional[int]:
+        """f16 K and V cache size of one token across all layers."""
+        if not (self.n_layers and self.embedding_length and self.head_count):
+            return None
+        head_dim = self.embedding_length // self.head_count
+        return self.n_layers * 2 * (self.head_count_kv or self.head_count) * head_dim * 2
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["kv_bytes_per_token"] = self.kv_bytes_per_token
+        return data
+
+
+class _Reader:
+    """Sequential little-endian reader over a memory-mapped GGUF header."""
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def scalar(self, fmt: str):
+        value = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def string(self) -> str:
+        length = self.scalar("<Q")
+        value = bytes(self.buf[self.pos:self.pos + length]).decode("utf-8", errors="replace")
+        self.pos += length
+        return value
+
+    def skip_string(self):
+        length = self.scalar("<Q")
+        self.pos += length
+
+    def value(self, value_type: int):
+        """Read one metadata value; arrays return their length only (token lists are huge)."""
+        if value_type in _SCALARS:
+            return self.scalar(_SCALARS[value_type])
+        if value_type == _STRING:
+            return self.string()
+        if value_type == _ARRAY:
+            item_type = self.scalar("<I")
+            count = self.scalar("<Q")
+            if item_type in _SCALARS:
+                self.pos += struct.calcsize(_SCALARS[item_type]) * count
+            elif item_type == _STRING:
+                # Token and merge lists hold 100k+ strings; skip them without decoding
+                for _ in range(count):
+                    self.skip_string()
+            else:
+                for _ in range(count):
+                    self.value(item_type)
+            return count
+        raise ValueError(f"Unknown GGUF value type {value_type}")
+
+
+def read_gguf(path: str) -> ModelInfo:
+    """Read model metadata from a GGUF header via mmap, without touching the weights."""
+    stat = os.stat(path)
+    info = ModelInfo(file=os.path.basename(path), size_bytes=stat.st_size, mtime=stat.st_mtime)
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            _parse_header(_Reader(buf), info)
+    except struct.error:
+        info.error = "truncated GGUF header"
+    except (OSError, ValueError) as e:
+        info.error = str(e) or type(e).__name__
+    if info.error:
+        logging.warning(f"Could not read GGUF header of {path}: {info.error}")
+    return info
+
+
+def _parse_header(reader: _Reader, info: ModelInfo):
+    if bytes(reader.buf[:4]) != GGUF_MAGIC:
+        raise ValueError("not a GGUF file")
+    reader.pos = 4
+    version = reader.scalar("<I")
+    if version < 2:
+        raise ValueError(f"unsupported GGUF version {version}")
+    tensor_count = reader.scalar("<Q")
+    kv_count = reader.scalar("<Q")
+
+    meta: Dict[str, object] = {}
+    for _ in range(kv_count):
+        key = reader.string()
+        meta[key] = reader.value(reader.scalar("<I"))
+
+    parameters = 0
+    tensor_types: Counter = Counter()
+    for _ in range(tensor_count):
+        reader.skip_string()
+        n_dims = reader.scalar("<I")
+        elements = 1
+        for _ in range(n_dims):
+            elements *= reader.scalar("<Q")
+        tensor_types[reader.scalar("<I")] += elements
+        reader.pos += 8  # data offset
+        parameters += elements
+
+    arch = meta.get("general.architecture")
+    info.architecture = arch
+    info.name = meta.get("general.name")
+    info.parameter_count = meta.get("general.parameter_count") or parameters or None
+    file_type = meta.get("general.file_type")
+    if file_type in FILE_TYPES:
+        info.quantization = FILE_TYPES[file_type]
+    elif tensor_types:
+        info.quantization = TENSOR_TYPES.get(tensor_types.most_common(1)[0][0])
+    if arch:
+        info.n_layers = meta.get(f"{arch}.block_count")
+        info.context_length = meta.get(f"{arch}.context_length")
+        info.embedding_length = meta.get(f"{arch}.embedding_length")
+        info.head_count = meta.get(f"{arch}.attention.head_count")
+        info.head_count_kv = meta.get(f"{arch}.attention.head_count_kv")
+    info.vocab_size = meta.get("tokenizer.ggml.tokens")
+    info.tokenizer_model = meta.get("tokenizer.ggml.model")
+    info.tokenizer_pre = meta.get("tokenizer.ggml.pre")
+    info.bos_token_id = meta.get("tokenizer.ggml.bos_token_id")
+    info.eos_token_id = meta.get("tokenizer.ggml.eos_token_id")
+
+
+def draft_mismatch(target: ModelInfo, draft: ModelInfo) -> Optional[str]:
+    """Why ``draft`` cannot propose tokens for ``target``; None when it can.
+
+    Speculative decoding needs both models to share a tokenizer: llama.cpp
+    accepts vocabularies whose sizes differ by at most
+    ``DRAFT_VOCAB_MAX_DIFFERENCE`` (padding) and whose special tokens match.
+    Same architecture is required as well, which in practice means the same
+    model family.
+    """
+    if target.error or draft.error:
+        return "unreadable GGUF header"
+    if not target.architecture or draft.architecture != target.architecture:
+        return f"architecture {draft.architecture} differs from {target.architecture}"
+    if draft.tokenizer_model != target.tokenizer_model or draft.tokenizer_pre != target.tokenizer_pre:
+        return "tokenizer differs"
+    if target.vocab_size is None or draft.vocab_size is None:
+        return "vocabulary size unknown"
+    if abs(target.vocab_size - draft.vocab_size) > DRAFT_VOCAB_MAX_DIFFERENCE:
+        return f"vocabulary of {draft.vocab_size} tokens differs from {target.vocab_size}"
+    if (draft.bos_token_id, draft.eos_token_id) != (target.bos_token_id, target.eos_token_id):
+        return "special tokens differ"
+    return None
+
+
+class ModelCatalog:
+    """Cached index of the GGUF files in a directory.
+
+    Headers are parsed once per file; a rescan only re-reads files whose size or
+    mtime changed. Rescans happen when the directory mtime changes (files added,
+    removed or renamed) or at most every ``rescan_interval`` seconds to catch
+    files overwritten in place.
+
+    The accessors are dict lookups and never touch the disk: ``refresh`` stats
+    and parses files, so it runs at startup and from ``watch`` in a worker
+    thread, off the event loop. A rescan swaps in a new dict, so lookups
+    never see a half-built index.
+    """
+    def __init__(self, models_dir: str, rescan_interval: float = 30.0):
+        self.models_dir = models_dir
+        self.rescan_interval = rescan_interval
+        self._models: Dict[str, ModelInfo] = {}
+        self._dir_mtime: Optional[float] = None
+        self._scanned_at = 0.0
+        self.scans = 0
+        self.headers_read = 0
+
+    def _stale(self) -> bool:
+        try:
+            dir_mtime = os.stat(self.models_dir).st_mtime
+        except OSError:
+            dir_mtime = None
+        return dir_mtime != self._dir_mtime or time() - self._scanned_at > self.rescan_interval
+
+    def refresh(self, force: bool = False):
+        """Rescan the directory if it changed, re-reading only new or modified files."""
+        if not force and not self._stale():
+            return
+        try:
+            self._dir_mtime = os.stat(self.models_dir).st_mtime
+            entries = [e for e in os.scandir(self.models_dir) if e.name.endswith(".gguf") and e.is_file()]
+        except OSError:
+            self._dir_mtime = None
+            entries = []
+        models = {}
+        for entry in entries:
+            stat = entry.stat()
+            cached = self._models.get(entry.name)
+            if cached and cached.size_bytes == stat.st_size and cached.mtime == stat.st_mtime:
+                models[entry.name] = cached
+            else:
+                models[entry.name] = read_gguf(entry.path)
+                self.headers_read += 1
+        added = models.keys() - self._models.keys()
+        removed = self._models.keys() - models.keys()
+        if added or removed:
+            logging.info(f"Model catalog: {len(models)} models (added {sorted(added)}, removed {sorted(removed)})")
+        self._models = models
+        self._scanned_at = time()
+        self.scans += 1
+
+    async def watch(self, poll_interval: float = 2.0):
+        """Rescan in a worker thread whenever the directory looks stale (see refresh)."""
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logging.warning(f"Model catalog rescan failed: {e}")
+            await asyncio.sleep(poll_interval)
+
+    def names(self) -> List[str]:
+        return sorted(self._models)
+
+    def get(self, name: str) -> Optional[ModelInfo]:
+        return self._models.get(name)
+
+    def find_draft(self, name: str) -> Optional[ModelInfo]:
+        """The smallest model in the directory that can draft for ``name``, if any.
+
+        Candidates share the target's architecture and tokenizer (see
+        draft_mismatch) and are at most ``DRAFT_MAX_SIZE_RATIO`` of its size.
+        """
+        target = self._models.get(name)
+        if target is None:
+            return None
+        candidates = [info for other, info in self._models.items()
+                      if other != name and info.size_bytes <= target.size_bytes * DRAFT_MAX_SIZE_RATIO
+                      and draft_mismatch(target, info) is None]
+        return min(candidates, key=lambda info: info.size_bytes, default=None)
+
+    def describe(self) -> List[dict]:
+        return [self._models[name].as_dict() for name in sorted(self._models)]
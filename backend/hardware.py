@@ -0,0 +1,352 @@
+import logging
+import os
+import subprocess
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional
+
+# llama.cpp's matmuls stop scaling at about this many threads per process
+MAX_THREADS = 16
+
+
+@dataclass
+class GpuInfo:
+    name: str
+    memory_total_mb: int
+    memory_free_mb: int
+
+
+@dataclass
+class HardwareProfile:
+    """What the host offers to llama-server, probed once and cached.
+
+    CPU and memory figures respect container limits (CPU affinity, cgroup
+    quotas), since those are what the process can actually use. Free RAM and
+    VRAM are a snapshot from before any model was loaded: each launch takes
+    off what is already held (see reserve_memory) instead of trusting them.
+    """
+    logical_cpus: int
+    physical_cores: int
+    allowed_cpus: List[int]
+    numa_nodes: Dict[int, List[int]]
+    ram_total_mb: int
+    ram_available_mb: int
+    gpus: List[GpuInfo] = field(default_factory=list)
+    probed_at: float = field(default_factory=time)
+
+    @property
+    def has_gpu(self) -> bool:
+        return bool(self.gpus)
+
+    @property
+    def gpu_free_mb(self) -> int:
+        return self.gpus[0].memory_free_mb if self.gpus else 0
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["allowed_cpus"] = len(self.allowed_cpus)
+        data["numa_nodes"] = {node: len(cpus) for node, cpus in self.numa_nodes.items()}
+        return data
+
+
+@dataclass
+class LaunchParams:
+    """llama-server launch parameters derived from the hardware profile and the model."""
+    threads: int
+    parallel: int
+    ctx_size: int
+    batch_size: int
+    gpu_layers: int
+    # Estimated VRAM the server holds (offloaded weights, their KV cache, CUDA buffers)
+    vram_mb: int = 0
+
+    def as_args(self) -> List[str]:
+        args = [
+            "--threads", str(self.threads),
+            "--parallel", str(self.parallel),
+            "-c", str(self.ctx_size),
+            "--batch-size", str(self.batch_size),
+        ]
+        if self.gpu_layers:
+            args += ["-ngl", str(self.gpu_layers), "--main-gpu", "0"]
+        return args
+
+
+def probe_hardware() -> HardwareProfile:
+    """Probe CPU topology, memory and GPUs. Blocking: run it off the event loop."""
+    allowed = _allowed_cpus()
+    quota = _cgroup_cpu_quota()
+    physical = _physical_cores(allowed)
+    if quota:
+        physical = max(1, min(physical, quota))
+    ram_total, ram_available = _memory_mb()
+    profile = HardwareProfile(
+        logical_cpus=os.cpu_count() or len(allowed),
+        physical_cores=physical,
+        allowed_cpus=allowed,
+        numa_nodes=_numa_nodes(allowed),
+        ram_total_mb=ram_total,
+        ram_available_mb=ram_available,
+        gpus=_probe_gpus(),
+    )
+    logging.info(f"Hardware: {len(allowed)} CPUs ({physical} physical cores), "
+                 f"{ram_total} MB RAM, GPUs: {[g.name for g in profile.gpus] or 'none'}")
+    return profile
+
+
+def derive_launch_params(profile: HardwareProfile, model_size_mb: int, n_layers: Optional[int],
+                         max_context_tokens: int, min_slot_context: int,
+                         kv_bytes_per_token: Optional[int] = None) -> LaunchParams:
+    """Pick llama-server parameters that fit the model into this host.
+
+    - threads: physical cores (hyperthreads slow down llama.cpp's matmuls)
+    - gpu_layers: as many layers (weights plus their KV cache) as fit into free VRAM
+    - parallel: slots the hardware can decode concurrently, each keeping at least
+      ``min_slot_context`` tokens of context
+    - ctx_size: total context (split across slots), capped by the memory left for the KV cache
+    """
+    n_layers = n_layers or _guess_layers(model_size_mb)
+    kv_mb_per_token = _kv_mb_per_token(n_layers, kv_bytes_per_token)
+
+    if profile.has_gpu:
+        parallel = 8 if profile.gpu_free_mb >= 16000 else 4
+        batch_size = 1024
+    else:
+        parallel = max(1, min(4, profile.physical_cores // 4))
+        batch_size = 256
+    parallel = max(1, min(parallel, max_context_tokens // max(min_slot_context, 1)))
+    ctx_size = max(min_slot_context, min(max_context_tokens, min_slot_context * parallel))
+
+    gpu_layers = 0
+    if profile.has_gpu:
+        # An offloaded layer brings its weights and its share of the KV cache into VRAM
+        per_layer = model_size_mb / (n_layers + 1) + kv_mb_per_token * ctx_size / n_layers
+        usable = profile.gpu_free_mb - 512
+        fit = int(usable / per_layer) if usable > 0 else 0
+        # n_layers + 1 also offloads the output layer
+        gpu_layers = max(0, min(n_layers + 1, fit))
+
+    # Whatever is not on the GPU lives in RAM next to the KV cache
+    offloaded_mb = model_size_mb * gpu_layers / (n_layers + 1)
+    ram_left = profile.ram_available_mb - (model_size_mb - offloaded_mb) - 512
+    if not profile.has_gpu or gpu_layers <= n_layers:
+        max_ctx = int(ram_left / kv_mb_per_token) if ram_left > 0 else min_slot_context
+        while parallel > 1 and ctx_size > max_ctx:
+            parallel -= 1
+            ctx_size = min(max_context_tokens, min_slot_context * parallel)
+        ctx_size = max(2048, min(ctx_size, max_ctx))
+
+    threads = max(1, min(profile.physical_cores, MAX_THREADS))
+    params = LaunchParams(threads=threads, parallel=parallel, ctx_size=ctx_size,
+                          batch_size=batch_size, gpu_layers=gpu_layers)
+    params.vram_mb = estimate_vram_mb(params, model_size_mb, n_layers, kv_bytes_per_token)
+    return params
+
+
+def estimate_vram_mb(params: LaunchParams, model_size_mb: int, n_layers: Optional[int],
+                     kv_bytes_per_token: Optional[int] = None) -> int:
+    """VRAM taken by a llama-server launched with ``params``: offloaded layers with their KV cache."""
+    if not params.gpu_layers:
+        return 0
+    n_layers = n_layers or _guess_layers(model_size_mb)
+    layers = min(params.gpu_layers, n_layers + 1)
+    kv_mb = _kv_mb_per_token(n_layers, kv_bytes_per_token) * params.ctx_size * min(layers, n_layers) / n_layers
+    return int(model_size_mb * layers / (n_layers + 1) + kv_mb + 512)
+
+
+def reserve_memory(profile: HardwareProfile, ram_mb: int, vram_mb: int) -> HardwareProfile:
+    """The profile with ``ram_mb`` of RAM and ``vram_mb`` of the first GPU's memory taken by others."""
+    gpus = list(profile.gpus)
+    if gpus and vram_mb:
+        gpus[0] = replace(gpus[0], memory_free_mb=max(0, gpus[0].memory_free_mb - vram_mb))
+    return replace(profile, ram_available_mb=max(0, profile.ram_available_mb - ram_mb), gpus=gpus)
+
+
+def _kv_mb_per_token(n_layers: int, kv_bytes_per_token: Optional[int]) -> float:
+    # Without GGUF metadata assume f16 K and V with ~1024-wide GQA projections
+    return (kv_bytes_per_token or n_layers * 4096) / 2**20
+
+
+def suggest_replicas(profile: HardwareProfile) -> int:
+    """llama-server processes worth running for one model: one per MAX_THREADS physical cores on a CPU host.
+
+    A GPU host runs one, since replicas would only split the same VRAM.
+    """
+    if profile.has_gpu:
+        return 1
+    return max(1, profile.physical_cores // MAX_THREADS)
+
+
+def partition_hardware(profile: HardwareProfile, parts: int) -> List[HardwareProfile]:
+    """Split the host into ``parts`` disjoint CPU sets, one per llama-server replica. Blocking (reads sysfs).
+
+    Physical cores are taken in NUMA node order and cut into contiguous runs,
+    so a replica spans two nodes only when the cores do not divide evenly;
+    hyperthread siblings stay with their core. RAM and free VRAM are split
+    equally, which sizes each replica's KV cache accordingly.
+    """
+    node_of = {cpu: node for node, cpus in profile.numa_nodes.items() for cpu in cpus}
+    cores = sorted(_core_groups(profile.allowed_cpus), key=lambda core: (node_of.get(core[0], 0), core[0]))
+    parts = max(1, min(parts, len(cores)))
+    slices = []
+    for i in range(parts):
+        group = cores[len(cores) * i // parts:len(cores) * (i + 1) // parts]
+        cpus = sorted(cpu for core in group for cpu in core)
+        nodes = {node: [cpu for cpu in cpus if node_of.get(cpu, 0) == node] for node in profile.numa_nodes}
+        slices.append(replace(
+            profile,
+            logical_cpus=len(cpus),
+            # A cgroup quota below the core count is shared out as well
+            physical_cores=max(1, min(len(group), profile.physical_cores // parts)),
+            allowed_cpus=cpus,
+            numa_nodes={node: node_cpus for node, node_cpus in nodes.items() if node_cpus},
+            ram_total_mb=profile.ram_total_mb // parts,
+            ram_available_mb=profile.ram_available_mb // parts,
+            gpus=[replace(gpu, memory_free_mb=gpu.memory_free_mb // parts) for gpu in profile.gpus],
+        ))
+    return slices
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    """Compact form of a CPU list as used by sysfs and taskset, e.g. "0-15,32-47"."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{start}-{end}" if end > start else str(start) for start, end in ranges)
+
+
+def _guess_layers(model_size_mb: int) -> int:
+    """Layer count typical for a model of this file size, used when the GGUF header is unreadable."""
+    if model_size_mb < 1500:
+        return 24
+    if model_size_mb < 3000:
+        return 28
+    if model_size_mb < 6000:
+        return 32
+    if model_size_mb < 12000:
+        return 40
+    return 64
+
+
+def _allowed_cpus() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return list(range(os.cpu_count() or 1))
+
+
+def _cgroup_cpu_quota() -> Optional[int]:
+    """CPUs granted by a cgroup v2 (or v1) quota, rounded up; None when unlimited."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        if quota != "max":
+            return max(1, -(-int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0:
+            return max(1, -(-quota // period))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _physical_cores(allowed: List[int]) -> int:
+    """Distinct (package, core) pairs among the allowed CPUs."""
+    cores = set()
+    for cpu in allowed:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            package = (topology / "physical_package_id").read_text().strip()
+            core = (topology / "core_id").read_text().strip()
+        except OSError:
+            return len(allowed)
+        cores.add((package, core))
+    return len(cores) or len(allowed)
+
+
+def _core_groups(allowed: List[int]) -> List[List[int]]:
+    """Allowed CPUs grouped by physical core, hyperthread siblings together."""
+    groups: Dict[tuple, List[int]] = {}
+    for cpu in allowed:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            key = ((topology / "physical_package_id").read_text().strip(), (topology / "core_id").read_text().strip())
+        except OSError:
+            key = ("cpu", str(cpu))
+        groups.setdefault(key, []).append(cpu)
+    return list(groups.values())
+
+
+def _numa_nodes(allowed: List[int]) -> Dict[int, List[int]]:
+    nodes = {}
+    allowed_set = set(allowed)
+    for path in sorted(Path("/sys/devices/system/node").glob("node[0-9]*")):
+        try:
+            cpus = [c for c in _parse_cpulist((path / "cpulist").read_text()) if c in allowed_set]
+        except OSError:
+            continue
+        if cpus:
+            nodes[int(path.name[4:])] = cpus
+    return nodes or {0: allowed}
+
+
+def _parse_cpulist(text: str) -> List[int]:
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def _memory_mb() -> tuple:
+    """(total, available) RAM in MB, capped by a cgroup memory limit."""
+    info = {}
+    try:
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            name, value = line.split(":", 1)
+            info[name] = int(value.split()[0]) // 1024
+    except (OSError, ValueError):
+        pass
+    total = info.get("MemTotal", 0)
+    available = info.get("MemAvailable", total)
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            limit = Path(path).read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit() and (not total or int(limit) // 2**20 < total):
+            total = int(limit) // 2**20
+            available = min(available, total)
+        break
+    return total, available
+
+
+def _probe_gpus() -> List[GpuInfo]:
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=name,memory.total,memory.free", "--format=csv,noheader,nounits"],
+            capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.debug(f"GPU probe failed: {e}")
+        return []
+    if result.returncode != 0:
+        return []
+    gpus = []
+    for line in result.stdout.strip().splitlines():
+        try:
+            name, total, free = [part.strip() for part in line.split(",")]
+            gpus.append(GpuInfo(name=name, memory_total_mb=int(total), memory_free_mb=int(free)))
+        except ValueError:
+            logging.debug(f"Unexpected nvidia-smi line: {line}")
+    return gpus
@@ -0,0 +1,116 @@
+import json
+from typing import Optional
+
+
+STOP_AFTER_MODES = ("object", "primary_xpath", "none")
+
+
+class JsonCompletionTracker:
+    """Tracks a streamed completion and detects when its JSON answer is complete.
+
+    The tracker scans tokens as they arrive and keeps a minimal JSON lexer state
+    (depth, string/escape flags, current top-level key). Generation can be cut
+    off once the top-level object has closed ("object") or as soon as the
+    "primary_xpath" value has closed ("primary_xpath").
+    """
+    def __init__(self, stop_after: Optional[str] = "object"):
+        if stop_after not in STOP_AFTER_MODES and stop_after is not None:
+            raise ValueError(f"Unknown stop_after mode: {stop_after}")
+        self.stop_after = None if stop_after == "none" else stop_after
+        self.parts = []
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_chars = []
+        self._expect_value = False
+        self._last_key = None
+
+    def feed(self, chunk: str) -> str:
+        """Consume a streamed chunk; return the part of it that belongs to the answer."""
+        if self.done or not chunk:
+            return ""
+        if not self.stop_after:
+            self.parts.append(chunk)
+            return chunk
+        for i, ch in enumerate(chunk):
+            if self._scan(ch):
+                self.done = True
+                kept = chunk[:i + 1]
+                self.parts.append(kept)
+                return kept
+        self.parts.append(chunk)
+        return chunk
+
+    def _scan(self, ch: str) -> bool:
+        """Advance the lexer by one character; return True when the answer is complete."""
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                return self._close_string()
+            if self._depth == 1:
+                self._string_chars.append(ch)
+            return False
+
+        if ch == '"' and self._depth > 0:
+            self._in_string = True
+            self._string_chars = []
+        elif ch == "{" or (ch == "[" and self._depth > 0):
+            # Only an object starts the answer: "[1]" in prose before it is not JSON
+            self._depth += 1
+        elif ch in "}]" and self._depth > 0:
+            self._depth -= 1
+            if self._depth == 0:
+                return True
+        elif self._depth == 1:
+            if ch == ":":
+                self._expect_value = True
+            elif ch == ",":
+                self._expect_value = False
+        return False
+
+    def _close_string(self) -> bool:
+        if self._depth != 1:
+            return False
+        if not self._expect_value:
+            self._last_key = "".join(self._string_chars)
+            return False
+        return self.stop_after == "primary_xpath" and self._last_key == "primary_xpath"
+
+    def closing_suffix(self) -> str:
+        """Return the text needed to close the object when it was cut at primary_xpath."""
+        if self.done and self.stop_after == "primary_xpath" and self._depth == 1:
+            return "}"
+        return ""
+
+    def text(self) -> str:
+        """Return the accumulated answer as parseable text."""
+        return "".join(self.parts).strip() + self.closing_suffix()
+
+
+def sse_event(payload) -> str:
+    """Format a payload as a server-sent event."""
+    if isinstance(payload, str):
+        return f"data: {payload}\n\n"
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def chat_chunk(content: str, model: Optional[str], finish_reason: Optional[str] = None, **extra) -> str:
+    """Format an OpenAI-style chat completion chunk as a server-sent event."""
+    payload = {
+        "object": "chat.completion.chunk",
+        "model": model,
+        "choices": [
+            {
+                "delta": {"content": content} if content else {},
+                "finish_reason": finish_reason,
+                "index": 0
+            }
+        ],
+    }
+    payload.update(extra)
+    return sse_event(payload)
@@ -0,0 +1,240 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from lxml import etree, html as lxml_html
+
+from dom_compact import is_stable_value
+from dom_window import ElementSpec
+
+
+# Attributes written for tests; the most reliable locators a page can offer
+TEST_ATTRIBUTES = ("data-testid", "data-test-id", "data-test", "data-qa", "data-cy")
+
+# Attributes that identify form controls and labelled elements
+LABEL_ATTRIBUTES = ("placeholder", "title", "alt", "for")
+
+FORM_TAGS = {"input", "select", "textarea", "button", "form", "fieldset", "output"}
+
+# Robustness scores per strategy; the fast path answers when the best unique one reaches the minimum
+SCORES = {
+    "id": 100,
+    "test-attribute": 95,
+    "name": 85,
+    "aria-label": 80,
+    "role-name": 75,
+    "label-attribute": 70,
+    "text": 65,
+    "link": 60,
+    "anchored": 60,
+    "anchored-tag": 50,
+    "anchored-position": 40,
+    "position": 10,
+}
+
+MAX_TEXT_CHARS = 50
+MAX_ANCHOR_DEPTH = 6
+
+
+@dataclass
+class Locator:
+    xpath: str
+    strategy: str
+    score: int
+
+    def as_dict(self) -> dict:
+        return {"xpath": self.xpath, "strategy": self.strategy, "score": self.score}
+
+
+@dataclass
+class LocatorResult:
+    """Unique locators for the target element, best first.
+
+    ``target_found`` is False when the element is missing from the DOM or matches
+    several identical nodes, in which case no locator can be trusted.
+    """
+    target_found: bool
+    candidates: List[Locator] = field(default_factory=list)
+
+    @property
+    def best(self) -> Optional[Locator]:
+        return self.candidates[0] if self.candidates else None
+
+    def alternative(self) -> Optional[Locator]:
+        """Best candidate built with a different strategy than the primary."""
+        for candidate in self.candidates[1:]:
+            if candidate.strategy != self.best.strategy and candidate.score > SCORES["position"]:
+                return candidate
+        return None
+
+    def answer(self) -> dict:
+        """The primary/alternative/explanation object the extension expects from the model."""
+        alternative = self.alternative()
+        return {
+            "primary_xpath": self.best.xpath,
+            "alternative_xpath": alternative.xpath if alternative else None,
+            "explanation": f"Unique {self.best.strategy} locator verified against the page DOM.",
+        }
+
+    def as_dict(self) -> dict:
+        return {"target_found": self.target_found, "candidates": [c.as_dict() for c in self.candidates]}
+
+
+def xpath_literal(value: str) -> str:
+    """Quote a string for XPath 1.0, which has no escape sequences."""
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    parts = value.split("'")
+    return "concat(" + ", \"'\", ".join(f"'{part}'" for part in parts) + ")"
+
+
+def parse_page(dom: str) -> etree._Element:
+    """Parse the DOM as-is: uniqueness must be checked against everything the browser sees."""
+    return lxml_html.document_fromstring(dom)
+
+
+def find_locators(root: etree._Element, spec: ElementSpec, limit: int = 5) -> LocatorResult:
+    """Enumerate ranked locator strategies and keep those matching only the target element."""
+    target = find_target(root, spec)
+    if target is None:
+        return LocatorResult(target_found=False)
+
+    candidates: List[Locator] = []
+    seen = set()
+    for xpath, strategy in _candidates(target):
+        if xpath in seen:
+            continue
+        seen.add(xpath)
+        if _is_unique(root, xpath, target):
+            candidates.append(Locator(xpath, strategy, SCORES[strategy]))
+            if len(candidates) >= limit:
+                break
+    if not any(c.strategy == "position" for c in candidates):
+        candidates.append(Locator(_absolute_path(target), "position", SCORES["position"]))
+    candidates.sort(key=lambda c: -c.score)
+    return LocatorResult(target_found=True, candidates=candidates[:limit])
+
+
+def find_target(root: etree._Element, spec: ElementSpec) -> Optional[etree._Element]:
+    """The single node agreeing with every known attribute and the text of the clicked element.
+
+    Returns None when nothing matches exactly or several nodes are indistinguishable:
+    guessing would produce a confident but wrong locator.
+    """
+    if not spec.tag:
+        return None
+    matches = []
+    for node in root.iter(spec.tag):
+        if _matches_exactly(node, spec):
+            matches.append(node)
+            if len(matches) > 1:
+                return None
+    return matches[0] if matches else None
+
+
+def _matches_exactly(node: etree._Element, spec: ElementSpec) -> bool:
+    for name, value in spec.attributes.items():
+        actual = node.get(name)
+        if name == "class":
+            if not set(value.split()) <= set((actual or "").split()):
+                return False
+        elif actual != value:
+            return False
+    return not spec.text or _normalize(node.text_content()) == spec.text
+
+
+def _is_unique(root: etree._Element, xpath: str, target: etree._Element) -> bool:
+    try:
+        matches = root.xpath(xpath)
+    except etree.XPathError as e:
+        logging.debug(f"Invalid candidate XPath {xpath}: {e}")
+        return False
+    return len(matches) == 1 and matches[0] is target
+
+
+def _candidates(target: etree._Element):
+    """Yield (xpath, strategy) pairs from most to least robust."""
+    tag = target.tag
+    yield from _own_candidates(target)
+
+    # Relative to the nearest ancestors that have a unique stable locator of their own
+    own = [(xpath, strategy) for xpath, strategy in _own_candidates(target)
+           if strategy in ("text", "label-attribute", "aria-label", "name", "link")]
+    for depth, ancestor in enumerate(target.iterancestors()):
+        if depth >= MAX_ANCHOR_DEPTH or ancestor.tag in ("body", "html"):
+            break
+        for anchor, _ in _own_candidates(ancestor, allow_text=False):
+            for xpath, _ in own:
+                yield anchor + xpath, "anchored"
+            yield f"{anchor}//{tag}", "anchored-tag"
+            same_tag = list(ancestor.iterdescendants(tag))
+            yield f"({anchor}//{tag})[{same_tag.index(target) + 1}]", "anchored-position"
+            break
+
+
+def _own_candidates(node: etree._Element, allow_text: bool = True):
+    """Locators built from the node's own attributes and text."""
+    tag = node.tag
+    element_id = node.get("id")
+    if element_id and is_stable_value(element_id):
+        yield f"//{tag}[@id={xpath_literal(element_id)}]", "id"
+    for name in TEST_ATTRIBUTES:
+        value = node.get(name)
+        if value:
+            yield f"//{tag}[@{name}={xpath_literal(value)}]", "test-attribute"
+    name_value = node.get("name")
+    if name_value and tag in FORM_TAGS:
+        yield f"//{tag}[@name={xpath_literal(name_value)}]", "name"
+    aria_label = node.get("aria-label")
+    if aria_label:
+        yield f"//{tag}[@aria-label={xpath_literal(aria_label)}]", "aria-label"
+    text = _normalize(node.text_content()) if allow_text else ""
+    role = node.get("role")
+    if role and text and len(text) <= MAX_TEXT_CHARS:
+        yield f"//*[@role={xpath_literal(role)} and normalize-space()={xpath_literal(text)}]", "role-name"
+    for name in LABEL_ATTRIBUTES:
+        value = node.get(name)
+        if value and len(value) <= MAX_TEXT_CHARS:
+            yield f"//{tag}[@{name}={xpath_literal(value)}]", "label-attribute"
+    if text and len(text) <= MAX_TEXT_CHARS:
+        yield f"//{tag}[normalize-space()={xpath_literal(text)}]", "text"
+    href = node.get("href")
+    if tag == "a" and href and len(href) <= MAX_TEXT_CHARS and "?" not in href and is_stable_value(href.strip("/")):
+        yield f"//a[@href={xpath_literal(href)}]", "link"
+
+
+def _normalize(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+def _absolute_path(node: etree._Element) -> str:
+    """Positional path from the root; last resort, breaks on any layout change."""
+    steps = []
+    while node is not None and isinstance(node.tag, str):
+        parent = node.getparent()
+        if parent is None:
+            steps.append(node.tag)
+            break
+        same_tag = [sibling for sibling in parent if sibling.tag == node.tag]
+        steps.append(f"{node.tag}[{same_tag.index(node) + 1}]" if len(same_tag) > 1 else node.tag)
+        node = parent
+    return "/" + "/".join(reversed(steps))
+
+
+def locate(dom: str, specs: List[ElementSpec], limit: int = 5,
+           root: Optional[etree._Element] = None) -> List[LocatorResult]:
+    """Parse the DOM once (unless its ``root`` is given) and find locators for each element spec."""
+    if root is None:
+        try:
+            root = parse_page(dom)
+        except (etree.ParserError, ValueError) as e:
+            logging.warning(f"Could not parse DOM for locators: {e}")
+            return [LocatorResult(target_found=False) for _ in specs]
+    return [find_locators(root, spec, limit) for spec in specs]
+
+
+def robust_answers(results: List[LocatorResult], min_score: int) -> Dict[int, LocatorResult]:
+    """Indices of elements whose best unique locator is robust enough to skip the model."""
+    return {i: r for i, r in enumerate(results) if r.best and r.best.score >= min_score}
@@ -1,19 +1,40 @@
 import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+import hashlib
 import json
 import os
 from pathlib import Path
 import re
-import subprocess
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import logging
 from time import time
-from typing import Optional, List
+from typing import Any, AsyncIterator, Dict, Literal, Optional, List, Tuple
 import httpx
 
+from answer_schema import answer_schema, structured_answer
+from cancellation import CancellationMiddleware, count_cancelled
+from decompression import DecompressionMiddleware
+from dom_store import DomStore, StoredDom
+from dom_window import DomWindow, ElementSpec, parse_dom, parse_element, window_dom, window_dom_many
+from gguf_catalog import ModelCatalog, ModelInfo, draft_mismatch
+from hardware import (HardwareProfile, LaunchParams, derive_launch_params, estimate_vram_mb, format_cpulist, partition_hardware,
+                      probe_hardware, reserve_memory, suggest_replicas)
+from json_stream import JsonCompletionTracker, chat_chunk, sse_event
+from locators import LocatorResult, locate, robust_answers
+from metrics import (COALESCED_REQUESTS, LOADED_MODELS, LOCATOR_FAST_PATH, MODEL_LOAD_SECONDS, MODEL_SWITCHES, QUEUE_DEPTH, QUEUE_RUNNING,
+                     REPLICA_RESTARTS, STREAM_ERRORS, XPATH_VALIDATION, DecodeTotals, GenerationStats, MetricsMiddleware, metrics_response)
+from prompt_templates import CompiledTemplate, TemplateRegistry
+from providers import GenerationRequest, Provider, ProviderError, ProviderRouter, build_provider
+from response_cache import ResponseCache, SingleFlight
+from scheduler import QueueFullError, QueueTimeoutError, RequestScheduler
+from xpath_check import AnswerValidation, DomChecker, compiled_xpaths, make_checker, repair_prompt
+
 
 logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +50,56 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("__main__").setLevel(logging.DEBUG)
 logging.getLogger("uvicorn").setLevel(logging.INFO)
 
+class SlotRouter:
+    """Routes requests to llama-server slots that already hold their prompt prefix.
+
+    llama.cpp keeps the KV cache of the last prompt per slot; with cache_prompt
+    enabled a request only prefills the part of its prompt that differs from
+    what the slot already holds. Sending requests with the same static prefix to
+    the same idle slot lets the instruction block be evaluated once per slot.
+    """
+    def __init__(self, n_slots: int):
+        self.n_slots = max(1, n_slots)
+        self.busy = [False] * self.n_slots
+        self.prefixes: List[Optional[str]] = [None] * self.n_slots
+        self.last_used = [0.0] * self.n_slots
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, prefix_key: Optional[str]) -> int:
+        """Reserve an idle slot, preferring one that holds prefix_key; -1 if all are busy."""
+        idle = [i for i in range(self.n_slots) if not self.busy[i]]
+        if not idle:
+            return -1
+        matching = [i for i in idle if prefix_key and self.prefixes[i] == prefix_key]
+        if matching:
+            slot = matching[0]
+            self.hits += 1
+        else:
+            # Prefer an empty slot, then the least recently used one
+            slot = min(idle, key=lambda i: (self.prefixes[i] is not None, self.last_used[i]))
+            self.misses += 1
+        self.busy[slot] = True
+        self.prefixes[slot] = prefix_key
+        return slot
+
+    def holds(self, prefix_key: Optional[str]) -> bool:
+        """Whether an idle slot already holds prefix_key."""
+        return bool(prefix_key) and any(not self.busy[i] and self.prefixes[i] == prefix_key for i in range(self.n_slots))
+
+    def release(self, slot: int):
+        if 0 <= slot < self.n_slots:
+            self.busy[slot] = False
+            self.last_used[slot] = time()
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.n_slots,
+            "busy": sum(self.busy),
+            "prefix_hits": self.hits,
+            "prefix_misses": self.misses,
+        }
+
 class LlamaCppServer:
     """Manages llama.cpp server instance via HTTP API."""
     def __init__(self, binary_path: str, models_dir: str, port: int = 8080):
@@ -39,12 +110,125 @@ class LlamaCppServer:
         self.current_model = None
         self.lock = asyncio.Lock()
         self.base_url = f"http://localhost:{port}"
+        self.client: Optional[httpx.AsyncClient] = None
+        self.state = "stopped"
+        self.state_changed_at = time()
+        self.state_checked_at = time()
+        self.last_health_status: Optional[int] = None
+        self.slots = SlotRouter(1)
+        self.scheduler = RequestScheduler(
+            capacity=1,
+            max_queue=settings.queue_max_size,
+            aging_rate=settings.queue_aging_chars_per_second,
+            max_wait=settings.queue_max_wait
+        )
+        self.n_ctx_slot: Optional[int] = None
+        self.launch_params: Optional[LaunchParams] = None
+        self.active_requests = 0
+        self.last_used = time()
+        self.memory_mb = 0
+        # The slice of the host this server may use (a replica's CPU set); None means the whole host
+        self.hardware: Optional[HardwareProfile] = None
+        self.draft_model: Optional[str] = None
+        self.decode_totals = DecodeTotals()
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    @property
+    def ports(self) -> List[int]:
+        return [self.port]
+
+    @property
+    def vram_mb(self) -> int:
+        return self.launch_params.vram_mb if self.launch_params else 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the long-lived keep-alive client, creating it on first use."""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(
+                    max_connections=settings.http_max_connections,
+                    max_keepalive_connections=settings.http_keepalive_connections,
+                    keepalive_expiry=settings.http_keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(settings.generation_timeout, connect=5.0),
+            )
+        return self.client
+
+    def _set_state(self, state: str):
+        """Record a readiness state observation."""
+        now = time()
+        if state != self.state:
+            logging.info(f"llama.cpp server state: {self.state} -> {state}")
+            self.state = state
+            self.state_changed_at = now
+        self.state_checked_at = now
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def state_age(self) -> float:
+        """Seconds since the cached readiness state was last confirmed."""
+        return time() - self.state_checked_at
+
+    def _invalidate_state(self):
+        """Force the next readiness check to re-probe the server."""
+        self.state_checked_at = 0.0
+
+    async def probe(self) -> str:
+        """Probe /health once and update the cached readiness state."""
+        if not self.process:
+            self._set_state("stopped")
+            return self.state
+        if self.process.returncode is not None:
+            self._set_state("dead")
+            return self.state
+        try:
+            response = await self._get_client().get("/health", timeout=3.0)
+            self.last_health_status = response.status_code
+            if response.status_code == 200:
+                self._set_state("ready")
+            elif response.status_code == 503:
+                self._set_state("loading")
+            else:
+                logging.warning(f"Unexpected health response: {response.status_code}")
+                self._set_state("loading")
+        except (httpx.RequestError, asyncio.TimeoutError) as e:
+            logging.debug(f"Health probe failed: {e}")
+            self.last_health_status = None
+            # Process is alive but not accepting connections yet (or restarting)
+            self._set_state("dead" if self.process.returncode is not None else "loading")
+        return self.state
+
+    async def _monitor_health(self):
+        """Keep the cached readiness state fresh in the background."""
+        try:
+            while self.process:
+                state = await self.probe()
+                if state == "dead":
+                    logging.error(f"llama-server process died with code {self.process.returncode}")
+                    break
+                interval = 1.0 if state == "loading" else settings.health_check_interval
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Health monitor error: {e}")
+
+    def _start_monitor(self):
+        self._stop_monitor()
+        self._monitor_task = asyncio.create_task(self._monitor_health())
+
+    def _stop_monitor(self):
+        if self._monitor_task and not self._monitor_task.done():
+            self._monitor_task.cancel()
+        self._monitor_task = None
         
     async def start_server(self, model_name: str, extra_args: Optional[List[str]] = None):
         """Start llama.cpp server with specified model."""
         logging.debug(f"start_server called with model: {model_name}")
         async with self.lock:
-            if self.process and self.current_model == model_name:
+            if self.process and self.process.returncode is None and self.current_model == model_name:
                 logging.debug(f"Server already running with {model_name}, skipping")
                 return  # Already running with this model
                 
@@ -54,101 +238,114 @@ class LlamaCppServer:
             if not os.path.exists(model_path):
                 raise ValueError(f"Model not found: {model_path}")
             
-            def get_cpu_params():
-                cpu_count = os.cpu_count() or 4
-                parallel = max(1, min(8, cpu_count // 2))
-                threads = min(16, cpu_count)
-                return parallel, threads
-
-            parallel, threads = get_cpu_params()
-            cmd = [
-                self.binary_path,
-                "-m", model_path,
-                "--port", str(self.port),
-                "--host", "0.0.0.0",
-                "-c", str(settings.max_context_tokens),
-                "--parallel", str(parallel),
-                "--threads", str(threads),
-            ]
-            if settings.use_mlock:
-                cmd.append("--mlock")
-            # Try to add GPU support if available
-            try:
-                gpu_available = False
-                gpu_layers = "0"  # Default CPU
-                # Check if NVIDIA GPU is available
+            profile = self.hardware or server_pool.free_profile(await get_hardware_profile(), self)
+            self.draft_model = None
+            draft = model_manager.draft_for(model_name)
+            if draft is not None:
                 try:
-                    result = subprocess.run(["nvidia-smi"], capture_output=True, timeout=3, text=True)
-                    if result.returncode == 0:
-                        gpu_available = True
-                        # Try to determine GPU layers dynamically based on GPU memory
-                        try:
-                            mem_match = re.search(r"(\d+)\s*MiB", result.stdout)
-                            if mem_match:
-                                gpu_mem = int(mem_match.group(1))
-                                # Estimate layers: more memory allows more layers
-                                if gpu_mem >= 24000:
-                                    gpu_layers = str(min(settings.gpu_layers, 60))
-                                elif gpu_mem >= 12000:
-                                    gpu_layers = str(min(settings.gpu_layers, 40))
-                                else:
-                                    gpu_layers = str(min(settings.gpu_layers, 20))
-                            else:
-                                gpu_layers = str(settings.gpu_layers)
-                        except Exception:
-                            gpu_layers = str(settings.gpu_layers)
-                        gpu_params = [
-                            "-ngl", gpu_layers,     # GPU layers
-                            "--main-gpu", "0"       # Use first GPU
-                        ]
-                        cmd.extend(gpu_params)
-                        logging.info(f"GPU detected, using {gpu_layers} layers on GPU")
+                    await self._launch(model_name, model_path, profile, extra_args, draft)
+                    self.draft_model = draft.file
+                    return
                 except Exception as e:
-                    logging.debug(f"GPU check failed: {e}")
-                        
-                if not gpu_available:
-                    logging.info("No GPU detected, using CPU only")
-            except Exception as e:
-                logging.debug(f"GPU detection failed, using CPU: {e}")
+                    # Older llama-server builds lack --model-draft; serve without it rather than not at all
+                    logging.warning(f"llama-server did not start with draft model {draft.file} ({e}), "
+                                    f"running {model_name} without speculative decoding")
+                    model_manager.failed_drafts.add(model_name)
+            await self._launch(model_name, model_path, profile, extra_args, None)
+
+    async def _launch(self, model_name: str, model_path: str, profile: HardwareProfile,
+                      extra_args: Optional[List[str]], draft: Optional[ModelInfo]):
+        """Derive launch parameters (leaving room for ``draft``), then spawn llama-server."""
+        params = self.launch_params = launch_params_for(profile, model_path, draft)
+        parallel = params.parallel
+        self.slots = SlotRouter(parallel)
+        self.scheduler.set_capacity(parallel)
+        cmd = [
+            self.binary_path,
+            "-m", model_path,
+            "--port", str(self.port),
+            "--host", "0.0.0.0",
+            *params.as_args(),
+        ]
+        if settings.use_mlock:
+            cmd.append("--mlock")
+        if settings.enable_advanced_params:
+            cmd.extend(["--ubatch-size", str(min(params.batch_size, 512))])
+        logging.info(f"Launch parameters for {model_name}: {params}")
+
+        if extra_args:
+            cmd.extend(extra_args)
+        if draft is not None:
+            cmd.extend(self._draft_args(draft, params))
+        await self._spawn(model_name, cmd, params)
+
+    def _draft_args(self, draft: ModelInfo, params: LaunchParams) -> List[str]:
+        """llama-server flags for speculative decoding with ``draft`` proposing tokens.
+
+        The draft model goes to the GPU only when the main model is offloaded;
+        on a CPU-only host it runs on the same threads between verification steps.
+        """
+        return [
+            "--model-draft", os.path.join(self.models_dir, draft.file),
+            "--draft-max", str(settings.draft_max),
+            "--draft-min", str(settings.draft_min),
+            "--draft-p-min", str(settings.draft_p_min),
+            "--gpu-layers-draft", str((draft.n_layers or 998) + 1 if params.gpu_layers else 0),
+        ]
+
+    async def _spawn(self, model_name: str, cmd: List[str], params: LaunchParams):
+        """Launch llama-server with ``cmd`` and wait until it serves requests."""
+        logging.info(f"Starting llama.cpp server: {' '.join(cmd)}")
+        
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
             
-            # Advanced parameters (may not be supported by all models)
-            if settings.enable_advanced_params:
-                try:
-                    advanced_params = [
-                        "--batch-size", "256",
-                        "--ubatch-size", "256"
-                    ]
-                    cmd.extend(advanced_params)
-                    logging.info("Added advanced llama.cpp parameters")
-                except Exception as e:
-                    logging.warning(f"Advanced parameters failed: {e}")
+            self.current_model = model_name
+            self._set_state("loading")
+            load_started = time()
+            if self.hardware is not None:
+                # llama-server starts its worker threads later; they inherit the affinity
+                os.sched_setaffinity(self.process.pid, self.hardware.allowed_cpus)
+                logging.info(f"llama-server on port {self.port} pinned to CPUs {format_cpulist(self.hardware.allowed_cpus)}")
             
-            if extra_args:
-                cmd.extend(extra_args)
-                
-            logging.info(f"Starting llama.cpp server: {' '.join(cmd)}")
+            # Log stderr in background to see llama-server errors
+            asyncio.create_task(self._log_stderr())
             
-            try:
-                self.process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                
-                self.current_model = model_name
-                
-                # Log stderr in background to see llama-server errors
-                asyncio.create_task(self._log_stderr())
-                
-                await self._wait_for_server(timeout=settings.request_timeout)
-                
-                logging.info(f"llama.cpp server started with model: {model_name}")
-                
-            except Exception as e:
-                logging.error(f"Failed to start llama.cpp server: {e}")
-                await self._stop_server_internal()
-                raise
+            await self._wait_for_server(timeout=settings.request_timeout)
+            MODEL_LOAD_SECONDS.labels("llama.cpp", model_name).observe(time() - load_started)
+            self.n_ctx_slot = await self._fetch_slot_context(params.ctx_size // params.parallel)
+            self._start_monitor()
+            
+            logging.info(f"llama.cpp server started with model: {model_name}")
+            
+        except Exception as e:
+            logging.error(f"Failed to start llama.cpp server: {e}")
+            await self._stop_server_internal()
+            raise
         
+    async def _fetch_slot_context(self, fallback: int) -> int:
+        """Context size of one slot as reported by /props (the -c value is split across slots)."""
+        try:
+            response = await self._get_client().get("/props", timeout=5.0)
+            response.raise_for_status()
+            n_ctx = response.json().get("default_generation_settings", {}).get("n_ctx")
+            if n_ctx:
+                logging.info(f"llama-server slot context: {n_ctx} tokens")
+                return int(n_ctx)
+        except (httpx.HTTPError, ValueError) as e:
+            logging.debug(f"Could not read /props: {e}")
+        return fallback
+
+    async def tokenize(self, text: str) -> int:
+        """Count tokens of text with the loaded model's tokenizer."""
+        response = await self._get_client().post("/tokenize", json={"content": text, "add_special": True}, timeout=10.0)
+        response.raise_for_status()
+        return len(response.json().get("tokens", []))
+
     async def _log_stderr(self):
         """Log stderr output from llama-server process."""
         if not self.process or not self.process.stderr:
@@ -169,9 +366,11 @@ class LlamaCppServer:
         
     async def _stop_server_internal(self):
         """Internal method to stop server without lock."""
+        self._stop_monitor()
         if self.process:
             try:
-                self.process.terminate()
+                if self.process.returncode is None:
+                    self.process.terminate()
                 await asyncio.wait_for(self.process.wait(), timeout=5.0)
             except asyncio.TimeoutError:
                 logging.warning("Force killing llama.cpp server")
@@ -182,102 +381,93 @@ class LlamaCppServer:
             finally:
                 self.process = None
                 self.current_model = None
+        self._set_state("stopped")
                 
     async def stop_server(self):
         """Stop current llama.cpp server."""
         async with self.lock:
             await self._stop_server_internal()
+
+    async def aclose(self):
+        """Stop the server and release pooled HTTP connections."""
+        await self.stop_server()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
             
     async def _wait_for_server(self, timeout: int = 120):
         """Wait for server to be ready with adaptive polling."""
-        async with httpx.AsyncClient() as client:
-            model_loading_detected = False
-            consecutive_503s = 0
-            
-            # Adaptive polling intervals: start fast, then slow down
-            intervals = [0.5, 0.5, 1, 1, 2, 2, 3, 3, 5, 5]
-            base_interval = 5 
-            
-            attempt = 0
-            total_time = 0
+        model_loading_detected = False
+        consecutive_503s = 0
+        
+        # Adaptive polling intervals: start fast, then slow down
+        intervals = [0.5, 0.5, 1, 1, 2, 2, 3, 3, 5, 5]
+        base_interval = 5 
+        
+        attempt = 0
+        total_time = 0
+        
+        while total_time < timeout:
+            state = await self.probe()
+            if state == "dead":
+                raise RuntimeError(f"llama-server process died with code {self.process.returncode}")
+                
+            if state == "ready":
+                logging.info(f"llama.cpp server is ready (took {total_time}s)")
+                return
             
-            while total_time < timeout:
-                if self.process and self.process.returncode is not None:
-                    raise RuntimeError(f"llama-server process died with code {self.process.returncode}")
-                    
-                try:
-                    response = await client.get(f"{self.base_url}/health", timeout=3.0)
-                    
-                    if response.status_code == 200:
-                        logging.info(f"llama.cpp server is ready (took {total_time}s)")
-                        return
-                        
-                    elif response.status_code == 503:
-                        consecutive_503s += 1
-                        
-                        if not model_loading_detected:
-                            logging.info("llama.cpp server is loading model, please wait...")
-                            model_loading_detected = True
-                        
-                        if consecutive_503s == 5:  # After ~10s of 503s
-                            logging.info("Model loading in progress...")
-                        elif consecutive_503s % 20 == 0:  # Every ~60s after that
-                            logging.info(f"Model still loading... ({total_time}s elapsed)")
-                            
-                    else:
-                        logging.warning(f"Unexpected health response: {response.status_code}")
-                        consecutive_503s = 0
-                        
-                except Exception as e:
-                    # Server not responding yet - this is normal during startup
-                    if attempt == 0:
-                        logging.info("Waiting for llama.cpp server to start...")
-                    elif attempt % 15 == 0:  # Log every ~30s
-                        logging.debug(f"Still waiting for server... ({total_time}s)")
-                        
-                # Calculate next sleep interval
-                if attempt < len(intervals):
-                    sleep_time = intervals[attempt]
-                else:
-                    sleep_time = base_interval
+            if self.last_health_status is None:
+                # Server not responding yet - this is normal during startup
+                if attempt == 0:
+                    logging.info("Waiting for llama.cpp server to start...")
+                elif attempt % 15 == 0:  # Log every ~30s
+                    logging.debug(f"Still waiting for server... ({total_time}s)")
+            else:
+                consecutive_503s += 1
+                
+                if not model_loading_detected:
+                    logging.info("llama.cpp server is loading model, please wait...")
+                    model_loading_detected = True
+                
+                if consecutive_503s == 5:  # After ~10s of 503s
+                    logging.info("Model loading in progress...")
+                elif consecutive_503s % 20 == 0:  # Every ~60s after that
+                    logging.info(f"Model still loading... ({total_time}s elapsed)")
                     
-                await asyncio.sleep(sleep_time)
-                total_time += sleep_time
-                attempt += 1
+            # Calculate next sleep interval
+            if attempt < len(intervals):
+                sleep_time = intervals[attempt]
+            else:
+                sleep_time = base_interval
+                
+            await asyncio.sleep(sleep_time)
+            total_time += sleep_time
+            attempt += 1
                 
         raise TimeoutError(f"llama.cpp server failed to start within {timeout}s")
                 
     async def is_healthy(self) -> bool:
-        """Check if server is healthy."""
-        if not self.process or self.process.returncode is not None:
-            return False
-            
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{self.base_url}/health", timeout=5.0)
-                # Server is healthy if it responds with 200 (ready) or 503 (loading)
-                return response.status_code in [200, 503]
-        except (httpx.RequestError, asyncio.TimeoutError) as e:
-            logging.debug(f"Health check failed: {e}")
-            return False
+        """Check if server is healthy (ready or still loading), using the cached state."""
+        if self.state_age() > settings.health_max_staleness:
+            await self.probe()
+        return self.state in ("ready", "loading")
     
     async def is_ready(self) -> bool:
-        """Check if server is ready (model loaded)."""
-        if not self.process or self.process.returncode is not None:
-            return False
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{self.base_url}/health", timeout=5.0)
-                return response.status_code == 200
-        except (httpx.RequestError, asyncio.TimeoutError) as e:
-            logging.debug(f"Ready check failed: {e}")
-            return False
+        """Check if server is ready (model loaded), using the cached state."""
+        if self.process and self.process.returncode is not None:
+            self._set_state("dead")
+        elif self.state_age() > settings.health_max_staleness:
+            await self.probe()
+        return self.state == "ready"
 
-    async def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.3, timeout: float = 60.0) -> str:
-        """Generate text using llama.cpp server."""
-        if not await self.is_ready():
-            raise RuntimeError("Server not ready - model may still be loading")
-            
+    def _build_payload(self, prompt: str, max_tokens: int, temperature: float, stream: bool = False, slot: int = -1,
+                       schema: Optional[dict] = None) -> dict:
+        """Build a /completion request body.
+
+        With a JSON ``schema`` llama.cpp constrains sampling to the answer object,
+        so the prose stop strings and repetition penalties are dropped: they
+        would cut or distort valid JSON (quotes and keys repeat by design).
+        """
         payload = {
             "prompt": prompt,
             "n_predict": max_tokens,
@@ -299,30 +489,721 @@ class LlamaCppServer:
                 "Explanation:",
                 "Alternative:",
             ],
-            "stream": False
+            "stream": stream,
+            # Reuse the slot's KV cache for the common prompt prefix
+            "cache_prompt": True
         }
+        if schema is not None:
+            payload["json_schema"] = schema
+            payload["stop"] = [stop for stop in payload["stop"] if stop.startswith("<")]  # end-of-turn markers only
+            for penalty in ("repeat_penalty", "repeat_last_n", "frequency_penalty", "presence_penalty"):
+                payload.pop(penalty)
+        if slot >= 0:
+            payload["id_slot"] = slot
+        if stream:
+            # Report token counts on every chunk so they survive an early stop
+            payload["timings_per_token"] = True
+        return payload
 
-        logging.debug(f"Sending request to llama.cpp server: {payload}")
+    async def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.3, timeout: float = 60.0,
+                       prefix_key: Optional[str] = None, stats: Optional[GenerationStats] = None,
+                       schema: Optional[dict] = None) -> str:
+        """Generate text using llama.cpp server.
 
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.post(f"{self.base_url}/completion", json=payload)
-            response.raise_for_status()
-            result = response.json()
-            return result.get("content", "").strip()
+        The completion is streamed and collected: when the caller is cancelled,
+        closing the stream stops llama.cpp decoding, which a dropped plain
+        request does not do on every llama-server version.
+        """
+        chunks = []
+        stream = self.generate_stream(prompt, max_tokens, temperature, timeout, prefix_key, stats, schema)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+        finally:
+            await stream.aclose()
+        return "".join(chunks).strip()
+
+    async def generate_stream(self, prompt: str, max_tokens: int = 512, temperature: float = 0.3, timeout: float = 60.0,
+                              prefix_key: Optional[str] = None, stats: Optional[GenerationStats] = None,
+                              schema: Optional[dict] = None) -> AsyncIterator[str]:
+        """Stream generated text from llama.cpp server token by token.
+
+        Closing the generator early closes the upstream connection, which makes
+        llama.cpp stop decoding for this request.
+        """
+        if not await self.is_ready():
+            raise RuntimeError("Server not ready - model may still be loading")
+
+        slot = self.slots.acquire(prefix_key)
+        payload = self._build_payload(prompt, max_tokens, temperature, stream=True, slot=slot, schema=schema)
+
+        logging.debug(f"Sending streaming request to llama.cpp server (slot {slot}): {payload}")
+
+        try:
+            async with self._get_client().stream("POST", "/completion", json=payload, timeout=timeout) as response:
+                if response.status_code == 503:
+                    self._invalidate_state()
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    chunk = json.loads(line[len("data: "):])
+                    content = chunk.get("content", "")
+                    if stats is not None:
+                        stats.update_from_llama(chunk.get("timings"))
+                        if content:
+                            stats.token()
+                    if content:
+                        yield content
+                    if chunk.get("stop"):
+                        break
+        except httpx.RequestError:
+            self._invalidate_state()
+            raise
+        finally:
+            self.slots.release(slot)
+            if stats is not None:
+                self.decode_totals.add(stats)
+
+class ReplicaSlots:
+    """Slot counters of a replica set, summed over its replicas (each routes its own slots)."""
+    def __init__(self, replicas: List[LlamaCppServer]):
+        self.replicas = replicas
+
+    @property
+    def n_slots(self) -> int:
+        return sum(replica.slots.n_slots for replica in self.replicas)
+
+    def stats(self) -> dict:
+        totals: Dict[str, int] = {}
+        for replica in self.replicas:
+            for name, value in replica.slots.stats().items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+class ReplicaSet:
+    """Several llama-server processes serving the same model, each pinned to its own CPU set and port.
+
+    One llama.cpp process stops scaling at about 16 threads, so on a large CPU
+    host the model runs as ``count`` replicas over disjoint core sets (see
+    hardware.partition_hardware). Each request goes to the ready replica with
+    the fewest requests per slot in flight, preferring one that holds the
+    prompt prefix among equally loaded ones. A replica that exits is
+    restarted with exponential backoff while the others keep serving.
+
+    Stands in for a LlamaCppServer in the ServerPool: requests queue in the
+    set's own scheduler, sized to the slots of all ready replicas.
+    """
+    def __init__(self, binary_path: str, models_dir: str, base_port: int, count: int):
+        self.replicas = [LlamaCppServer(binary_path, models_dir, port=base_port + i) for i in range(count)]
+        self.port = base_port
+        self.current_model: Optional[str] = None
+        self.lock = asyncio.Lock()
+        self.slots = ReplicaSlots(self.replicas)
+        self.scheduler = RequestScheduler(
+            capacity=count,
+            max_queue=settings.queue_max_size,
+            aging_rate=settings.queue_aging_chars_per_second,
+            max_wait=settings.queue_max_wait
+        )
+        self.active_requests = 0
+        self.last_used = time()
+        self.memory_mb = 0
+        self.restarts = [0] * count
+        self._running = False
+        self._keepers: List[asyncio.Task] = []
+
+    @property
+    def ports(self) -> List[int]:
+        return [replica.port for replica in self.replicas]
+
+    @property
+    def base_url(self) -> str:
+        return self.replicas[0].base_url
+
+    @property
+    def process(self):
+        """A running replica's process, if any (for status reporting)."""
+        alive = [replica.process for replica in self.replicas if replica.is_alive()]
+        return alive[0] if alive else self.replicas[0].process
+
+    @property
+    def state(self) -> str:
+        """The best state among the replicas: the set serves while any replica is ready."""
+        states = {replica.state for replica in self.replicas}
+        for state in ("ready", "loading", "dead"):
+            if state in states:
+                return state
+        return "stopped"
+
+    @property
+    def n_ctx_slot(self) -> Optional[int]:
+        sizes = [replica.n_ctx_slot for replica in self.replicas if replica.n_ctx_slot]
+        return min(sizes) if sizes else None
+
+    @property
+    def launch_params(self) -> Optional[LaunchParams]:
+        """Launch parameters of one replica (they differ only if the cores do not divide evenly)."""
+        return next((replica.launch_params for replica in self.replicas if replica.launch_params), None)
+
+    @property
+    def vram_mb(self) -> int:
+        return sum(replica.vram_mb for replica in self.replicas)
+
+    @property
+    def draft_model(self) -> Optional[str]:
+        return next((replica.draft_model for replica in self.replicas if replica.draft_model), None)
+
+    @property
+    def decode_totals(self) -> DecodeTotals:
+        return DecodeTotals.merged([replica.decode_totals for replica in self.replicas])
+
+    def is_alive(self) -> bool:
+        """Whether the set is starting or running: dead replicas are restarted by the set itself."""
+        return self._running
+
+    def state_age(self) -> float:
+        return min(replica.state_age() for replica in self.replicas)
+
+    async def is_ready(self) -> bool:
+        ready = [await replica.is_ready() for replica in self.replicas]
+        self._update_capacity()
+        return any(ready)
+
+    async def is_healthy(self) -> bool:
+        return any([await replica.is_healthy() for replica in self.replicas])
+
+    async def start_server(self, model_name: str, extra_args: Optional[List[str]] = None):
+        """Start every replica with the model; the set is up once at least one of them is."""
+        async with self.lock:
+            if self.current_model == model_name and self.is_alive():
+                return
+            await self._stop_internal()
+            self._running = True
+            profile = server_pool.free_profile(await get_hardware_profile(), self)
+            slices = await asyncio.to_thread(partition_hardware, profile, len(self.replicas))
+            if len(slices) < len(self.replicas):
+                logging.warning(f"Only {len(slices)} CPU sets available, running {len(slices)} replicas")
+                del self.replicas[len(slices):]
+                del self.restarts[len(slices):]
+            for replica, hardware in zip(self.replicas, slices):
+                replica.hardware = hardware
+            results = await asyncio.gather(*(replica.start_server(model_name, extra_args) for replica in self.replicas),
+                                           return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if len(errors) == len(self.replicas):
+                self._running = False
+                raise errors[0]
+            for replica, result in zip(self.replicas, results):
+                if isinstance(result, BaseException):
+                    logging.error(f"llama-server replica on port {replica.port} failed to start: {result}")
+            self.current_model = model_name
+            self._update_capacity()
+            self._keepers = [asyncio.create_task(self._keep_running(index, extra_args))
+                             for index in range(len(self.replicas))]
+            logging.info(f"{len(self.replicas) - len(errors)}/{len(self.replicas)} llama-server replicas "
+                         f"serving {model_name}")
+
+    async def _keep_running(self, index: int, extra_args: Optional[List[str]]):
+        """Restart a replica whenever its process exits, backing off while it keeps crashing."""
+        replica = self.replicas[index]
+        delay = settings.replica_restart_delay
+        started = time()
+        try:
+            while True:
+                process = replica.process
+                if process is not None:
+                    await process.wait()
+                    if replica.process is not process:
+                        continue
+                    # A replica that ran for a while crashed on a request, not at startup
+                    if time() - started > 60:
+                        delay = settings.replica_restart_delay
+                    logging.error(f"llama-server replica on port {replica.port} exited with code "
+                                  f"{process.returncode}, restarting in {delay:.0f}s")
+                replica._set_state("dead")
+                self._update_capacity()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+                try:
+                    await replica.start_server(self.current_model, extra_args)
+                except Exception as e:
+                    logging.error(f"Restarting llama-server replica on port {replica.port} failed: {e}")
+                    continue
+                started = time()
+                self.restarts[index] += 1
+                REPLICA_RESTARTS.labels(self.current_model).inc()
+                self._update_capacity()
+        except asyncio.CancelledError:
+            pass
+
+    def _update_capacity(self):
+        """Size the shared queue to the slots of the replicas that can take requests now."""
+        ready = [replica.slots.n_slots for replica in self.replicas if replica.state == "ready"]
+        self.scheduler.set_capacity(max(1, sum(ready)))
+
+    def pick(self, prefix_key: Optional[str]) -> LlamaCppServer:
+        """The ready replica with the fewest requests per slot, preferring one that holds the prefix."""
+        ready = [replica for replica in self.replicas if replica.state == "ready" and replica.is_alive()]
+        if not ready:
+            raise RuntimeError("Server not ready - model may still be loading")
+        return min(ready, key=lambda replica: (replica.active_requests / replica.slots.n_slots,
+                                               not replica.slots.holds(prefix_key), replica.active_requests))
+
+    async def tokenize(self, text: str) -> int:
+        return await self.pick(None).tokenize(text)
+
+    async def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.3, timeout: float = 60.0,
+                       prefix_key: Optional[str] = None, stats: Optional[GenerationStats] = None,
+                       schema: Optional[dict] = None) -> str:
+        replica = self.pick(prefix_key)
+        replica.active_requests += 1
+        try:
+            return await replica.generate(prompt, max_tokens, temperature, timeout, prefix_key, stats, schema)
+        finally:
+            replica.active_requests -= 1
+
+    async def generate_stream(self, prompt: str, max_tokens: int = 512, temperature: float = 0.3, timeout: float = 60.0,
+                              prefix_key: Optional[str] = None, stats: Optional[GenerationStats] = None,
+                              schema: Optional[dict] = None) -> AsyncIterator[str]:
+        replica = self.pick(prefix_key)
+        replica.active_requests += 1
+        stream = replica.generate_stream(prompt, max_tokens, temperature, timeout, prefix_key, stats, schema)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+            replica.active_requests -= 1
+
+    async def _stop_internal(self):
+        for task in self._keepers:
+            task.cancel()
+        if self._keepers:
+            await asyncio.gather(*self._keepers, return_exceptions=True)
+        self._keepers = []
+        self._running = False
+        await asyncio.gather(*(replica.stop_server() for replica in self.replicas))
+        self.current_model = None
+
+    async def stop_server(self):
+        async with self.lock:
+            await self._stop_internal()
+
+    async def aclose(self):
+        await self.stop_server()
+        for replica in self.replicas:
+            await replica.aclose()
+
+    def replica_status(self) -> List[dict]:
+        return [
+            {
+                "port": replica.port,
+                "state": replica.state,
+                "pid": replica.process.pid if replica.is_alive() else None,
+                "cpus": format_cpulist(replica.hardware.allowed_cpus) if replica.hardware else None,
+                "threads": replica.launch_params.threads if replica.launch_params else None,
+                "draft_model": replica.draft_model,
+                "active_requests": replica.active_requests,
+                "slots": replica.slots.stats(),
+                "restarts": self.restarts[index],
+            }
+            for index, replica in enumerate(self.replicas)
+        ]
+
+class PoolBusyError(RuntimeError):
+    """Raised when a model cannot be loaded because every resident model is busy."""
+
+class ServerPool:
+    """Keeps several llama-server processes resident, one per model on its own port.
+
+    Models are loaded on first use and stay warm, so alternating between them
+    costs nothing once both are loaded. When loading another model would exceed
+    ``max_models`` or the memory budget, the least recently used idle model is
+    stopped first.
+    """
+    def __init__(self, binary_path: str, models_dir: str, base_port: int, max_models: int, memory_budget_mb: int):
+        self.binary_path = binary_path
+        self.models_dir = models_dir
+        self.base_port = base_port
+        self.max_models = max(1, max_models)
+        self.memory_budget_mb = memory_budget_mb or self._default_budget_mb()
+        self.servers: "OrderedDict[str, LlamaCppServer]" = OrderedDict()  # least recently used first
+        # Launches in progress; concurrent callers for the same model await the same one
+        self._starting: Dict[str, asyncio.Task] = {}
+        self.lock = asyncio.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _default_budget_mb() -> int:
+        """75% of physical RAM, or 0 (no memory limit) when it cannot be determined."""
+        try:
+            total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+            return int(total * 0.75 / 2**20)
+        except (ValueError, OSError, AttributeError):
+            return 0
+
+    def estimate_mb(self, model_name: str, replicas: int = 1) -> int:
+        """Resident size of a model: weights, KV cache for the full context and runtime overhead.
+
+        Replicas map the same weights file (the page cache holds it once) but
+        each has its own KV cache and runtime.
+        """
+        info = model_manager.get_model_info(model_name)
+        if info is None:
+            return settings.pool_model_overhead_mb * replicas
+        size_mb, kv_mb = info.size_mb, self._kv_mb(info)
+        # A draft model adds its weights and its own KV cache for the same context
+        draft = model_manager.draft_for(model_name)
+        if draft is not None:
+            size_mb += draft.size_mb
+            kv_mb += self._kv_mb(draft)
+        return int(size_mb + (kv_mb + settings.pool_model_overhead_mb) * replicas)
+
+    @staticmethod
+    def _kv_mb(info: ModelInfo) -> float:
+        if info.kv_bytes_per_token:
+            return info.kv_bytes_per_token * settings.max_context_tokens / 2**20
+        return info.size_mb * 0.1
+
+    def free_profile(self, profile: HardwareProfile, server) -> HardwareProfile:
+        """The host as ``server`` finds it at launch: the probed free memory minus what the other pooled models hold.
+
+        The profile is probed once, before any model is loaded, so without this
+        a second model would be sized for the whole free VRAM and RAM again.
+        """
+        others = [other for other in self.servers.values() if other is not server]
+        vram_mb = sum(other.vram_mb for other in others)
+        ram_mb = sum(max(0, other.memory_mb - other.vram_mb) for other in others)
+        if others:
+            logging.info(f"Sizing launch around {len(others)} resident models: {ram_mb} MB RAM, {vram_mb} MB VRAM in use")
+        return reserve_memory(profile, ram_mb, vram_mb)
+
+    async def replica_count(self) -> int:
+        """llama-server processes per model: ``XPATH_REPLICAS``, or derived from the host when 0."""
+        if settings.replicas > 0:
+            return settings.replicas
+        return suggest_replicas(await get_hardware_profile())
+
+    def get_loaded(self, model_name: Optional[str]) -> Optional[LlamaCppServer]:
+        return self.servers.get(model_name) if model_name else None
+
+    async def get(self, model_name: str) -> LlamaCppServer:
+        """Return a ready server for model_name, loading it (and evicting idle models) if needed.
+
+        A server is added to the pool before its process exists, so a launch in
+        progress is tracked in ``_starting``: concurrent callers wait for it
+        instead of mistaking the new server for a dead one and stopping it.
+        """
+        server = self.servers.get(model_name)
+        starting = self._starting.get(model_name)
+        if starting is None and (server is None or not server.is_alive()):
+            async with self.lock:
+                server = self.servers.get(model_name)
+                starting = self._starting.get(model_name)
+                if starting is None and (server is None or not server.is_alive()):
+                    if server is not None:
+                        logging.warning(f"llama-server for {model_name} is not running, restarting")
+                        del self.servers[model_name]
+                        await server.aclose()
+                    replicas = await self.replica_count()
+                    await self._make_room(model_name, replicas)
+                    if replicas > 1:
+                        server = ReplicaSet(self.binary_path, self.models_dir, self._free_port(replicas), replicas)
+                    else:
+                        server = LlamaCppServer(self.binary_path, self.models_dir, port=self._free_port())
+                    server.memory_mb = self.estimate_mb(model_name, replicas)
+                    self.servers[model_name] = server
+                    self.loads += 1
+                    if self.loads > 1:
+                        MODEL_SWITCHES.labels("llama.cpp").inc()
+                    starting = self._starting[model_name] = asyncio.create_task(self._start(model_name, server))
+        if starting is not None:
+            # Shielded: a caller that gives up does not abort the launch others wait for
+            server = await asyncio.shield(starting)
+        if model_name in self.servers:
+            self.servers.move_to_end(model_name)
+        server.last_used = time()
+        return server
+
+    async def _start(self, model_name: str, server: LlamaCppServer) -> LlamaCppServer:
+        try:
+            await server.start_server(model_name)
+            return server
+        except Exception:
+            if self.servers.get(model_name) is server:
+                del self.servers[model_name]
+            await server.aclose()
+            raise
+        finally:
+            self._starting.pop(model_name, None)
+
+    @asynccontextmanager
+    async def lease(self, model_name: str) -> AsyncIterator[LlamaCppServer]:
+        """Use a model's server; it is not evicted while the lease is held."""
+        server = await self.get(model_name)
+        server.active_requests += 1
+        try:
+            yield server
+        finally:
+            server.active_requests -= 1
+            server.last_used = time()
+
+    async def _make_room(self, model_name: str, replicas: int = 1):
+        needed = self.estimate_mb(model_name, replicas)
+        if self.memory_budget_mb and needed > self.memory_budget_mb:
+            logging.warning(f"Model {model_name} (~{needed} MB) exceeds the pool memory budget "
+                            f"({self.memory_budget_mb} MB), loading it alone")
+
+        def over_budget() -> bool:
+            if len(self.servers) >= self.max_models:
+                return True
+            used = sum(s.memory_mb for s in self.servers.values())
+            return bool(self.memory_budget_mb) and used + needed > self.memory_budget_mb
+
+        while self.servers and over_budget():
+            idle = [name for name, s in self.servers.items()
+                    if s.active_requests == 0 and not s.lock.locked() and name not in self._starting]
+            if not idle:
+                raise PoolBusyError(f"Cannot load {model_name}: all loaded models are busy")
+            victim = idle[0]
+            logging.info(f"Evicting idle model {victim} to load {model_name}")
+            server = self.servers.pop(victim)
+            self.evictions += 1
+            await server.aclose()
+
+    def _free_port(self, count: int = 1) -> int:
+        """First port of ``count`` consecutive ports no loaded server uses."""
+        used = {port for s in self.servers.values() for port in s.ports}
+        port = self.base_port
+        while used.intersection(range(port, port + count)):
+            port += 1
+        return port
+
+    def status(self) -> List[dict]:
+        now = time()
+        return [
+            {
+                "model": name,
+                "port": server.port,
+                "state": server.state,
+                "active_requests": server.active_requests,
+                "idle_seconds": round(now - server.last_used, 1),
+                "memory_mb": server.memory_mb,
+                "slots": server.slots.stats(),
+                "queue": server.scheduler.stats(),
+                "launch_params": asdict(server.launch_params) if server.launch_params else None,
+                "draft_model": server.draft_model,
+                "decode": server.decode_totals.as_dict(),
+                "replicas": server.replica_status() if isinstance(server, ReplicaSet) else None,
+            }
+            for name, server in self.servers.items()
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "loaded": len(self.servers),
+            "max_models": self.max_models,
+            "memory_budget_mb": self.memory_budget_mb,
+            "memory_used_mb": sum(s.memory_mb for s in self.servers.values()),
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+    async def aclose(self):
+        for server in list(self.servers.values()):
+            await server.aclose()
+        self.servers.clear()
+
+class ModelLoad:
+    """Progress of one background model load, from starting llama-server to a warmed KV cache."""
+    def __init__(self, model: str, expected_seconds: float):
+        self.model = model
+        self.phase = "loading"  # loading -> warming -> ready | failed
+        self.started = time()
+        self.finished: Optional[float] = None
+        self.expected_seconds = expected_seconds
+        self.error: Optional[BaseException] = None
+        self.done = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def progress(self) -> float:
+        """Estimated fraction done; llama-server reports no progress while loading."""
+        if self.done.is_set():
+            return 1.0
+        return round(min(0.99, (time() - self.started) / max(self.expected_seconds, 1.0)), 2)
+
+    def eta_seconds(self) -> int:
+        if self.done.is_set():
+            return 0
+        # An overdue load is expected to finish soon, not to have finished already
+        return max(1, int(self.expected_seconds - (time() - self.started)))
+
+    def status(self) -> dict:
+        return {
+            "model": self.model,
+            "phase": self.phase,
+            "progress": self.progress(),
+            "elapsed_seconds": round((self.finished or time()) - self.started, 1),
+            "eta_seconds": self.eta_seconds(),
+            "error": str(self.error) if self.error else None,
+        }
+
+class ModelLoader:
+    """Loads models into the pool in the background, so the API serves while llama-server starts.
+
+    Each load ends with a warm-up that prefills the default template's
+    instruction prefix into every slot. Requests for a loading model wait for
+    it up to ``XPATH_LOAD_WAIT_TIMEOUT`` seconds (see load_model). The expected
+    duration comes from the model's previous load in this process, or from its
+    file size.
+    """
+    LOAD_MB_PER_SECOND = 300
+
+    def __init__(self):
+        self.loads: Dict[str, ModelLoad] = {}
+        self.load_seconds: Dict[str, float] = {}
+
+    def expected_seconds(self, model_name: str) -> float:
+        if model_name in self.load_seconds:
+            return self.load_seconds[model_name]
+        info = model_manager.get_model_info(model_name)
+        return 5.0 + (info.size_mb / self.LOAD_MB_PER_SECOND if info else 0.0)
+
+    def loading(self, model_name: str) -> Optional[ModelLoad]:
+        load = self.loads.get(model_name)
+        return load if load is not None and not load.done.is_set() else None
+
+    def ensure(self, model_name: str) -> Optional[ModelLoad]:
+        """Start loading the model unless it is loaded or loading; None when it is already running."""
+        load = self.loading(model_name)
+        if load is not None:
+            return load
+        server = server_pool.get_loaded(model_name)
+        if server is not None and server.is_alive():
+            return None
+        load = ModelLoad(model_name, self.expected_seconds(model_name))
+        load.task = asyncio.create_task(self._run(load))
+        self.loads[model_name] = load
+        return load
+
+    async def _run(self, load: ModelLoad):
+        try:
+            server = await server_pool.get(load.model)
+            self.load_seconds[load.model] = time() - load.started
+            load.phase = "warming"
+            await warm_up(server)
+            load.phase = "ready"
+            logging.info(f"Model {load.model} ready in {time() - load.started:.1f}s")
+        except Exception as e:
+            logging.error(f"Loading {load.model} failed: {e}")
+            load.phase = "failed"
+            load.error = e
+        finally:
+            load.finished = time()
+            load.done.set()
+
+    def status(self) -> List[dict]:
+        return [load.status() for load in self.loads.values()]
+
+class TokenCounter:
+    """Exact prompt token counts from the model's /tokenize endpoint, cached by content hash.
+
+    Also tracks the observed characters-per-token ratio per model, which sizes
+    DOM windows in tokens instead of assuming 4 characters per token.
+    """
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._ratios: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def chars_per_token(self, model: Optional[str]) -> float:
+        return self._ratios.get(model, 4.0)
+
+    def estimate(self, model: Optional[str], text: str) -> int:
+        return int(len(text) / self.chars_per_token(model)) + 1
+
+    async def count(self, server: Optional[LlamaCppServer], model: str, text: str) -> Optional[int]:
+        """Exact token count of text, or None when the model's server cannot tokenize right now."""
+        key = hashlib.sha1(f"{model}\0{text}".encode("utf-8")).hexdigest()
+        cached = self._counts.get(key)
+        if cached is not None:
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return cached
+        if server is None or server.state != "ready":
+            return None
+        self.misses += 1
+        try:
+            tokens = await server.tokenize(text)
+        except (httpx.HTTPError, ValueError) as e:
+            self.failures += 1
+            logging.debug(f"Tokenize failed, falling back to estimate: {e}")
+            return None
+        self._counts[key] = tokens
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        if tokens and len(text) > 200:
+            ratio = len(text) / tokens
+            previous = self._ratios.get(model)
+            self._ratios[model] = ratio if previous is None else 0.8 * previous + 0.2 * ratio
+        return tokens
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "chars_per_token": {model: round(ratio, 2) for model, ratio in self._ratios.items()},
+        }
 
 class ModelManager:
     """Manages available models and current selection."""
-    def __init__(self, models_dir: str):
+    def __init__(self, models_dir: str, rescan_interval: float = 30.0):
         self.models_dir = models_dir
+        self.catalog = ModelCatalog(models_dir, rescan_interval)
         self.current_model = None
+        # Models whose llama-server failed to start with a draft model
+        self.failed_drafts = set()
         
     def get_available_models(self) -> List[str]:
         """Get list of available GGUF models."""
-        models_path = Path(self.models_dir)
-        if not models_path.exists():
-            return []
-        return [f.name for f in models_path.glob("*.gguf")]
+        return self.catalog.names()
+
+    def get_model_info(self, model_name: str) -> Optional[ModelInfo]:
+        return self.catalog.get(model_name)
         
+    def draft_for(self, model_name: str) -> Optional[ModelInfo]:
+        """Draft model for speculative decoding of model_name, or None to decode without one.
+
+        ``XPATH_DRAFT_MODEL=auto`` pairs the model with the smallest compatible
+        GGUF in the models directory, on GPU hosts only: on a CPU the draft
+        model competes for the same cores and usually slows decoding down. A
+        file name uses that file if it matches the model's architecture and
+        vocabulary; empty (the default) disables drafting.
+        """
+        choice = settings.draft_model.strip()
+        if not choice or choice == model_name or model_name in self.failed_drafts:
+            return None
+        if choice == "auto":
+            if hardware_profile is None or not hardware_profile.has_gpu:
+                return None
+            return self.catalog.find_draft(model_name)
+        draft, target = self.catalog.get(choice), self.catalog.get(model_name)
+        if draft is None or target is None:
+            logging.warning(f"Draft model {choice} not found in {self.models_dir}")
+            return None
+        mismatch = draft_mismatch(target, draft)
+        if mismatch:
+            logging.warning(f"Draft model {choice} cannot draft for {model_name}: {mismatch}")
+            return None
+        return draft
+
     def set_current_model(self, model_name: str):
         """Set current model."""
         available = self.get_available_models()
@@ -341,9 +1222,64 @@ class Settings(BaseSettings):
     generation_timeout: int = 90
     large_input_threshold: int = 20000
     max_context_tokens: int = 32768
-    gpu_layers: int = 35
+    min_slot_context_tokens: int = 8192
+    gpu_layers: int = -1  # -1 = as many as fit into free VRAM
+    threads: Optional[int] = None
+    parallel: Optional[int] = None
+    batch_size: Optional[int] = None
     enable_advanced_params: bool = False
     use_mlock: bool = False
+    health_check_interval: float = 5.0
+    health_max_staleness: float = 15.0
+    http_max_connections: int = 64
+    http_keepalive_connections: int = 16
+    http_keepalive_expiry: float = 60.0
+    stop_after: str = "object"
+    dom_window_tokens: int = 4000
+    dom_compaction: bool = True
+    response_cache_size: int = 512
+    response_cache_ttl: int = 86400
+    response_cache_dir: Optional[str] = None
+    default_template_path: str = str(Path(__file__).with_name("default_template.txt"))
+    templates_dir: str = str(Path(__file__).resolve().parent.parent / "extension" / "prompts")
+    prefix_affinity_chars: int = 2048
+    pool_max_models: int = 2
+    pool_memory_budget_mb: int = 0
+    pool_model_overhead_mb: int = 512
+    queue_max_size: int = 32
+    queue_max_wait: float = 45.0
+    queue_aging_chars_per_second: float = 2000.0
+    batch_max_elements: int = 64
+    catalog_rescan_interval: float = 30.0
+    locator_fast_path: bool = True
+    locator_min_score: int = 60
+    xpath_validation: bool = True
+    repair_max_attempts: int = 1
+    repair_max_tokens: int = 256
+    structured_output: bool = True
+    answer_mode: Literal["full", "xpath_only"] = "full"
+    explanation_max_chars: int = 200
+    upstreams: List[Dict[str, Any]] = []
+    hedge_requests: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_delay: float = 0.5
+    hedge_max_delay: float = 10.0
+    upstream_failure_cooldown: float = 10.0
+    upstream_probe_interval: float = 5.0
+    coalesce_requests: bool = True
+    replicas: int = 1  # llama-server processes per model; 0 = one per 16 physical cores
+    replica_restart_delay: float = 2.0
+    load_wait_timeout: float = 30.0
+    warmup_template: str = "default"  # empty disables the KV cache warm-up
+    request_deadline: float = 0.0  # seconds; 0 = only the client's X-Request-Timeout
+    draft_model: str = ""  # speculative decoding: "auto" (GPU hosts only), a GGUF file name, or empty to disable
+    draft_max: int = 16
+    draft_min: int = 2
+    draft_p_min: float = 0.75
+    dom_store_max_mb: int = 64
+    dom_store_max_entries: int = 256
+    dom_store_ttl: float = 3600.0
+    max_body_mb: int = 32
 
     model_config = SettingsConfigDict(env_prefix="XPATH_", case_sensitive=False)
 
@@ -361,27 +1297,164 @@ def _log_effective_settings():
         "generation_timeout": settings.generation_timeout,
         "large_input_threshold": settings.large_input_threshold,
         "max_context_tokens": settings.max_context_tokens,
+        "min_slot_context_tokens": settings.min_slot_context_tokens,
         "gpu_layers": settings.gpu_layers,
+        "threads": settings.threads,
+        "parallel": settings.parallel,
+        "batch_size": settings.batch_size,
         "enable_advanced_params": settings.enable_advanced_params,
         "use_mlock": settings.use_mlock,
+        "health_check_interval": settings.health_check_interval,
+        "health_max_staleness": settings.health_max_staleness,
+        "http_max_connections": settings.http_max_connections,
+        "http_keepalive_connections": settings.http_keepalive_connections,
+        "http_keepalive_expiry": settings.http_keepalive_expiry,
+        "stop_after": settings.stop_after,
+        "dom_window_tokens": settings.dom_window_tokens,
+        "dom_compaction": settings.dom_compaction,
+        "response_cache_size": settings.response_cache_size,
+        "response_cache_ttl": settings.response_cache_ttl,
+        "response_cache_dir": settings.response_cache_dir,
+        "default_template_path": settings.default_template_path,
+        "templates_dir": settings.templates_dir,
+        "prefix_affinity_chars": settings.prefix_affinity_chars,
+        "pool_max_models": settings.pool_max_models,
+        "pool_memory_budget_mb": settings.pool_memory_budget_mb,
+        "pool_model_overhead_mb": settings.pool_model_overhead_mb,
+        "queue_max_size": settings.queue_max_size,
+        "queue_max_wait": settings.queue_max_wait,
+        "queue_aging_chars_per_second": settings.queue_aging_chars_per_second,
+        "batch_max_elements": settings.batch_max_elements,
+        "catalog_rescan_interval": settings.catalog_rescan_interval,
+        "locator_fast_path": settings.locator_fast_path,
+        "locator_min_score": settings.locator_min_score,
+        "xpath_validation": settings.xpath_validation,
+        "repair_max_attempts": settings.repair_max_attempts,
+        "repair_max_tokens": settings.repair_max_tokens,
+        "structured_output": settings.structured_output,
+        "answer_mode": settings.answer_mode,
+        "explanation_max_chars": settings.explanation_max_chars,
+        # API keys stay out of the log
+        "upstreams": [{k: v for k, v in spec.items() if k != "api_key"} for spec in settings.upstreams],
+        "hedge_requests": settings.hedge_requests,
+        "hedge_quantile": settings.hedge_quantile,
+        "hedge_min_delay": settings.hedge_min_delay,
+        "hedge_max_delay": settings.hedge_max_delay,
+        "upstream_failure_cooldown": settings.upstream_failure_cooldown,
+        "upstream_probe_interval": settings.upstream_probe_interval,
+        "coalesce_requests": settings.coalesce_requests,
+        "replicas": settings.replicas,
+        "replica_restart_delay": settings.replica_restart_delay,
+        "load_wait_timeout": settings.load_wait_timeout,
+        "warmup_template": settings.warmup_template,
+        "request_deadline": settings.request_deadline,
+        "draft_model": settings.draft_model,
+        "draft_max": settings.draft_max,
+        "draft_min": settings.draft_min,
+        "draft_p_min": settings.draft_p_min,
+        "dom_store_max_mb": settings.dom_store_max_mb,
+        "dom_store_max_entries": settings.dom_store_max_entries,
+        "dom_store_ttl": settings.dom_store_ttl,
+        "max_body_mb": settings.max_body_mb,
     }
     logging.info(f"Effective settings: {json.dumps(safe)}")
 
 # Initialize managers
-model_manager = ModelManager(settings.models_dir)
-llama_server = LlamaCppServer(
+model_manager = ModelManager(settings.models_dir, settings.catalog_rescan_interval)
+server_pool = ServerPool(
     binary_path=settings.llamacpp_binary,
     models_dir=settings.models_dir,
-    port=settings.llamacpp_port
+    base_port=settings.llamacpp_port,
+    max_models=settings.pool_max_models,
+    memory_budget_mb=settings.pool_memory_budget_mb
+)
+
+template_registry = TemplateRegistry(settings.default_template_path, settings.templates_dir)
+
+model_loader = ModelLoader()
+
+token_counter = TokenCounter()
+
+response_cache = ResponseCache(
+    max_entries=settings.response_cache_size,
+    ttl=settings.response_cache_ttl,
+    persist_dir=settings.response_cache_dir
 )
 
+hardware_profile: Optional[HardwareProfile] = None
+in_flight = SingleFlight()
+
+dom_store = DomStore(
+    max_bytes=settings.dom_store_max_mb * 1024 * 1024,
+    max_entries=settings.dom_store_max_entries,
+    ttl=settings.dom_store_ttl
+)
+
+_hardware_lock = asyncio.Lock()
+
+background_tasks: List[asyncio.Task] = []
+
+async def get_hardware_profile() -> HardwareProfile:
+    """Hardware profile probed once per process (off the event loop) and cached."""
+    global hardware_profile
+    async with _hardware_lock:
+        if hardware_profile is None:
+            hardware_profile = await asyncio.to_thread(probe_hardware)
+    return hardware_profile
+
+def draft_memory_mb(draft: ModelInfo) -> int:
+    """Weights plus KV cache of a draft model, which llama-server sizes to the main model's context."""
+    return int(draft.size_mb + ServerPool._kv_mb(draft))
+
+def launch_params_for(profile: HardwareProfile, model_path: str, draft: Optional[ModelInfo] = None) -> LaunchParams:
+    """Derived llama-server parameters for a model, with explicit settings taking precedence.
+
+    With a draft model its memory is set aside first: in VRAM on a GPU host
+    (it is offloaded along with the main model), in RAM otherwise.
+    """
+    draft_mb = draft_memory_mb(draft) if draft is not None else 0
+    if draft_mb:
+        profile = reserve_memory(profile, 0, draft_mb) if profile.has_gpu else reserve_memory(profile, draft_mb, 0)
+    info = model_manager.get_model_info(os.path.basename(model_path))
+    size_mb = info.size_mb if info else int(os.path.getsize(model_path) / 2**20)
+    min_slot_context = settings.min_slot_context_tokens
+    if info and info.context_length:
+        # Slots larger than the training context only waste KV cache
+        min_slot_context = min(min_slot_context, info.context_length)
+    params = derive_launch_params(profile, size_mb, info.n_layers if info else None,
+                                  settings.max_context_tokens, min_slot_context,
+                                  info.kv_bytes_per_token if info else None)
+    if settings.threads:
+        params.threads = settings.threads
+    if settings.parallel:
+        params.parallel = settings.parallel
+        params.ctx_size = min(settings.max_context_tokens, min_slot_context * settings.parallel)
+    if settings.batch_size:
+        params.batch_size = settings.batch_size
+    if settings.gpu_layers >= 0:
+        params.gpu_layers = settings.gpu_layers if profile.has_gpu else 0
+    params.vram_mb = estimate_vram_mb(params, size_mb, info.n_layers if info else None,
+                                      info.kv_bytes_per_token if info else None)
+    if draft_mb and params.gpu_layers:
+        params.vram_mb += draft_mb
+    return params
+
 class AIMessage(BaseModel):
     role: str
     content: str
 
+class ElementAttribute(BaseModel):
+    name: str
+    value: str = ""
+
+class ElementInfo(BaseModel):
+    html: str = ""
+    tag: Optional[str] = None
+    attributes: List[ElementAttribute] = []
+
 class AIRequest(BaseModel):
     model: str = "default"
-    messages: List[AIMessage]
+    messages: List[AIMessage] = []
     stream: bool = False
     max_tokens: int = 512
     temperature: float = 0.7
@@ -391,88 +1464,615 @@ class AIRequest(BaseModel):
     n: int = 1
     response_format: dict = {"type": "text"}
     stop: List[str] = ["null"]
+    stop_after: Optional[Literal["object", "primary_xpath", "none"]] = None
+    dom: Optional[str] = None
+    dom_hash: Optional[str] = None
+    element: Optional[ElementInfo] = None
+    dom_window_tokens: Optional[int] = None
+    cache: bool = True
+    template_id: Optional[str] = None
+    fast_path: Optional[bool] = None
+    validate_xpath: Optional[bool] = None
+    structured: Optional[bool] = None
+    answer_mode: Optional[Literal["full", "xpath_only"]] = None
 
     @model_validator(mode="after") 
     def validate_fields(self):
-        if not self.messages:
+        if not self.messages and not self.template_id:
             raise ValueError('Field "messages" must contain at least one message')
         return self
 
+class BatchRequest(BaseModel):
+    model: str = "default"
+    dom: Optional[str] = None
+    dom_hash: Optional[str] = None
+    elements: List[ElementInfo]
+    template_id: Optional[str] = None
+    template: Optional[str] = None
+    stream: bool = True
+    max_tokens: int = 512
+    temperature: float = 0.7
+    stop_after: Optional[Literal["object", "primary_xpath", "none"]] = None
+    dom_window_tokens: Optional[int] = None
+    cache: bool = True
+    fast_path: Optional[bool] = None
+    structured: Optional[bool] = None
+    answer_mode: Optional[Literal["full", "xpath_only"]] = None
+
+    @model_validator(mode="after")
+    def validate_fields(self):
+        if not self.elements:
+            raise ValueError('Field "elements" must contain at least one element')
+        if not self.dom and not self.dom_hash:
+            raise ValueError('Either "dom" or "dom_hash" is required')
+        if self.template and "{element}" not in self.template:
+            raise ValueError('Field "template" must contain an {element} placeholder')
+        return self
+
+class DomUpload(BaseModel):
+    dom: str
+
 class ModelRequest(BaseModel):
     model: str
 
 class ModelResponse(BaseModel):
     current_model: Optional[str]
     available_models: List[str]
+    loaded_models: List[dict] = []
+    pool: dict = {}
+    models: List[dict] = []
 
 app = FastAPI(title="XPathAI Backend", description="AI-powered XPath generation with llama.cpp")
 
+# Middlewares added later wrap earlier ones: errors from the inner ones get CORS headers
+app.add_middleware(DecompressionMiddleware, max_bytes=settings.max_body_mb * 1024 * 1024)
+app.add_middleware(CancellationMiddleware, default_timeout=settings.request_deadline)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=False,
-    allow_methods=["POST", "GET", "PUT"],
+    allow_methods=["POST", "GET", "PUT", "DELETE"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, backend="llama.cpp")
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize with default model on startup."""
+    """Select the default model and start loading it; the API serves (and reports progress) meanwhile."""
     try:
         _log_effective_settings()
+        template_registry.load()
+        await get_hardware_profile()
+        await asyncio.to_thread(model_manager.catalog.refresh, True)
+        background_tasks.append(asyncio.create_task(model_manager.catalog.watch()))
         available_models = model_manager.get_available_models()
         if available_models:
             default_model = settings.default_model if settings.default_model in available_models else available_models[0]
             model_manager.set_current_model(default_model)
-            await llama_server.start_server(default_model)
-            logging.info(f"Started with model: {default_model}")
+            model_loader.ensure(default_model)
+            logging.info(f"Loading model in the background: {default_model}")
         else:
             logging.warning("No models found in models directory")
     except Exception as e:
         logging.error(f"Startup error: {e}")
+    if provider_router is not None:
+        provider_router.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown."""
-    await llama_server.stop_server()
+    for task in background_tasks:
+        task.cancel()
+    if provider_router is not None:
+        await provider_router.aclose()
+    await server_pool.aclose()
+
+def _prefix_key(prompt: str) -> str:
+    """Affinity key for prompts that were not built from a compiled template."""
+    return hashlib.sha1(prompt[:settings.prefix_affinity_chars].encode("utf-8")).hexdigest()
+
+def _shared_prefix_key(shared: str) -> str:
+    """Affinity key for a batch's shared prompt prefix (template plus DOM)."""
+    return hashlib.sha1(shared.encode("utf-8")).hexdigest()
+
+def element_spec(element: ElementInfo) -> ElementSpec:
+    return parse_element(element.html, element.tag, {attr.name: attr.value for attr in element.attributes})
+
+def find_fast_locators(dom: str, elements: List[ElementInfo],
+                       stored: Optional[StoredDom] = None) -> Tuple[Dict[int, LocatorResult], List[LocatorResult]]:
+    """Try the deterministic locator engine; returns the elements it can answer without the model."""
+    started = time()
+    specs = [element_spec(element) for element in elements]
+    if stored is None:
+        results = locate(dom, specs)
+    else:
+        with stored.lock:
+            results = locate(dom, specs, root=stored.page())
+    answers = robust_answers(results, settings.locator_min_score)
+    for index, result in enumerate(results):
+        outcome = "hit" if index in answers else ("miss" if result.target_found else "not_found")
+        LOCATOR_FAST_PATH.labels(outcome).inc()
+    logging.info(f"Locator fast path: {len(answers)}/{len(elements)} elements answered "
+                 f"in {(time() - started) * 1000:.1f}ms")
+    return answers, results
+
+def response_schema(structured: Optional[bool], answer_mode: Optional[str]) -> Optional[dict]:
+    """JSON schema that constrains the model's answer, or None when structured output is off."""
+    if not (structured if structured is not None else settings.structured_output):
+        return None
+    return answer_schema(answer_mode or settings.answer_mode, settings.explanation_max_chars)
+
+def answer_checker(dom: str, element: Optional[ElementInfo], stored: Optional[StoredDom] = None) -> Optional[DomChecker]:
+    """Parse the submitted DOM (or reuse the stored tree) for checking model answers against it."""
+    spec = element_spec(element) if element else None
+    if stored is None:
+        return make_checker(dom, spec)
+    with stored.lock:
+        root = stored.page()
+    return make_checker(dom, spec, root, stored.lock)
+
+def resolve_dom(data) -> Optional[StoredDom]:
+    """Put an inline DOM into the DOM store, or load the one ``dom_hash`` refers to into ``data.dom``."""
+    if data.dom:
+        return dom_store.put(data.dom)
+    if data.dom_hash:
+        stored = dom_store.get(data.dom_hash)
+        if stored is None:
+            raise HTTPException(status_code=404, detail=f"Unknown dom_hash {data.dom_hash}, upload the DOM again")
+        data.dom = stored.dom
+        return stored
+    return None
+
+async def validate_and_repair(checker: DomChecker, prompt: str, response: str, model: Optional[str], *,
+                              temperature: float, prefix_key: Optional[str],
+                              schema: Optional[dict] = None) -> Tuple[str, AnswerValidation, int]:
+    """Check the answer's XPaths against the DOM and re-ask the model when they are invalid or ambiguous.
 
-async def call_llama(prompt: str, model: Optional[str] = None, *, max_tokens: Optional[int] = None, temperature: Optional[float] = None) -> str:
-    """Generate text using llama.cpp server."""
+    The repair prompt appends the rejected answer and its specific failure to
+    the original prompt and is capped at ``repair_max_tokens``. A repaired
+    answer replaces the original only when it checks out better. Returns the
+    answer, its validation and the number of repair attempts.
+    """
+    validation = await asyncio.to_thread(checker.check, response)
+    XPATH_VALIDATION.labels("first", validation.result).inc()
+    attempts = 0
+    while validation.repairable and attempts < settings.repair_max_attempts:
+        attempts += 1
+        logging.info(f"Repairing answer (attempt {attempts}): {validation.failure()}")
+        try:
+            repaired = await call_llama(repair_prompt(prompt, response, validation), model,
+                                        max_tokens=settings.repair_max_tokens, temperature=temperature,
+                                        stop_after="object", prefix_key=prefix_key, schema=schema)
+        except HTTPException as e:
+            logging.warning(f"Repair failed, keeping the original answer: {e.detail}")
+            break
+        repaired_validation = await asyncio.to_thread(checker.check, repaired)
+        XPATH_VALIDATION.labels("repair", repaired_validation.result).inc()
+        if repaired_validation.rank() < validation.rank():
+            response, validation = repaired, repaired_validation
+    return response, validation, attempts
+
+def prepare_prompt(data: AIRequest, prompt: str, budget_tokens: Optional[int] = None,
+                   chars_per_token: float = 4.0, stored: Optional[StoredDom] = None) -> Tuple[str, Optional[DomWindow], str]:
+    """Window the submitted DOM around the target element and build the final prompt.
+
+    Returns the prompt, the DOM window (if any) and the key of its static prefix
+    used for slot affinity. A named server-side template (``template_id``) takes
+    precedence; otherwise the user message is used as a template when it contains
+    placeholders; if it already embeds the full DOM, the DOM is swapped for the
+    window; otherwise the default template is used. The window budget is given in
+    tokens and converted with the model's observed chars-per-token ratio.
+    """
+    template = None
+    if data.template_id:
+        template = template_registry.get(data.template_id)
+    elif "{dom}" in prompt or "{element}" in prompt:
+        template = CompiledTemplate("request", prompt)
+
+    if not data.dom or not data.element:
+        if data.template_id:
+            raise ValueError("Requests with template_id must include dom and element")
+        return prompt, None, _prefix_key(prompt)
+
+    budget_tokens = budget_tokens or data.dom_window_tokens or settings.dom_window_tokens
+    attributes = {attr.name: attr.value for attr in data.element.attributes}
     try:
-        # Switch model if requested
-        if model and model != llama_server.current_model:
-            logging.debug(f"Model switch requested: {llama_server.current_model} -> {model}")
-            await llama_server.start_server(model)
-            model_manager.set_current_model(model)
-        
-        response = await llama_server.generate(
-            prompt=prompt,
-            max_tokens=max_tokens or settings.max_tokens,
-            temperature=temperature if temperature is not None else settings.temperature,
-            timeout=settings.generation_timeout
+        window = window_dom(
+            data.dom,
+            data.element.html,
+            tag=data.element.tag,
+            attributes=attributes,
+            budget_chars=int(budget_tokens * chars_per_token),
+            compact=settings.dom_compaction,
+            parse=stored.cleaned_copy if stored else parse_dom,
         )
+    except Exception as e:
+        logging.warning(f"DOM windowing failed, using full DOM: {e}")
+        window = DomWindow(html=data.dom, target_found=False, original_chars=len(data.dom), window_chars=len(data.dom))
+    logging.info(f"DOM window: {window.original_chars} -> {window.window_chars} chars "
+                f"(target found: {window.target_found})")
+    if window.compaction:
+        logging.info(f"DOM compaction: ~{window.compaction.tokens_before} -> ~{window.compaction.tokens_after} tokens, "
+                    f"{window.compaction.collapsed_nodes} repeated siblings collapsed")
+
+    if template is None:
+        if data.dom in prompt:
+            prompt = prompt.replace(data.dom, window.html, 1)
+            return prompt, window, _prefix_key(prompt)
+        template = template_registry.get("default")
+    return template.render(data.element.html, window.html), window, template.prefix_key
+
+def prepare_batch_prompts(data: BatchRequest, chars_per_token: float = 4.0,
+                          elements: Optional[List[ElementInfo]] = None,
+                          stored: Optional[StoredDom] = None) -> Tuple[str, List[str], DomWindow, List[Optional[bool]]]:
+    """Window the DOM around the given elements (default: all requested) and build one prompt per element.
+
+    Every prompt starts with the same shared text (template instructions plus
+    the DOM window); only the element line differs. Returns the shared text,
+    the per-element prompts, the window and per-element "found" flags.
+    """
+    elements = data.elements if elements is None else elements
+    if data.template_id:
+        template = template_registry.get(data.template_id)
+    elif data.template:
+        template = CompiledTemplate("request", data.template)
+    else:
+        template = template_registry.get("default")
+
+    specs = [element_spec(element) for element in elements]
+    budget_tokens = data.dom_window_tokens or settings.dom_window_tokens
+    try:
+        window, found = window_dom_many(data.dom, specs, budget_chars=int(budget_tokens * chars_per_token),
+                                        compact=settings.dom_compaction,
+                                        parse=stored.cleaned_copy if stored else parse_dom)
+    except Exception as e:
+        logging.warning(f"DOM windowing failed, using full DOM: {e}")
+        window = DomWindow(html=data.dom, target_found=False, original_chars=len(data.dom), window_chars=len(data.dom))
+        found = [None] * len(specs)
+    logging.info(f"Batch DOM window: {window.original_chars} -> {window.window_chars} chars "
+                f"for {len(specs)} elements ({sum(1 for f in found if f is False)} not found)")
+
+    shared, element_tail = template.split_shared(window.html)
+    prompts = [shared + element_tail.replace("{element}", element.html) for element in elements]
+    return shared, prompts, window, found
+
+def _queue_error(e: QueueFullError) -> HTTPException:
+    """429 when the queue is full, 503 when a queued request waited too long; both with Retry-After."""
+    logging.warning(str(e))
+    status_code = 503 if isinstance(e, QueueTimeoutError) else 429
+    return HTTPException(status_code=status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def check_admission(model: Optional[str]):
+    """Shed a request early when its model's queue is already full."""
+    server = server_pool.get_loaded(resolve_model(model))
+    if server is not None:
+        try:
+            server.scheduler.check_admission()
+        except QueueFullError as e:
+            raise _queue_error(e)
+
+def context_budget(server: Optional[LlamaCppServer], max_tokens: int) -> int:
+    """Prompt tokens that fit one slot's context while leaving room for the answer."""
+    n_ctx = server.n_ctx_slot if server and server.n_ctx_slot else settings.max_context_tokens
+    return max(0, n_ctx - max_tokens)
+
+async def count_prompt_tokens(server: Optional[LlamaCppServer], model_name: str, prompt: str) -> Tuple[int, bool]:
+    """Return (token count, exact): exact via /tokenize, else the ratio-based estimate."""
+    tokens = await token_counter.count(server, model_name, prompt)
+    if tokens is None:
+        return token_counter.estimate(model_name, prompt), False
+    return tokens, True
+
+def _loading_error(load: ModelLoad) -> HTTPException:
+    """503 for a model that is still loading, with its progress and when to retry."""
+    return HTTPException(
+        status_code=503,
+        detail={"message": f"Model {load.model} is loading, try again later", **load.status()},
+        headers={"Retry-After": str(load.eta_seconds())}
+    )
+
+async def load_model(model_name: str) -> LlamaCppServer:
+    """Get the model's server from the pool, mapping failures to HTTP errors.
+
+    A model that is not running is loaded in the background; the request waits
+    for it up to ``XPATH_LOAD_WAIT_TIMEOUT`` seconds and then gets a 503 with
+    the load's progress.
+    """
+    if not os.path.exists(os.path.join(settings.models_dir, model_name)):
+        raise HTTPException(status_code=400, detail=f"Model not found: {model_name}")
+    load = model_loader.ensure(model_name)
+    try:
+        if load is not None:
+            try:
+                await asyncio.wait_for(load.done.wait(), timeout=settings.load_wait_timeout)
+            except asyncio.TimeoutError:
+                raise _loading_error(load)
+            if load.error is not None:
+                raise load.error
+        return await server_pool.get(model_name)
+    except HTTPException:
+        raise
+    except PoolBusyError as e:
+        logging.warning(str(e))
+        raise HTTPException(status_code=503, detail="All loaded models are busy, try again later")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"llama.cpp error: {str(e)}")
+        raise HTTPException(status_code=502, detail="Error calling local LLM")
+
+async def warm_up(server: LlamaCppServer):
+    """Prefill the warm-up template's instruction prefix into every slot's KV cache.
+
+    One single-token generation per slot, sent together so each takes a
+    different slot; the slot router then sends requests with that template to
+    slots that already hold its prefix. Failures only cost the first requests
+    their prefix reuse.
+    """
+    if not settings.warmup_template:
+        return
+    try:
+        template = template_registry.get(settings.warmup_template)
+    except ValueError as e:
+        logging.warning(f"Skipping warm-up: {e}")
+        return
+    started = time()
+    results = await asyncio.gather(*(
+        server.generate(template.prefix, max_tokens=1, temperature=0.0, timeout=settings.generation_timeout,
+                        prefix_key=template.prefix_key)
+        for _ in range(server.slots.n_slots)
+    ), return_exceptions=True)
+    failed = [result for result in results if isinstance(result, BaseException)]
+    if failed:
+        logging.warning(f"Warm-up failed on {len(failed)}/{len(results)} slots: {failed[0]}")
+    logging.info(f"Warmed {len(results) - len(failed)} slots with template {template.name} "
+                 f"({len(template.prefix)} chars) in {time() - started:.2f}s")
+
+def resolve_model(model: Optional[str]) -> str:
+    """Map a requested model name to a GGUF file; "default" means the selected model."""
+    if not model or model == "default":
+        return model_manager.current_model or settings.default_model
+    return model
+
+async def call_llama(prompt: str, model: Optional[str] = None, *, max_tokens: Optional[int] = None, temperature: Optional[float] = None,
+                     stop_after: Optional[str] = None, prefix_key: Optional[str] = None,
+                     stats: Optional[GenerationStats] = None, schema: Optional[dict] = None) -> str:
+    """Generate text, sharing one generation among concurrent identical calls.
+
+    Calls with the same model, prompt and parameters that overlap in time get
+    the result of a single generation, so a double click or several users on
+    the same page take one llama.cpp slot instead of many. Every caller's
+    ``stats`` receive that generation's numbers.
+    """
+    stats = stats if stats is not None else GenerationStats()
+    kwargs = dict(max_tokens=max_tokens, temperature=temperature, stop_after=stop_after, prefix_key=prefix_key, schema=schema)
+    if not settings.coalesce_requests:
+        with count_cancelled("llama.cpp"):
+            return await _generate(prompt, model, stats=stats, **kwargs)
+    key = ResponseCache.make_key(resolve_model(model), prompt, {
+        "max_tokens": max_tokens, "temperature": temperature, "stop_after": stop_after, "schema": schema})
+
+    async def work() -> Tuple[str, GenerationStats]:
+        # Cancelled only when every caller waiting for it has left
+        own = GenerationStats(prompt_tokens=stats.prompt_tokens)
+        with count_cancelled("llama.cpp"):
+            return await _generate(prompt, model, stats=own, **kwargs), own
+
+    (response, shared_stats), shared = await in_flight.run(key, work)
+    vars(stats).update(vars(shared_stats))
+    if shared:
+        COALESCED_REQUESTS.labels("llama.cpp").inc()
+        logging.info("Identical request already in flight, reused its answer")
+    return response
+
+async def _generate(prompt: str, model: Optional[str] = None, *, max_tokens: Optional[int] = None, temperature: Optional[float] = None,
+                    stop_after: Optional[str] = None, prefix_key: Optional[str] = None,
+                    stats: Optional[GenerationStats] = None, schema: Optional[dict] = None) -> str:
+    """Generate text using llama.cpp server.
+
+    With ``stop_after`` the completion is streamed from llama.cpp and cut off as
+    soon as the JSON answer is complete; with ``schema`` decoding is constrained
+    to it. Token counts and phase timings are recorded into ``stats`` and
+    exported as metrics. With upstreams configured the request goes through
+    the provider router and may be answered by another backend.
+    """
+    stats = stats if stats is not None else GenerationStats()
+    if provider_router is None:
+        model_name = resolve_model(model)
+        response = await _call_local(prompt, model_name, max_tokens=max_tokens, temperature=temperature,
+                                     stop_after=stop_after, prefix_key=prefix_key, stats=stats, schema=schema)
+        stats.observe("llama.cpp", model_name)
         return response
+    request = generation_request(prompt, model, max_tokens=max_tokens, temperature=temperature, stop_after=stop_after,
+                                 prefix_key=prefix_key, schema=schema, prompt_tokens=stats.prompt_tokens)
+    try:
+        response, provider, attempt_stats = await provider_router.complete(request)
+    except ProviderError as e:
+        logging.error(str(e))
+        raise HTTPException(status_code=502, detail="Error calling LLM backends")
+    # The caller reads usage and timings from the stats object it passed in
+    vars(stats).update(vars(attempt_stats))
+    stats.observe(provider.kind, provider.model or resolve_model(model))
+    if stop_after and stop_after != "none":
+        # Remote backends do not stop at the end of the JSON answer by themselves
+        tracker = JsonCompletionTracker(stop_after)
+        tracker.feed(response)
+        response = tracker.text()
+    return response
+
+async def _call_local(prompt: str, model_name: str, *, max_tokens: Optional[int], temperature: Optional[float],
+                      stop_after: Optional[str], prefix_key: Optional[str], stats: GenerationStats,
+                      schema: Optional[dict]) -> str:
+    """Generate with this backend's own llama-server pool, mapping failures to HTTP errors."""
+    try:
+        async with server_pool.lease(model_name) as server, server.scheduler.slot(len(prompt)) as waited:
+            if waited > 1:
+                logging.info(f"Request waited {waited:.2f}s in queue")
+            stats.queue_seconds = waited
+            stats.start()
+            if stop_after and stop_after != "none":
+                tracker = JsonCompletionTracker(stop_after)
+                async for _ in stream_llama(server, prompt, max_tokens=max_tokens, temperature=temperature,
+                                            tracker=tracker, prefix_key=prefix_key, stats=stats, schema=schema):
+                    pass
+                response = tracker.text()
+            else:
+                response = await server.generate(
+                    prompt=prompt,
+                    max_tokens=max_tokens or settings.max_tokens,
+                    temperature=temperature if temperature is not None else settings.temperature,
+                    timeout=settings.generation_timeout,
+                    prefix_key=prefix_key,
+                    stats=stats,
+                    schema=schema
+                )
+            stats.finish()
+        return response
+    except QueueFullError as e:
+        raise _queue_error(e)
+    except PoolBusyError as e:
+        logging.warning(str(e))
+        raise HTTPException(status_code=503, detail="All loaded models are busy, try again later")
     except Exception as e:
         logging.error(f"llama.cpp error: {str(e)}")
         raise HTTPException(status_code=502, detail="Error calling local LLM")
 
+async def stream_llama(server: LlamaCppServer, prompt: str, *, max_tokens: Optional[int] = None,
+                       temperature: Optional[float] = None, tracker: JsonCompletionTracker,
+                       prefix_key: Optional[str] = None, stats: Optional[GenerationStats] = None,
+                       schema: Optional[dict] = None) -> AsyncIterator[str]:
+    """Stream answer chunks from llama.cpp until the tracker reports the answer complete."""
+    stream = server.generate_stream(
+        prompt=prompt,
+        max_tokens=max_tokens or settings.max_tokens,
+        temperature=temperature if temperature is not None else settings.temperature,
+        timeout=settings.generation_timeout,
+        prefix_key=prefix_key,
+        stats=stats,
+        schema=schema
+    )
+    try:
+        async for chunk in stream:
+            kept = tracker.feed(chunk)
+            if kept:
+                yield kept
+            if tracker.done:
+                logging.debug("JSON answer complete, stopping generation early")
+                break
+    finally:
+        await stream.aclose()
+
+def generation_request(prompt: str, model: Optional[str], *, max_tokens: Optional[int], temperature: Optional[float],
+                       stop_after: Optional[str], prefix_key: Optional[str], schema: Optional[dict],
+                       prompt_tokens: Optional[int]) -> GenerationRequest:
+    return GenerationRequest(
+        prompt=prompt,
+        max_tokens=max_tokens or settings.max_tokens,
+        temperature=temperature if temperature is not None else settings.temperature,
+        schema=schema,
+        model=model,
+        prefix_key=prefix_key,
+        stop_after=stop_after,
+        prompt_tokens=prompt_tokens,
+    )
+
+class LocalProvider(Provider):
+    """This backend's llama-server pool as one of the router's providers.
+
+    It is unavailable while the selected model is not loaded or is reloading,
+    so requests go to the other backends in the meantime.
+    """
+    kind = "llama.cpp"
+
+    async def complete(self, request: GenerationRequest, stats: GenerationStats) -> str:
+        return await _call_local(request.prompt, resolve_model(request.model), max_tokens=request.max_tokens,
+                                 temperature=request.temperature, stop_after=request.stop_after,
+                                 prefix_key=request.prefix_key, stats=stats, schema=request.schema)
+
+    async def stream(self, request: GenerationRequest, stats: GenerationStats) -> AsyncIterator[str]:
+        async with server_pool.lease(resolve_model(request.model)) as server, \
+                server.scheduler.slot(len(request.prompt)) as waited:
+            stats.queue_seconds = waited
+            stats.start()
+            stream = server.generate_stream(
+                prompt=request.prompt,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                timeout=settings.generation_timeout,
+                prefix_key=request.prefix_key,
+                stats=stats,
+                schema=request.schema
+            )
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+
+    async def probe(self) -> bool:
+        server = server_pool.get_loaded(resolve_model(None))
+        return server is not None and server.state == "ready"
+
+    def status(self) -> dict:
+        return {**super().status(), "model": resolve_model(None)}
+
+def build_router() -> Optional[ProviderRouter]:
+    """Provider router over the local pool and ``XPATH_UPSTREAMS``; None when no upstream is configured."""
+    if not settings.upstreams:
+        return None
+    providers = [LocalProvider("local")]
+    providers += [build_provider(spec, settings.generation_timeout) for spec in settings.upstreams]
+    return ProviderRouter(
+        providers,
+        hedge=settings.hedge_requests,
+        hedge_quantile=settings.hedge_quantile,
+        hedge_min_delay=settings.hedge_min_delay,
+        hedge_max_delay=settings.hedge_max_delay,
+        failure_cooldown=settings.upstream_failure_cooldown,
+        probe_interval=settings.upstream_probe_interval,
+    )
+
+provider_router = build_router()
+
 @app.get("/models", response_model=ModelResponse)
 async def get_models():
-    """Get available models and current selection."""
+    """Get available models with their GGUF metadata, current selection and the resident model pool."""
+    # Reading headers of new files is blocking I/O
+    await asyncio.to_thread(model_manager.catalog.refresh)
     return ModelResponse(
         current_model=model_manager.current_model,
-        available_models=model_manager.get_available_models()
+        available_models=model_manager.get_available_models(),
+        loaded_models=server_pool.status(),
+        pool=server_pool.stats(),
+        models=model_manager.catalog.describe()
     )
 
 @app.put("/models")
 async def set_model(request: ModelRequest):
-    """Switch to a different model."""
+    """Switch the default model, loading it into the pool; other loaded models stay warm.
+
+    Waits for the load up to ``XPATH_LOAD_WAIT_TIMEOUT`` seconds, then answers
+    503 with its progress; the load goes on and a repeated PUT completes the switch.
+    """
     try:
-        await llama_server.start_server(request.model)
+        if request.model not in model_manager.get_available_models():
+            raise ValueError(f"Model {request.model} not found. Available: {model_manager.get_available_models()}")
+        load = model_loader.ensure(request.model)
+        if load is not None:
+            try:
+                await asyncio.wait_for(load.done.wait(), timeout=settings.load_wait_timeout)
+            except asyncio.TimeoutError:
+                raise _loading_error(load)
+            if load.error is not None:
+                raise load.error
         model_manager.set_current_model(request.model)
         return {"message": f"Switched to model: {request.model}"}
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except PoolBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logging.error(f"Model switch error: {e}")
         raise HTTPException(status_code=500, detail="Failed to switch model")
@@ -490,36 +2090,121 @@ async def generate_xpath(data: AIRequest):
                 prompt = msg.content
                 break
         
-        if not prompt:
+        if not prompt and not data.template_id:
             raise HTTPException(status_code=400, detail="No user message found in request")
         
+        model_name = resolve_model(model)
+        stored = resolve_dom(data)
+        
+        use_fast_path = data.fast_path if data.fast_path is not None else settings.locator_fast_path
+        if use_fast_path and data.dom and data.element:
+            answers, _ = await asyncio.to_thread(find_fast_locators, data.dom, [data.element], stored)
+            if answers:
+                return locator_response(answers[0], model_name, start, data.stream)
+        
+        prompt_source = prompt
+        try:
+            prompt, dom_window, prefix_key = await asyncio.to_thread(
+                prepare_prompt, data, prompt_source, chars_per_token=token_counter.chars_per_token(model_name),
+                stored=stored)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        stop_after = data.stop_after or settings.stop_after
+        max_tokens = data.max_tokens or settings.max_tokens
+        temperature = data.temperature if data.temperature is not None else settings.temperature
+        schema = response_schema(data.structured, data.answer_mode)
+        cache_params = {"max_tokens": max_tokens, "temperature": temperature, "stop_after": stop_after, "schema": schema}
+        
+        cache_key = None
+        response = None
+        if data.cache:
+            cache_key = ResponseCache.make_key(model_name, prompt, cache_params)
+            response = await response_cache.get(cache_key)
+        cached = response is not None
+        
+        prompt_tokens, exact_tokens = token_counter.estimate(model_name, prompt), False
+        if not cached:
+            # With other backends available a loading local model must not hold the request
+            server = server_pool.get_loaded(model_name) if provider_router else await load_model(model_name)
+            budget = context_budget(server, max_tokens)
+            prompt_tokens, exact_tokens = await count_prompt_tokens(server, model_name, prompt)
+            
+            # Shrink the DOM window until the prompt fits the slot's context
+            for _ in range(2):
+                if prompt_tokens <= budget or dom_window is None:
+                    break
+                window_tokens = dom_window.window_chars * prompt_tokens // max(len(prompt), 1)
+                reduced = window_tokens - (prompt_tokens - budget) - 64
+                if reduced < 256:
+                    break
+                logging.info(f"Prompt has {prompt_tokens} tokens, budget {budget}: shrinking DOM window to {reduced} tokens")
+                prompt, dom_window, prefix_key = await asyncio.to_thread(
+                    prepare_prompt, data, prompt_source, budget_tokens=reduced,
+                    chars_per_token=len(prompt) / max(prompt_tokens, 1), stored=stored)
+                prompt_tokens, exact_tokens = await count_prompt_tokens(server, model_name, prompt)
+                if cache_key:
+                    cache_key = ResponseCache.make_key(model_name, prompt, cache_params)
+            
+            if prompt_tokens > budget:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Input too large ({prompt_tokens} tokens). "
+                           f"Maximum supported: {budget} tokens. "
+                           f"Please optimize DOM on extension side."
+                )
+        
         prompt_chars = len(prompt)
-        prompt_tokens_estimate = prompt_chars // 4
         is_large_input = prompt_chars > settings.large_input_threshold
         
         logging.info(f"Processing {'LARGE' if is_large_input else 'NORMAL'} input: "
-                    f"{prompt_chars} chars (~{prompt_tokens_estimate} tokens)")
+                    f"{prompt_chars} chars ({prompt_tokens} tokens{'' if exact_tokens else ', estimated'})")
         logging.debug(f"Requested model: {model or 'current'}")
         
-        # Check if input might be too large for fast processing
-        if prompt_tokens_estimate > settings.max_context_tokens * 0.9:
-            raise HTTPException(
-                status_code=413, 
-                detail=f"Input too large ({prompt_tokens_estimate} tokens). "
-                       f"Maximum supported: {int(settings.max_context_tokens * 0.9)} tokens. "
-                       f"Please optimize DOM on extension side."
-            )
-        
         # Warn if input might be slow
-        if prompt_tokens_estimate > settings.max_context_tokens * 0.6:
-            logging.warning(f"Large input ({prompt_tokens_estimate} tokens) may take longer to process")
+        if prompt_tokens > settings.max_context_tokens * 0.6:
+            logging.warning(f"Large input ({prompt_tokens} tokens) may take longer to process")
         
-        response = await call_llama(
-            prompt,
-            model,
-            max_tokens=data.max_tokens or settings.max_tokens,
-            temperature=data.temperature if data.temperature is not None else settings.temperature,
-        )
+        validate = data.validate_xpath if data.validate_xpath is not None else settings.xpath_validation
+        checker = None
+        if validate and data.dom:
+            checker = await asyncio.to_thread(answer_checker, data.dom, data.element, stored)
+
+        if data.stream:
+            if not cached and provider_router is None:
+                check_admission(model)
+            return StreamingResponse(
+                _stream_xpath_events(prompt, model, start, max_tokens=max_tokens, temperature=temperature,
+                                     stop_after=stop_after, cache_key=cache_key, cached_response=response,
+                                     prefix_key=prefix_key, prompt_tokens=prompt_tokens, checker=checker,
+                                     schema=schema),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        # A cached answer processed no tokens
+        stats = GenerationStats(prompt_tokens=0 if cached else prompt_tokens)
+        if not cached:
+            response = await call_llama(
+                prompt,
+                model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop_after=stop_after,
+                prefix_key=prefix_key,
+                stats=stats,
+                schema=schema,
+            )
+
+        validation_info = None
+        generated = response
+        if checker is not None:
+            response, validation, repairs = await validate_and_repair(
+                checker, prompt, response, model, temperature=temperature, prefix_key=prefix_key, schema=schema)
+            validation_info = {**validation.as_dict(), "repair_attempts": repairs}
+        # Cache the repaired answer so a repeat request does not pay for the repair again
+        if cache_key and (not cached or response != generated):
+            await response_cache.put(cache_key, response)
         execution_time = time() - start
         
         # Log performance warning if too slow
@@ -528,7 +2213,7 @@ async def generate_xpath(data: AIRequest):
                           f"Consider DOM optimization.")
         
         logging.info(f"XPath generation completed in {execution_time:.2f}s "
-                    f"(input: {prompt_chars} chars)")
+                    f"(input: {prompt_chars} chars, cached: {cached})")
         
         return {
             "choices": [
@@ -541,17 +2226,24 @@ async def generate_xpath(data: AIRequest):
                     "index": 0
                 }
             ],
-            "model": llama_server.current_model,
-            "usage": {
-                "completion_tokens": len(response.split()),
-                "prompt_tokens": prompt_tokens_estimate,
-                "total_tokens": len(response.split()) + prompt_tokens_estimate
-            },
+            "answer": structured_answer(response),
+            "model": resolve_model(model),
+            "usage": stats.usage(prompt_tokens),
+            "timings": stats.timings(),
             "execution_time": execution_time,
             "input_size": prompt_chars,
-            "estimated_tokens": prompt_tokens_estimate,
+            "prompt_tokens": prompt_tokens,
+            "exact_tokens": exact_tokens,
             "large_input": is_large_input,
             "performance_warning": execution_time > 30,
+            "cached": cached,
+            "validation": validation_info,
+            "dom_window": {
+                "original_chars": dom_window.original_chars,
+                "window_chars": dom_window.window_chars,
+                "target_found": dom_window.target_found,
+                "compaction": dom_window.compaction.as_dict() if dom_window.compaction else None
+            } if dom_window else None,
             "backend": "llama.cpp"
         }
     except HTTPException:
@@ -560,11 +2252,332 @@ async def generate_xpath(data: AIRequest):
         logging.error(f"Unexpected error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+def locator_response(result: LocatorResult, model_name: str, start: float, stream: bool):
+    """Answer /generate-xpath from the locator engine in the same shape as a model response."""
+    content = json.dumps(result.answer())
+    execution_time = time() - start
+    logging.info(f"XPath answered by {result.best.strategy} locator in {execution_time * 1000:.1f}ms")
+    if stream:
+        async def events() -> AsyncIterator[str]:
+            yield chat_chunk(content, model_name)
+            yield chat_chunk("", model_name, finish_reason="stop", cached=False, fast_path=True,
+                             execution_time=execution_time, backend="llama.cpp", locator=result.as_dict(),
+                             answer=result.answer())
+            yield sse_event("[DONE]")
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return {
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": content
+                },
+                "finish_reason": "stop",
+                "index": 0
+            }
+        ],
+        "answer": result.answer(),
+        "model": model_name,
+        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
+        "execution_time": execution_time,
+        "cached": False,
+        "fast_path": True,
+        "locator": result.as_dict(),
+        "backend": "llama.cpp"
+    }
+
+async def _stream_xpath_events(prompt: str, model: Optional[str], start: float, *, max_tokens: int, temperature: float,
+                               stop_after: str, cache_key: Optional[str] = None, cached_response: Optional[str] = None,
+                               prefix_key: Optional[str] = None, prompt_tokens: Optional[int] = None,
+                               checker: Optional[DomChecker] = None, schema: Optional[dict] = None) -> AsyncIterator[str]:
+    """Proxy the llama.cpp token stream as OpenAI-style server-sent events.
+
+    With a ``checker`` the final chunk reports how the answer's XPaths match the
+    DOM; the answer has already been streamed, so it is not repaired.
+    """
+    model_name = resolve_model(model)
+    if cached_response is not None:
+        validation = await _stream_validation(checker, cached_response)
+        yield chat_chunk(cached_response, model_name)
+        yield chat_chunk("", model_name, finish_reason="stop", cached=True,
+                         execution_time=time() - start, backend="llama.cpp", validation=validation,
+                         answer=structured_answer(cached_response))
+        yield sse_event("[DONE]")
+        return
+    tracker = JsonCompletionTracker(stop_after)
+    stats = GenerationStats(prompt_tokens=prompt_tokens)
+    backend = "llama.cpp"
+    try:
+        with count_cancelled("llama.cpp"):
+            if provider_router is None:
+                async with server_pool.lease(model_name) as server, server.scheduler.slot(len(prompt)) as waited:
+                    stats.queue_seconds = waited
+                    stats.start()
+                    async for chunk in stream_llama(server, prompt, max_tokens=max_tokens, temperature=temperature,
+                                                    tracker=tracker, prefix_key=prefix_key, stats=stats, schema=schema):
+                        yield chat_chunk(chunk, model_name)
+                    stats.finish()
+            else:
+                request = generation_request(prompt, model, max_tokens=max_tokens, temperature=temperature,
+                                             stop_after=stop_after, prefix_key=prefix_key, schema=schema,
+                                             prompt_tokens=prompt_tokens)
+                provider, chunks, stats = await provider_router.stream(request)
+                backend, model_name = provider.kind, provider.model or model_name
+                try:
+                    async for chunk in chunks:
+                        kept = tracker.feed(chunk)
+                        if kept:
+                            yield chat_chunk(kept, model_name)
+                        if tracker.done:
+                            break
+                finally:
+                    # Closing the stream drops the upstream connection, which stops its generation
+                    await chunks.aclose()
+        stats.observe(backend, model_name)
+        if tracker.closing_suffix():
+            yield chat_chunk(tracker.closing_suffix(), model_name)
+        if cache_key:
+            await response_cache.put(cache_key, tracker.text())
+        validation = await _stream_validation(checker, tracker.text())
+        execution_time = time() - start
+        logging.info(f"XPath streaming completed in {execution_time:.2f}s "
+                    f"(input: {len(prompt)} chars, early stop: {tracker.done})")
+        yield chat_chunk("", model_name, finish_reason="stop", cached=False,
+                         early_stop=tracker.done, execution_time=execution_time, backend=backend,
+                         usage=stats.usage(token_counter.estimate(model_name, prompt)), timings=stats.timings(),
+                         validation=validation, answer=structured_answer(tracker.text()))
+    except QueueFullError as e:
+        logging.warning(str(e))
+        code = 503 if isinstance(e, QueueTimeoutError) else 429
+        STREAM_ERRORS.labels("llama.cpp", str(code)).inc()
+        yield sse_event({"error": {"message": str(e), "code": code, "retry_after": e.retry_after}})
+    except PoolBusyError as e:
+        logging.warning(str(e))
+        STREAM_ERRORS.labels("llama.cpp", "503").inc()
+        yield sse_event({"error": {"message": "All loaded models are busy, try again later", "code": 503}})
+    except ProviderError as e:
+        logging.error(str(e))
+        STREAM_ERRORS.labels("llama.cpp", "502").inc()
+        yield sse_event({"error": {"message": "Error calling LLM backends", "code": 502}})
+    except Exception as e:
+        logging.error(f"llama.cpp streaming error: {str(e)}")
+        STREAM_ERRORS.labels("llama.cpp", "502").inc()
+        yield sse_event({"error": {"message": "Error calling local LLM", "code": 502}})
+    yield sse_event("[DONE]")
+
+async def _stream_validation(checker: Optional[DomChecker], response: str) -> Optional[dict]:
+    if checker is None:
+        return None
+    validation = await asyncio.to_thread(checker.check, response)
+    XPATH_VALIDATION.labels("first", validation.result).inc()
+    return validation.as_dict()
+
+@app.post("/generate-xpath/batch")
+async def generate_xpath_batch(data: BatchRequest):
+    """Generate XPaths for many elements of one DOM, streaming results per element.
+
+    The DOM is windowed once for all elements and placed in a prompt prefix
+    shared by every element, so each llama-server slot prefills it once and
+    the per-element generations run concurrently across the --parallel slots.
+    """
+    start = time()
+    if len(data.elements) > settings.batch_max_elements:
+        raise HTTPException(status_code=400, detail=f"Too many elements ({len(data.elements)}). "
+                                                    f"Maximum per batch: {settings.batch_max_elements}")
+    model_name = resolve_model(data.model)
+    stored = resolve_dom(data)
+    answers: Dict[int, LocatorResult] = {}
+    if data.fast_path if data.fast_path is not None else settings.locator_fast_path:
+        answers, _ = await asyncio.to_thread(find_fast_locators, data.dom, data.elements, stored)
+    # Only elements without a robust locator go to the model
+    pending = [index for index in range(len(data.elements)) if index not in answers]
+    if not pending:
+        events = _batch_results(data, model_name, 1, [], [], [], [], answers, "", start)
+        return await _batch_response(data, events, model_name, start, None)
+
+    server = await load_model(model_name)
+    try:
+        shared, prompts, dom_window, found = await asyncio.to_thread(
+            prepare_batch_prompts, data, token_counter.chars_per_token(model_name),
+            [data.elements[index] for index in pending], stored)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Prompts differ only in the element line: count the shared part exactly, estimate the rest
+    shared_tokens, _ = await count_prompt_tokens(server, model_name, shared)
+    prompt_tokens = [shared_tokens + token_counter.estimate(model_name, p[len(shared):]) for p in prompts]
+    budget = context_budget(server, data.max_tokens or settings.max_tokens)
+    if max(prompt_tokens) > budget:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Input too large ({max(prompt_tokens)} tokens). "
+                   f"Maximum supported: {budget} tokens. "
+                   f"Please optimize DOM on extension side."
+        )
+
+    dom_window_info = {
+        "original_chars": dom_window.original_chars,
+        "window_chars": dom_window.window_chars,
+        "shared_prefix_chars": len(shared),
+        "compaction": dom_window.compaction.as_dict() if dom_window.compaction else None
+    }
+    try:
+        server.scheduler.check_admission()
+    except QueueFullError as e:
+        raise _queue_error(e)
+
+    events = _batch_results(data, model_name, server.slots.n_slots, pending, prompts, prompt_tokens, found,
+                            answers, _shared_prefix_key(shared), start)
+    return await _batch_response(data, events, model_name, start, dom_window_info)
+
+async def _batch_response(data: BatchRequest, events: AsyncIterator[dict], model_name: str, start: float,
+                          dom_window_info: Optional[dict]):
+    """Stream batch results as server-sent events or collect them into one JSON response."""
+    count = len(data.elements)
+    if data.stream:
+        return StreamingResponse(
+            _stream_batch_events(events, model_name, start, count, dom_window_info),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    results = [None] * count
+    async for result in events:
+        results[result["index"]] = result
+    execution_time = time() - start
+    logging.info(f"Batch of {count} elements completed in {execution_time:.2f}s")
+    return {
+        "results": results,
+        "model": model_name,
+        "execution_time": execution_time,
+        "errors": sum(1 for r in results if "error" in r),
+        "dom_window": dom_window_info,
+        "backend": "llama.cpp"
+    }
+
+async def _batch_results(data: BatchRequest, model_name: str, n_slots: int, pending: List[int], prompts: List[str],
+                         prompt_tokens: List[int], found: List[Optional[bool]], answers: Dict[int, LocatorResult],
+                         prefix_key: str, start: float) -> AsyncIterator[dict]:
+    """Yield locator answers first, then run one generation per pending element.
+
+    ``pending`` maps positions in ``prompts`` to element indices. At most one
+    generation per llama-server slot runs at a time; results are yielded as they finish.
+    """
+    stop_after = data.stop_after or settings.stop_after
+    max_tokens = data.max_tokens or settings.max_tokens
+    temperature = data.temperature if data.temperature is not None else settings.temperature
+    schema = response_schema(data.structured, data.answer_mode)
+    semaphore = asyncio.Semaphore(n_slots)
+
+    async def run(position: int) -> dict:
+        prompt = prompts[position]
+        result = {"index": pending[position], "target_found": found[position]}
+        cache_key = None
+        if data.cache:
+            cache_key = ResponseCache.make_key(model_name, prompt, {
+                "max_tokens": max_tokens, "temperature": temperature, "stop_after": stop_after, "schema": schema
+            })
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                result.update(content=cached, answer=structured_answer(cached), cached=True,
+                              execution_time=time() - start)
+                return result
+        stats = GenerationStats(prompt_tokens=prompt_tokens[position])
+        async with semaphore:
+            try:
+                content = await call_llama(prompt, model_name, max_tokens=max_tokens, temperature=temperature,
+                                           stop_after=stop_after, prefix_key=prefix_key, stats=stats, schema=schema)
+            except HTTPException as e:
+                STREAM_ERRORS.labels("llama.cpp", str(e.status_code)).inc()
+                result["error"] = {"message": e.detail, "code": e.status_code}
+                return result
+        if cache_key:
+            await response_cache.put(cache_key, content)
+        result.update(content=content, answer=structured_answer(content), cached=False, execution_time=time() - start,
+                      usage=stats.usage(prompt_tokens[position]))
+        return result
+
+    for index, located in sorted(answers.items()):
+        answer = located.answer()
+        yield {"index": index, "target_found": True, "content": json.dumps(answer), "answer": answer, "cached": False,
+               "fast_path": True, "locator": located.as_dict(), "execution_time": time() - start}
+
+    tasks = [asyncio.create_task(run(position)) for position in range(len(prompts))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _stream_batch_events(events: AsyncIterator[dict], model_name: str, start: float, count: int,
+                               dom_window_info: dict) -> AsyncIterator[str]:
+    """Emit one server-sent event per finished element, then a summary event."""
+    errors = 0
+    try:
+        async for result in events:
+            errors += "error" in result
+            yield sse_event(result)
+    finally:
+        await events.aclose()
+    execution_time = time() - start
+    logging.info(f"Batch of {count} elements streamed in {execution_time:.2f}s ({errors} errors)")
+    yield sse_event({"done": True, "count": count, "errors": errors, "execution_time": execution_time,
+                     "model": model_name, "dom_window": dom_window_info, "backend": "llama.cpp"})
+    yield sse_event("[DONE]")
+
+@app.post("/dom")
+async def upload_dom(upload: DomUpload):
+    """Store a page DOM; requests for elements of that page can then send ``dom_hash`` instead of ``dom``."""
+    uploads = dom_store.uploads
+    stored = dom_store.put(upload.dom)
+    return {"dom_hash": stored.key, "chars": len(stored.dom), "new": dom_store.uploads > uploads}
+
+@app.get("/dom/{dom_hash}")
+async def get_dom_info(dom_hash: str):
+    """Check whether a DOM is still stored (404 means upload it again)."""
+    stored = dom_store.get(dom_hash)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dom_hash {dom_hash}")
+    return {"dom_hash": stored.key, "chars": len(stored.dom), "age_seconds": round(time() - stored.created, 1)}
+
+@app.get("/templates")
+async def get_templates():
+    """List server-side prompt templates usable via template_id."""
+    return {"templates": [template_registry.get(name).describe() for name in template_registry.names()]}
+
+@app.get("/cache")
+async def cache_stats():
+    """Response cache hit/miss counters."""
+    return response_cache.stats()
+
+@app.delete("/cache")
+async def clear_cache():
+    """Drop all cached responses."""
+    await response_cache.clear()
+    return {"message": "Cache cleared"}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics."""
+    LOADED_MODELS.set(len(server_pool.servers))
+    QUEUE_DEPTH.clear()
+    QUEUE_RUNNING.clear()
+    for name, server in server_pool.servers.items():
+        queue = server.scheduler.stats()
+        QUEUE_DEPTH.labels(name).set(queue["queued"])
+        QUEUE_RUNNING.labels(name).set(queue["running"])
+    return metrics_response()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    server_healthy = await llama_server.is_healthy()
-    server_ready = await llama_server.is_ready()
+    server = server_pool.get_loaded(model_manager.current_model)
+    load = model_loader.loading(model_manager.current_model) if model_manager.current_model else None
+    server_ready = await server.is_ready() if server else False
+    # Before llama-server is launched the load is already under way
+    server_healthy = (server is not None and server.state in ("ready", "loading")) or load is not None
     
     # Determine server status
     if server_ready:
@@ -574,25 +2587,15 @@ async def health_check():
     else:
         server_status = "unhealthy"
     
-    if llama_server.process:
-        process_status = "running" if llama_server.process.returncode is None else "dead"
+    if server and server.process:
+        process_status = "running" if server.process.returncode is None else "dead"
     else:
         process_status = "stopped"
     
-    # Check GPU availability
-    gpu_available = False
-    gpu_info = "Not detected"
-    try:
-        if os.path.exists("/usr/local/cuda") or os.environ.get("CUDA_VISIBLE_DEVICES"):
-            result = subprocess.run(
-                ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
-                capture_output=True, text=True, timeout=3, shell=False
-            )
-            if result.returncode == 0:
-                gpu_available = True
-                gpu_info = result.stdout.strip()
-    except Exception:
-        pass
+    # Probed once at startup; /health never shells out
+    gpus = hardware_profile.gpus if hardware_profile else []
+    gpu_available = bool(gpus)
+    gpu_info = ", ".join(g.name for g in gpus) or "Not detected"
     
     if server_ready:
         status_code = 200
@@ -604,12 +2607,30 @@ async def health_check():
         "status": "ok",
         "server_status": server_status,
         "server_ready": server_ready,
+        "server_state": server.state if server else "stopped",
+        "state_age_seconds": round(server.state_age(), 3) if server else None,
         "process_status": process_status,
         "current_model": model_manager.current_model,
         "available_models": len(model_manager.get_available_models()),
-        "server_url": llama_server.base_url,
+        "server_url": server.base_url if server else None,
         "gpu_available": gpu_available,
         "gpu_info": gpu_info,
-        "acceleration": "GPU" if gpu_available else "CPU"
+        "acceleration": "GPU" if gpu_available else "CPU",
+        "hardware": hardware_profile.as_dict() if hardware_profile else None,
+        "launch_params": asdict(server.launch_params) if server and server.launch_params else None,
+        "draft_model": server.draft_model if server else None,
+        "decode": server.decode_totals.as_dict() if server else None,
+        "replicas": server.replica_status() if isinstance(server, ReplicaSet) else None,
+        "response_cache": response_cache.stats(),
+        "tokenizer": token_counter.stats(),
+        "in_flight": in_flight.stats(),
+        "dom_store": dom_store.stats(),
+        "compiled_xpaths": compiled_xpaths.stats(),
+        "slots": server.slots.stats() if server else None,
+        "queue": server.scheduler.stats() if server else None,
+        "model_pool": server_pool.stats(),
+        "loading": load.status() if load else None,
+        "model_loads": model_loader.status(),
+        "upstreams": provider_router.stats() if provider_router else None
     }
     return JSONResponse(payload, status_code=status_code)
\ No newline at end of file
@@ -1,31 +1,46 @@
+import asyncio
 import httpx
+import json
 import os
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, model_validator
 import logging
 from time import time
 
+from answer_schema import answer_schema, structured_answer
+from cancellation import CancellationMiddleware, count_cancelled
+from decompression import DecompressionMiddleware
+from json_stream import JsonCompletionTracker, chat_chunk, sse_event
+from metrics import (COALESCED_REQUESTS, MODEL_LOAD_SECONDS, MODEL_SWITCHES, STREAM_ERRORS, GenerationStats, MetricsMiddleware,
+                     metrics_response)
+from response_cache import ResponseCache, SingleFlight
+
 logging.basicConfig(level=logging.INFO)
 
-from typing import Optional, List
+from typing import AsyncIterator, Literal, Optional, List, Tuple, Union
 
 app = FastAPI(title="XPathAI Backend - Ollama", description="AI-powered XPath generation with Ollama")
 
+# Middlewares added later wrap earlier ones: errors from the inner ones get CORS headers
+app.add_middleware(DecompressionMiddleware, max_bytes=int(os.getenv("OLLAMA_MAX_BODY_MB", "32")) * 1024 * 1024)
+app.add_middleware(CancellationMiddleware, default_timeout=float(os.getenv("OLLAMA_REQUEST_DEADLINE", "0")))
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=False,
-    allow_methods=["POST", "GET"],
+    allow_methods=["POST", "GET", "DELETE"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, backend="ollama")
 
 class AIMessage(BaseModel):
     role: str
     content: str
 
 class AIRequest(BaseModel):
-    model: str = "qwen2.5:3b"
+    model: str = "default"
     messages: List[AIMessage]
     stream: bool = False
     max_tokens: int = 512
@@ -36,6 +51,10 @@ class AIRequest(BaseModel):
     n: int = 1
     response_format: dict = {"type": "text"}
     stop: List[str] = ["</s>", "<|end|>", "\n\n"]
+    stop_after: Optional[Literal["object", "primary_xpath", "none"]] = None
+    cache: bool = True
+    structured: Optional[bool] = None
+    answer_mode: Optional[Literal["full", "xpath_only"]] = None
 
     @model_validator(mode="after") 
     def validate_fields(self):
@@ -54,34 +73,276 @@ class ModelResponse(BaseModel):
 
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_STOP_AFTER = os.getenv("OLLAMA_STOP_AFTER", "object")
+OLLAMA_STRUCTURED_OUTPUT = os.getenv("OLLAMA_STRUCTURED_OUTPUT", "1").lower() not in ("0", "false", "no")
+OLLAMA_ANSWER_MODE = os.getenv("OLLAMA_ANSWER_MODE", "full")
+OLLAMA_EXPLANATION_MAX_CHARS = int(os.getenv("OLLAMA_EXPLANATION_MAX_CHARS", "200"))
+OLLAMA_DEFAULT_MODEL = os.getenv("OLLAMA_DEFAULT_MODEL", "qwen2.5:3b")
+
+
+def parse_keep_alive(value: str) -> Union[int, str]:
+    """keep_alive as Ollama accepts it: a plain number is seconds (-1 = forever) and must be sent as a
+    number, since a string goes through Go's time.ParseDuration, which rejects "-1" without a unit."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+# Ollama unloads a model after its keep_alive; every request resets it, so it is sent each time
+OLLAMA_KEEP_ALIVE = parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "5m"))
+OLLAMA_PIN_KEEP_ALIVE = parse_keep_alive(os.getenv("OLLAMA_PIN_KEEP_ALIVE", "-1"))
+OLLAMA_TAGS_TTL = float(os.getenv("OLLAMA_TAGS_TTL", "30"))
+OLLAMA_COALESCE_REQUESTS = os.getenv("OLLAMA_COALESCE_REQUESTS", "1").lower() not in ("0", "false", "no")
 logging.info(f"Ollama URL: {OLLAMA_BASE_URL}")
 
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("OLLAMA_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("OLLAMA_CACHE_TTL", "86400")),
+    persist_dir=os.getenv("OLLAMA_CACHE_DIR") or None
+)
+
+in_flight = SingleFlight()
 CURRENT_MODEL = None
+LAST_SERVED_MODEL = None
 
-async def call_ollama(data: AIRequest) -> str:
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        payload = {
-            "model": data.model,
-            "prompt": data.messages[0].content,
-            "stream": False,
-            "options": {
-                "temperature": float(data.temperature),
-                "top_p": float(data.top_p),
-                "top_k": int(data.top_k),
-                "repeat_penalty": float(data.frequency_penalty),
-                "num_predict": int(data.max_tokens),
-                "stop": ["</s>", "<|end|>", "\n\n\n"]
-            }
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    """Shared keep-alive client for all Ollama calls, created on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=OLLAMA_BASE_URL,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(120.0, connect=5.0),
+        )
+    return _client
+
+class TagCache:
+    """Model names from /api/tags, refreshed at most every ``ttl`` seconds.
+
+    Concurrent callers share one in-flight refresh. ``status`` reflects the
+    last refresh, so health checks do not call Ollama on every probe.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.models: List[str] = []
+        self.status = "unknown"
+        self.error: Optional[str] = None
+        self.fetched_at = 0.0
+        self.lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return time() - self.fetched_at < self.ttl
+
+    async def get(self, force: bool = False) -> List[str]:
+        if not force and self.fresh():
+            return self.models
+        async with self.lock:
+            if not force and self.fresh():
+                return self.models
+            try:
+                response = await get_client().get("/api/tags", timeout=5.0)
+                if response.status_code == 200:
+                    self.models = [model["name"] for model in response.json().get("models", [])]
+                    self.status, self.error = "ready", None
+                else:
+                    self.status, self.error = "error", f"Ollama returned {response.status_code}"
+            except httpx.HTTPError as e:
+                self.status, self.error = "offline", str(e) or type(e).__name__
+            # Failures are cached too, so an offline Ollama is not hammered by health checks
+            self.fetched_at = time()
+            return self.models
+
+tag_cache = TagCache(OLLAMA_TAGS_TTL)
+
+def resolve_model(model: Optional[str]) -> str:
+    """"default" (or nothing) means the model selected through PUT /models."""
+    if not model or model == "default":
+        return CURRENT_MODEL or OLLAMA_DEFAULT_MODEL
+    return model
+
+def keep_alive_for(model: str) -> Union[int, str]:
+    return OLLAMA_PIN_KEEP_ALIVE if model == CURRENT_MODEL else OLLAMA_KEEP_ALIVE
+
+async def preload_model(model: str, keep_alive: Union[int, str], warm_up: bool = True) -> float:
+    """Load a model into Ollama with the given keep_alive, then run a one-token warm-up generation.
+
+    Returns the seconds spent. An empty prompt only loads the weights; the
+    warm-up request also allocates the context and primes the compute graph,
+    so the first real request does not pay for either.
+    """
+    started = time()
+    response = await get_client().post("/api/generate", json={"model": model, "keep_alive": keep_alive},
+                                       timeout=600.0)
+    response.raise_for_status()
+    _record_model_use(model, response.json())
+    if warm_up:
+        response = await get_client().post("/api/generate", json={
+            "model": model, "prompt": "{}", "stream": False, "keep_alive": keep_alive,
+            "options": {"num_predict": 1}
+        }, timeout=120.0)
+        response.raise_for_status()
+    elapsed = time() - started
+    logging.info(f"Model {model} loaded and warmed up in {elapsed:.2f}s (keep_alive {keep_alive})")
+    return elapsed
+
+def _record_model_use(model: str, final: dict):
+    """Count model switches and record load time when Ollama had to load the model."""
+    global LAST_SERVED_MODEL
+    if model != LAST_SERVED_MODEL:
+        if LAST_SERVED_MODEL is not None:
+            MODEL_SWITCHES.labels("ollama").inc()
+        if "load_duration" in final:
+            MODEL_LOAD_SECONDS.labels("ollama", model).observe(final["load_duration"] / 1e9)
+        LAST_SERVED_MODEL = model
+
+def _response_schema(data: AIRequest) -> Optional[dict]:
+    """JSON schema passed as Ollama's ``format`` to constrain the answer, or None when disabled."""
+    if not (data.structured if data.structured is not None else OLLAMA_STRUCTURED_OUTPUT):
+        return None
+    return answer_schema(data.answer_mode or OLLAMA_ANSWER_MODE, OLLAMA_EXPLANATION_MAX_CHARS)
+
+def _ollama_payload(data: AIRequest, stream: bool = False) -> dict:
+    payload = {
+        "model": data.model,
+        "prompt": data.messages[0].content,
+        "stream": stream,
+        "keep_alive": keep_alive_for(data.model),
+        "options": {
+            "temperature": float(data.temperature),
+            "top_p": float(data.top_p),
+            "top_k": int(data.top_k),
+            "repeat_penalty": float(data.frequency_penalty),
+            "num_predict": int(data.max_tokens),
+            "stop": ["</s>", "<|end|>", "\n\n\n"]
         }
-        logging.info(f"call_ollama: model={data.model}, max_tokens={data.max_tokens}, temperature={data.temperature}, prompt_len={len(data.messages[0].content)}, prompt_preview={data.messages[0].content[:1000].replace('\n',' ')}")
-        try:
-            response = await client.post(f"{OLLAMA_BASE_URL}/api/generate", json=payload)
+    }
+    schema = _response_schema(data)
+    if schema is not None:
+        payload["format"] = schema
+    return payload
+
+async def call_ollama(data: AIRequest, stop_after: Optional[str] = None, stats: Optional[GenerationStats] = None) -> str:
+    """Generate an answer; concurrent identical requests share one Ollama generation."""
+    stats = stats if stats is not None else GenerationStats()
+    if not OLLAMA_COALESCE_REQUESTS:
+        with count_cancelled("ollama"):
+            return await _generate(data, stop_after, stats)
+
+    async def work() -> Tuple[str, GenerationStats]:
+        own = GenerationStats(prompt_tokens=stats.prompt_tokens)
+        with count_cancelled("ollama"):
+            return await _generate(data, stop_after, own), own
+
+    (response, shared_stats), shared = await in_flight.run(_cache_key(data, stop_after), work)
+    vars(stats).update(vars(shared_stats))
+    if shared:
+        COALESCED_REQUESTS.labels("ollama").inc()
+        logging.info("Identical request already in flight, reused its answer")
+    return response
+
+async def _generate(data: AIRequest, stop_after: Optional[str], stats: GenerationStats) -> str:
+    stats.start()
+    if stop_after and stop_after != "none":
+        tracker = JsonCompletionTracker(stop_after)
+        async for _ in stream_ollama(data, tracker, stats):
+            pass
+        stats.finish()
+        stats.observe("ollama", data.model)
+        return tracker.text()
+
+    payload = _ollama_payload(data)
+    prompt_preview = data.messages[0].content[:1000].replace('\n', ' ')
+    logging.info(f"call_ollama: model={data.model}, max_tokens={data.max_tokens}, temperature={data.temperature}, prompt_len={len(data.messages[0].content)}, prompt_preview={prompt_preview}")
+    try:
+        response = await get_client().post("/api/generate", json=payload)
+        response.raise_for_status()
+        result = response.json()
+        stats.update_from_ollama(result)
+        stats.finish()
+        stats.observe("ollama", data.model)
+        _record_model_use(data.model, result)
+        return result.get("response", "").strip()
+    except Exception as e:
+        logging.error(f"Ollama error: {e}")
+        raise HTTPException(status_code=502, detail=f"Ollama error: {str(e)}")
+
+async def stream_ollama(data: AIRequest, tracker: JsonCompletionTracker,
+                        stats: Optional[GenerationStats] = None) -> AsyncIterator[str]:
+    """Stream answer chunks from Ollama until the tracker reports the answer complete.
+
+    Leaving the stream early closes the connection, which makes Ollama stop generating.
+    """
+    payload = _ollama_payload(data, stream=True)
+    logging.info(f"stream_ollama: model={data.model}, max_tokens={data.max_tokens}, prompt_len={len(data.messages[0].content)}")
+    try:
+        async with get_client().stream("POST", "/api/generate", json=payload) as response:
             response.raise_for_status()
-            result = response.json()
-            return result.get("response", "").strip()
-        except Exception as e:
-            logging.error(f"Ollama error: {e}")
-            raise HTTPException(status_code=502, detail=f"Ollama error: {str(e)}")
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if stats is not None:
+                    if chunk.get("response"):
+                        stats.token()
+                    if chunk.get("done"):
+                        stats.update_from_ollama(chunk)
+                if chunk.get("done") or "load_duration" in chunk:
+                    _record_model_use(data.model, chunk)
+                kept = tracker.feed(chunk.get("response", ""))
+                if kept:
+                    yield kept
+                if tracker.done or chunk.get("done"):
+                    break
+    except Exception as e:
+        logging.error(f"Ollama error: {e}")
+        raise HTTPException(status_code=502, detail=f"Ollama error: {str(e)}")
+
+def _cache_key(data: AIRequest, stop_after: str) -> str:
+    return ResponseCache.make_key(data.model, data.messages[0].content, {
+        "temperature": data.temperature,
+        "top_p": data.top_p,
+        "top_k": data.top_k,
+        "frequency_penalty": data.frequency_penalty,
+        "max_tokens": data.max_tokens,
+        "stop_after": stop_after,
+        "schema": _response_schema(data)
+    })
+
+async def _stream_xpath_events(data: AIRequest, start: float, stop_after: str,
+                               cache_key: Optional[str] = None, cached_response: Optional[str] = None) -> AsyncIterator[str]:
+    """Proxy the Ollama token stream as OpenAI-style server-sent events."""
+    if cached_response is not None:
+        yield chat_chunk(cached_response, data.model)
+        yield chat_chunk("", data.model, finish_reason="stop", cached=True,
+                         execution_time=time() - start, backend="ollama", answer=structured_answer(cached_response))
+        yield sse_event("[DONE]")
+        return
+    tracker = JsonCompletionTracker(stop_after)
+    stats = GenerationStats()
+    stats.start()
+    try:
+        with count_cancelled("ollama"):
+            async for chunk in stream_ollama(data, tracker, stats):
+                yield chat_chunk(chunk, data.model)
+        stats.finish()
+        stats.observe("ollama", data.model)
+        if tracker.closing_suffix():
+            yield chat_chunk(tracker.closing_suffix(), data.model)
+        if cache_key:
+            await response_cache.put(cache_key, tracker.text())
+        execution_time = time() - start
+        logging.info(f"/generate-xpath stream time: {execution_time:.3f}s, early stop: {tracker.done}")
+        yield chat_chunk("", data.model, finish_reason="stop", cached=False,
+                         early_stop=tracker.done, execution_time=execution_time, backend="ollama",
+                         usage=stats.usage(), timings=stats.timings(),
+                         answer=structured_answer(tracker.text()))
+    except HTTPException as e:
+        STREAM_ERRORS.labels("ollama", str(e.status_code)).inc()
+        yield sse_event({"error": {"message": e.detail, "code": e.status_code}})
+    yield sse_event("[DONE]")
 
 @app.post("/generate-xpath")
 async def generate_xpath(data: AIRequest):
@@ -94,11 +355,29 @@ async def generate_xpath(data: AIRequest):
                 break
         if not prompt_text:
             raise HTTPException(status_code=400, detail="No user message found in request")
+        data.model = resolve_model(data.model)
+
+        stop_after = data.stop_after or OLLAMA_STOP_AFTER
+        cache_key = _cache_key(data, stop_after) if data.cache else None
+        response = await response_cache.get(cache_key) if cache_key else None
+        cached = response is not None
 
-        response = await call_ollama(data)
+        if data.stream:
+            return StreamingResponse(
+                _stream_xpath_events(data, start, stop_after, cache_key=cache_key, cached_response=response),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        # A cached answer processed no tokens
+        stats = GenerationStats(prompt_tokens=0) if cached else GenerationStats()
+        if not cached:
+            response = await call_ollama(data, stop_after, stats)
+            if cache_key:
+                await response_cache.put(cache_key, response)
 
         execution_time = time() - start
-        logging.info(f"/generate-xpath response time: {execution_time:.3f}s")
+        logging.info(f"/generate-xpath response time: {execution_time:.3f}s (cached: {cached})")
         logging.info(f"/generate-xpath response: {response}")
         return {
             "choices": [
@@ -111,13 +390,12 @@ async def generate_xpath(data: AIRequest):
                     "index": 0
                 }
             ],
+            "answer": structured_answer(response),
             "model": data.model,
-            "usage": {
-                "completion_tokens": len(response.split()),
-                "prompt_tokens": len(prompt_text.split()),
-                "total_tokens": len(response.split()) + len(prompt_text.split())
-            },
+            "usage": stats.usage(),
+            "timings": stats.timings(),
             "execution_time": execution_time,
+            "cached": cached,
             "backend": "ollama"
         }
     except HTTPException:
@@ -128,67 +406,72 @@ async def generate_xpath(data: AIRequest):
 
 @app.get("/models", response_model=ModelResponse)
 async def get_models():
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            if response.status_code == 200:
-                models_data = response.json()
-                models = [model["name"] for model in models_data.get("models", [])]
-                return ModelResponse(current_model=CURRENT_MODEL, available_models=models, backend="ollama")
-            else:
-                return ModelResponse(current_model=CURRENT_MODEL, available_models=[], backend="ollama", error="Ollama not available")
-    except Exception as e:
-        return ModelResponse(current_model=CURRENT_MODEL, available_models=[], backend="ollama", error=str(e))
+    models = await tag_cache.get()
+    return ModelResponse(current_model=CURRENT_MODEL, available_models=models, backend="ollama", error=tag_cache.error)
 
 @app.put("/models")
 async def set_model(request: ModelRequest):
+    """Select the default model, load it into Ollama pinned by keep_alive and warm it up."""
+    global CURRENT_MODEL
+    models = await tag_cache.get()
+    if request.model not in models:
+        # A model pulled since the last refresh is not in the cached list yet
+        models = await tag_cache.get(force=True)
+    if tag_cache.status != "ready" and not models:
+        raise HTTPException(status_code=500, detail="Ollama not available")
+    if request.model not in models:
+        raise HTTPException(status_code=400, detail=f"Model {request.model} not found. Available: {models}")
+    previous = CURRENT_MODEL
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            if response.status_code == 200:
-                models_data = response.json()
-                models = [model["name"] for model in models_data.get("models", [])]
-                if request.model not in models:
-                    raise HTTPException(status_code=400, detail=f"Model {request.model} not found. Available: {models}")
-                global CURRENT_MODEL
-                CURRENT_MODEL = request.model
-                return {"message": f"Switched to model: {request.model}", "current_model": CURRENT_MODEL}
-            else:
-                raise HTTPException(status_code=500, detail="Ollama not available")
-    except HTTPException:
-        raise
-    except Exception as e:
+        load_seconds = await preload_model(request.model, OLLAMA_PIN_KEEP_ALIVE)
+        CURRENT_MODEL = request.model
+        if previous and previous != request.model:
+            # Unpin the old model: it is unloaded after the normal keep_alive instead of never
+            await preload_model(previous, OLLAMA_KEEP_ALIVE, warm_up=False)
+    except httpx.HTTPError as e:
         logging.error(f"Model switch error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to switch model")
+        raise HTTPException(status_code=502, detail=f"Failed to load model {request.model}: {e}")
+    return {"message": f"Switched to model: {request.model}", "current_model": CURRENT_MODEL,
+            "load_seconds": round(load_seconds, 3)}
 
 @app.get("/endpoint-health")
 async def endpoint_health():
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            if response.status_code == 200:
-                return {"status": "ok", "ollama_status": "ready", "backend": "ollama", "url": OLLAMA_BASE_URL}
-            else:
-                return {"status": "error", "ollama_status": "error", "backend": "ollama", "url": OLLAMA_BASE_URL}
-    except Exception:
-        return {"status": "offline", "ollama_status": "offline", "backend": "ollama", "url": OLLAMA_BASE_URL}
+    await tag_cache.get()
+    status = {"ready": "ok", "offline": "offline"}.get(tag_cache.status, "error")
+    return {"status": status, "ollama_status": tag_cache.status, "backend": "ollama", "url": OLLAMA_BASE_URL}
+
+@app.get("/cache")
+async def cache_stats():
+    return response_cache.stats()
+
+@app.delete("/cache")
+async def clear_cache():
+    await response_cache.clear()
+    return {"message": "Cache cleared"}
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response()
 
 @app.get("/health")
 async def health_check():
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            ollama_status = "ready" if response.status_code == 200 else "error"
-    except Exception:
-        ollama_status = "offline"
-    
+    await tag_cache.get()
     return {
         "status": "ok",
-        "ollama_status": ollama_status,
+        "ollama_status": tag_cache.status,
+        "status_age_seconds": round(time() - tag_cache.fetched_at, 3),
         "backend": "ollama",
-        "url": OLLAMA_BASE_URL
+        "url": OLLAMA_BASE_URL,
+        "current_model": CURRENT_MODEL,
+        "response_cache": response_cache.stats(),
+        "in_flight": in_flight.stats()
     }
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _client is not None:
+        await _client.aclose()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
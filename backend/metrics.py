@@ -0,0 +1,279 @@
+from dataclasses import dataclass
+from time import time
+from typing import List, Optional
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+
+REQUEST_SECONDS = Histogram(
+    "xpath_request_duration_seconds", "End-to-end request latency",
+    ["backend", "endpoint"], buckets=LATENCY_BUCKETS)
+PHASE_SECONDS = Histogram(
+    "xpath_phase_duration_seconds", "Time spent per generation phase (queue, prefill, decode)",
+    ["backend", "phase"], buckets=LATENCY_BUCKETS)
+TOKENS = Counter(
+    "xpath_tokens_total", "Tokens processed by the model",
+    ["backend", "model", "kind"])
+TOKENS_PER_SECOND = Histogram(
+    "xpath_tokens_per_second", "Prefill and decode throughput per request",
+    ["backend", "phase"], buckets=THROUGHPUT_BUCKETS)
+MODEL_LOAD_SECONDS = Histogram(
+    "xpath_model_load_duration_seconds", "Time to load a model until it serves requests",
+    ["backend", "model"], buckets=LATENCY_BUCKETS)
+MODEL_SWITCHES = Counter(
+    "xpath_model_switches_total", "Changes of the model serving requests",
+    ["backend"])
+RESPONSES = Counter(
+    "xpath_responses_total", "HTTP responses by status code",
+    ["backend", "endpoint", "status"])
+STREAM_ERRORS = Counter(
+    "xpath_stream_errors_total", "Errors reported inside a started event stream",
+    ["backend", "code"])
+IN_FLIGHT = Gauge(
+    "xpath_in_flight_requests", "Requests currently being processed",
+    ["backend"])
+QUEUE_DEPTH = Gauge(
+    "xpath_queue_depth", "Requests waiting for a llama-server slot",
+    ["model"])
+QUEUE_RUNNING = Gauge(
+    "xpath_queue_running", "Requests holding a llama-server slot",
+    ["model"])
+LOADED_MODELS = Gauge(
+    "xpath_loaded_models", "Models resident in the llama-server pool")
+LOCATOR_FAST_PATH = Counter(
+    "xpath_locator_fast_path_total", "Elements answered by the deterministic locator engine instead of the model",
+    ["result"])
+XPATH_VALIDATION = Counter(
+    "xpath_validation_total", "Model answers checked against the submitted DOM, by attempt and result",
+    ["attempt", "result"])
+COALESCED_REQUESTS = Counter(
+    "xpath_coalesced_requests_total", "Requests answered by an identical generation already in flight",
+    ["backend"])
+CANCELLED_GENERATIONS = Counter(
+    "xpath_cancelled_generations_total", "Generations stopped before they finished, by reason (disconnect, deadline)",
+    ["backend", "reason"])
+REPLICA_RESTARTS = Counter(
+    "xpath_replica_restarts_total", "llama-server replicas restarted after their process exited",
+    ["model"])
+DRAFT_TOKENS = Counter(
+    "xpath_draft_tokens_total", "Tokens proposed by the draft model and accepted by the main model (speculative decoding)",
+    ["model", "kind"])
+UPSTREAM_REQUESTS = Counter(
+    "xpath_upstream_requests_total", "Generation attempts per inference backend by outcome (success, error, cancelled)",
+    ["provider", "outcome"])
+UPSTREAM_HEDGES = Counter(
+    "xpath_upstream_hedges_total", "Duplicate requests sent because the first backend was slower than its p95",
+    ["provider"])
+UPSTREAM_FAILOVERS = Counter(
+    "xpath_upstream_failovers_total", "Requests retried on another backend after a failure",
+    ["provider"])
+
+
+@dataclass
+class GenerationStats:
+    """Token counts and phase timings of one generation.
+
+    Filled from the model server's own accounting (llama.cpp ``timings``,
+    Ollama ``*_count``/``*_duration``) when available; otherwise prefill is
+    measured as time to first token and completion tokens as streamed chunks.
+    ``prompt_tokens`` is the whole prompt; ``prefill_tokens`` is the part the
+    server actually evaluated (less when a cached prefix was reused).
+    """
+    prompt_tokens: Optional[int] = None
+    prefill_tokens: Optional[int] = None
+    completion_tokens: int = 0
+    queue_seconds: float = 0.0
+    prefill_seconds: Optional[float] = None
+    decode_seconds: Optional[float] = None
+    draft_tokens: Optional[int] = None
+    draft_accepted: Optional[int] = None
+    from_server: bool = False
+    _started: Optional[float] = None
+    _first_token: Optional[float] = None
+
+    def start(self):
+        self._started = time()
+
+    def token(self):
+        """Record a streamed chunk when the server does not report counts itself."""
+        if self._first_token is None:
+            self._first_token = time()
+        if not self.from_server:
+            self.completion_tokens += 1
+
+    def finish(self):
+        if self.from_server or self._started is None:
+            return
+        end = time()
+        first = self._first_token or end
+        self.prefill_seconds = first - self._started
+        self.decode_seconds = end - first
+
+    def update_from_llama(self, timings: dict):
+        """Take counts from a llama.cpp ``timings`` object (last one wins)."""
+        if not timings:
+            return
+        self.from_server = True
+        self.prefill_tokens = timings.get("prompt_n", self.prefill_tokens)
+        self.completion_tokens = timings.get("predicted_n", self.completion_tokens)
+        if "prompt_ms" in timings:
+            self.prefill_seconds = timings["prompt_ms"] / 1000
+        if "predicted_ms" in timings:
+            self.decode_seconds = timings["predicted_ms"] / 1000
+        # Present only when llama-server runs a draft model
+        if "draft_n" in timings:
+            self.draft_tokens = timings["draft_n"]
+            self.draft_accepted = timings.get("draft_n_accepted", 0)
+
+    def update_from_ollama(self, final: dict):
+        """Take counts from the final Ollama /api/generate message (durations are in ns)."""
+        if "eval_count" not in final and "prompt_eval_count" not in final:
+            return
+        self.from_server = True
+        self.prefill_tokens = final.get("prompt_eval_count", self.prefill_tokens)
+        if self.prompt_tokens is None:
+            self.prompt_tokens = self.prefill_tokens
+        self.completion_tokens = final.get("eval_count", self.completion_tokens)
+        if "prompt_eval_duration" in final:
+            self.prefill_seconds = final["prompt_eval_duration"] / 1e9
+        if "eval_duration" in final:
+            self.decode_seconds = final["eval_duration"] / 1e9
+
+    @property
+    def prompt_tokens_per_second(self) -> Optional[float]:
+        if self.prefill_tokens and self.prefill_seconds:
+            return self.prefill_tokens / self.prefill_seconds
+        return None
+
+    @property
+    def completion_tokens_per_second(self) -> Optional[float]:
+        if self.completion_tokens and self.decode_seconds:
+            return self.completion_tokens / self.decode_seconds
+        return None
+
+    @property
+    def draft_acceptance_rate(self) -> Optional[float]:
+        if self.draft_tokens:
+            return self.draft_accepted / self.draft_tokens
+        return None
+
+    def usage(self, prompt_tokens_fallback: Optional[int] = None) -> dict:
+        """OpenAI-style usage block; uses the fallback when the prompt was not counted.
+
+        Without a count or a tokenizer-based fallback, prompt and total tokens
+        are None rather than a guess from the character count.
+        """
+        prompt_tokens = self.prompt_tokens if self.prompt_tokens is not None else prompt_tokens_fallback
+        return {
+            "completion_tokens": self.completion_tokens,
+            "prompt_tokens": prompt_tokens,
+            "total_tokens": prompt_tokens + self.completion_tokens if prompt_tokens is not None else None,
+        }
+
+    def timings(self) -> dict:
+        return {
+            "queue_seconds": round(self.queue_seconds, 4),
+            "prefill_seconds": round(self.prefill_seconds, 4) if self.prefill_seconds is not None else None,
+            "decode_seconds": round(self.decode_seconds, 4) if self.decode_seconds is not None else None,
+            "prompt_tokens_per_second": round(self.prompt_tokens_per_second or 0, 1) or None,
+            "completion_tokens_per_second": round(self.completion_tokens_per_second or 0, 1) or None,
+            "draft_acceptance_rate": round(self.draft_acceptance_rate, 3) if self.draft_acceptance_rate is not None else None,
+        }
+
+    def observe(self, backend: str, model: Optional[str]):
+        PHASE_SECONDS.labels(backend, "queue").observe(self.queue_seconds)
+        if self.prefill_seconds is not None:
+            PHASE_SECONDS.labels(backend, "prefill").observe(self.prefill_seconds)
+        if self.decode_seconds is not None:
+            PHASE_SECONDS.labels(backend, "decode").observe(self.decode_seconds)
+        if self.prompt_tokens:
+            TOKENS.labels(backend, model or "unknown", "prompt").inc(self.prompt_tokens)
+        if self.prefill_tokens:
+            TOKENS.labels(backend, model or "unknown", "prefill").inc(self.prefill_tokens)
+        if self.completion_tokens:
+            TOKENS.labels(backend, model or "unknown", "completion").inc(self.completion_tokens)
+        if self.prompt_tokens_per_second:
+            TOKENS_PER_SECOND.labels(backend, "prefill").observe(self.prompt_tokens_per_second)
+        if self.completion_tokens_per_second:
+            TOKENS_PER_SECOND.labels(backend, "decode").observe(self.completion_tokens_per_second)
+        if self.draft_tokens:
+            DRAFT_TOKENS.labels(model or "unknown", "drafted").inc(self.draft_tokens)
+            DRAFT_TOKENS.labels(model or "unknown", "accepted").inc(self.draft_accepted)
+
+
+class DecodeTotals:
+    """Running decode totals of one llama-server: throughput and, with a draft model, its acceptance rate."""
+    def __init__(self):
+        self.completion_tokens = 0
+        self.decode_seconds = 0.0
+        self.draft_tokens = 0
+        self.draft_accepted = 0
+
+    def add(self, stats: GenerationStats):
+        if stats.completion_tokens and stats.decode_seconds:
+            self.completion_tokens += stats.completion_tokens
+            self.decode_seconds += stats.decode_seconds
+        if stats.draft_tokens:
+            self.draft_tokens += stats.draft_tokens
+            self.draft_accepted += stats.draft_accepted
+
+    @classmethod
+    def merged(cls, parts: "List[DecodeTotals]") -> "DecodeTotals":
+        total = cls()
+        for part in parts:
+            total.completion_tokens += part.completion_tokens
+            total.decode_seconds += part.decode_seconds
+            total.draft_tokens += part.draft_tokens
+            total.draft_accepted += part.draft_accepted
+        return total
+
+    def as_dict(self) -> dict:
+        return {
+            "completion_tokens": self.completion_tokens,
+            "decode_tokens_per_second": round(self.completion_tokens / self.decode_seconds, 1) if self.decode_seconds else None,
+            "draft_tokens": self.draft_tokens,
+            "draft_accepted": self.draft_accepted,
+            "draft_acceptance_rate": round(self.draft_accepted / self.draft_tokens, 3) if self.draft_tokens else None,
+        }
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting in-flight requests, latency and status codes.
+
+    Works at the ASGI level so streamed responses are measured until their last
+    chunk is sent, not just until the headers go out.
+    """
+    def __init__(self, app, backend: str, path_prefix: str = "/generate-xpath"):
+        self.app = app
+        self.backend = backend
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = scope["path"]
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time()
+        IN_FLIGHT.labels(self.backend).inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.labels(self.backend).dec()
+            REQUEST_SECONDS.labels(self.backend, endpoint).observe(time() - start)
+            RESPONSES.labels(self.backend, endpoint, str(status["code"])).inc()
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+PLACEHOLDERS = ("{element}", "{dom}")
+
+
+class CompiledTemplate:
+    """A prompt template split into its static instruction prefix and a dynamic tail.
+
+    The prefix is everything before the first placeholder. It is identical for
+    every request using the template, so llama.cpp can keep it in a slot's KV
+    cache and only prefill the element/DOM tail.
+    """
+    def __init__(self, name: str, text: str):
+        positions = [text.find(p) for p in PLACEHOLDERS if p in text]
+        if not positions:
+            raise ValueError(f"Template {name} has no {{element}} or {{dom}} placeholder")
+        split = min(positions)
+        self.name = name
+        self.prefix = text[:split]
+        self.tail = text[split:]
+        self.prefix_key = hashlib.sha1(self.prefix.encode("utf-8")).hexdigest()
+
+    def render(self, element: str, dom: str) -> str:
+        return self.prefix + self.tail.replace("{element}", element).replace("{dom}", dom)
+
+    def split_shared(self, dom: str) -> Tuple[str, str]:
+        """Split the template for many elements on one DOM.
+
+        Returns the shared text (prefix with the DOM filled in) and the
+        per-element tail still holding ``{element}``. Lines mentioning the
+        element are moved after the DOM so every element prompt starts with the
+        same text and llama.cpp only prefills the DOM once per slot.
+        """
+        line_start = self.prefix.rfind("\n") + 1
+        lines = (self.prefix[line_start:] + self.tail).split("\n")
+        element_lines = [line for line in lines if "{element}" in line]
+        other_lines = [line for line in lines if "{element}" not in line]
+        shared = self.prefix[:line_start] + "\n".join(other_lines).replace("{dom}", dom).rstrip() + "\n"
+        return shared, "\n".join(element_lines).replace("{dom}", dom)
+
+    def describe(self) -> dict:
+        return {"id": self.name, "prefix_chars": len(self.prefix), "tail_chars": len(self.tail)}
+
+
+class TemplateRegistry:
+    """Named prompt templates compiled once at startup.
+
+    ``default_path`` is registered as "default"; every ``*.txt`` file in
+    ``templates_dir`` is registered under its file stem (e.g. "prompt_template2").
+    """
+    def __init__(self, default_path: Optional[str] = None, templates_dir: Optional[str] = None):
+        self.default_path = default_path
+        self.templates_dir = templates_dir
+        self.templates: Dict[str, CompiledTemplate] = {}
+
+    def load(self):
+        templates = {}
+        sources = []
+        if self.templates_dir and Path(self.templates_dir).is_dir():
+            sources.extend((p.stem, p) for p in sorted(Path(self.templates_dir).glob("*.txt")))
+        if self.default_path:
+            sources.append(("default", Path(self.default_path)))
+        for name, path in sources:
+            try:
+                templates[name] = CompiledTemplate(name, path.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Skipping prompt template {path}: {e}")
+        self.templates = templates
+        logging.info(f"Loaded prompt templates: {sorted(templates)}")
+
+    def get(self, name: str) -> CompiledTemplate:
+        if not self.templates:
+            self.load()
+        template = self.templates.get(name)
+        if template is None:
+            raise ValueError(f"Unknown template {name}. Available: {self.names()}")
+        return template
+
+    def names(self) -> List[str]:
+        return sorted(self.templates)
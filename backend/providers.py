@@ -0,0 +1,525 @@
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from time import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from metrics import GenerationStats, UPSTREAM_FAILOVERS, UPSTREAM_HEDGES, UPSTREAM_REQUESTS
+
+
+class ProviderError(RuntimeError):
+    """Raised when no inference backend produced an answer."""
+
+
+@dataclass
+class GenerationRequest:
+    """One completion, independent of the backend that will serve it.
+
+    ``model``, ``prefix_key`` and ``stop_after`` are used by the local
+    llama.cpp pool; HTTP providers serve their configured model and stop on
+    their own (the caller trims the text to the JSON answer).
+    """
+    prompt: str
+    max_tokens: int = 512
+    temperature: float = 0.3
+    schema: Optional[dict] = None
+    model: Optional[str] = None
+    prefix_key: Optional[str] = None
+    stop_after: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+
+
+class LatencyWindow:
+    """Recent latencies of one provider: quantiles for hedging, an EWMA for routing."""
+    def __init__(self, size: int = 200, alpha: float = 0.2):
+        self.samples: deque = deque(maxlen=size)
+        self.alpha = alpha
+        self.ewma: Optional[float] = None
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 3) if value is not None else None
+        return {"samples": len(self.samples), "ewma": rounded(self.ewma),
+                "p50": rounded(self.quantile(0.5)), "p95": rounded(self.quantile(0.95))}
+
+
+class Provider(ABC):
+    """An inference backend the router can send a prompt to.
+
+    Subclasses implement ``complete`` (whole answer), ``stream`` (answer
+    chunks) and ``probe`` (True when the backend can serve right now); both
+    generation methods record token counts and timings into the ``stats`` of
+    their attempt. The router keeps the health and latency bookkeeping here.
+    """
+    kind = "unknown"
+
+    def __init__(self, name: str, model: Optional[str] = None):
+        self.name = name
+        self.model = model
+        self.latency = LatencyWindow()
+        self.first_token = LatencyWindow()
+        self.inflight = 0
+        self.ready = True
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+
+    @abstractmethod
+    async def complete(self, request: GenerationRequest, stats: GenerationStats) -> str:
+        """Return the whole answer."""
+
+    @abstractmethod
+    def stream(self, request: GenerationRequest, stats: GenerationStats) -> AsyncIterator[str]:
+        """Yield the answer in chunks as they are generated."""
+
+    async def probe(self) -> bool:
+        return True
+
+    async def aclose(self):
+        pass
+
+    def available(self) -> bool:
+        return self.ready and time() >= self.down_until
+
+    def expected_seconds(self) -> float:
+        """Routing score: smoothed latency scaled by the requests already in flight.
+
+        A provider without samples scores zero, so a new or recovered backend
+        gets traffic and a measurement.
+        """
+        return (self.latency.ewma or 0.0) * (1 + self.inflight)
+
+    def record_success(self, seconds: float, first_token: Optional[float] = None):
+        self.latency.observe(seconds)
+        if first_token is not None:
+            self.first_token.observe(first_token)
+        self.failures = 0
+        self.ready = True
+        UPSTREAM_REQUESTS.labels(self.name, "success").inc()
+
+    def record_failure(self, error: BaseException, cooldown: float):
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+        # Back off longer while a backend keeps failing, e.g. during a model reload
+        self.down_until = time() + cooldown * min(self.failures, 4)
+        UPSTREAM_REQUESTS.labels(self.name, "error").inc()
+        logging.warning(f"Provider {self.name} failed ({self.failures} in a row): {self.last_error}")
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "model": self.model,
+            "available": self.available(),
+            "ready": self.ready,
+            "inflight": self.inflight,
+            "failures": self.failures,
+            "down_for_seconds": round(max(0.0, self.down_until - time()), 1),
+            "last_error": self.last_error,
+            "latency": self.latency.stats(),
+            "first_token": self.first_token.stats(),
+        }
+
+
+class HttpProvider(Provider):
+    """Provider reached over HTTP through one long-lived keep-alive client."""
+    def __init__(self, name: str, url: str, model: Optional[str] = None, timeout: float = 90.0,
+                 headers: Optional[Dict[str, str]] = None):
+        super().__init__(name, model)
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=self.url,
+                headers=self.headers,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=60.0),
+                timeout=httpx.Timeout(self.timeout, connect=3.0),
+            )
+        return self.client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    def status(self) -> dict:
+        return {**super().status(), "url": self.url}
+
+
+class LlamaServerProvider(HttpProvider):
+    """A llama-server (llama.cpp) instance: ``/completion`` with ``json_schema`` constraints."""
+    kind = "llama.cpp"
+
+    def _payload(self, request: GenerationRequest, stream: bool) -> dict:
+        payload = {"prompt": request.prompt, "n_predict": request.max_tokens,
+                   "temperature": request.temperature, "stream": stream, "cache_prompt": True}
+        if request.schema is not None:
+            payload["json_schema"] = request.schema
+        return payload
+
+    async def complete(self, request: GenerationRequest, stats: GenerationStats) -> str:
+        response = await self._get_client().post("/completion", json=self._payload(request, False))
+        response.raise_for_status()
+        result = response.json()
+        stats.update_from_llama(result.get("timings"))
+        return result.get("content", "").strip()
+
+    async def stream(self, request: GenerationRequest, stats: GenerationStats) -> AsyncIterator[str]:
+        async with self._get_client().stream("POST", "/completion", json=self._payload(request, True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                chunk = json.loads(line[6:])
+                stats.update_from_llama(chunk.get("timings"))
+                if chunk.get("content"):
+                    stats.token()
+                    yield chunk["content"]
+                if chunk.get("stop"):
+                    break
+
+    async def probe(self) -> bool:
+        # 503 while the model is loading
+        response = await self._get_client().get("/health", timeout=3.0)
+        return response.status_code == 200
+
+
+class OllamaProvider(HttpProvider):
+    """An Ollama server: ``/api/generate`` with the schema passed as ``format``."""
+    kind = "ollama"
+
+    def _payload(self, request: GenerationRequest, stream: bool) -> dict:
+        payload = {"model": self.model, "prompt": request.prompt, "stream": stream,
+                   "options": {"temperature": request.temperature, "num_predict": request.max_tokens}}
+        if request.schema is not None:
+            payload["format"] = request.schema
+        return payload
+
+    async def complete(self, request: GenerationRequest, stats: GenerationStats) -> str:
+        response = await self._get_client().post("/api/generate", json=self._payload(request, False))
+        response.raise_for_status()
+        result = response.json()
+        stats.update_from_ollama(result)
+        return result.get("response", "").strip()
+
+    async def stream(self, request: GenerationRequest, stats: GenerationStats) -> AsyncIterator[str]:
+        async with self._get_client().stream("POST", "/api/generate", json=self._payload(request, True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("response"):
+                    stats.token()
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    stats.update_from_ollama(chunk)
+                    break
+
+    async def probe(self) -> bool:
+        response = await self._get_client().get("/api/tags", timeout=3.0)
+        if response.status_code != 200:
+            return False
+        return self.model in [model["name"] for model in response.json().get("models", [])]
+
+
+class OpenAIProvider(HttpProvider):
+    """Any OpenAI-compatible ``/v1/chat/completions`` endpoint (vLLM, LM Studio, hosted APIs)."""
+    kind = "openai"
+
+    def _payload(self, request: GenerationRequest, stream: bool) -> dict:
+        payload = {"model": self.model, "messages": [{"role": "user", "content": request.prompt}],
+                   "max_tokens": request.max_tokens, "temperature": request.temperature, "stream": stream}
+        if request.schema is not None:
+            payload["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": "xpath_answer", "schema": request.schema}}
+        return payload
+
+    async def complete(self, request: GenerationRequest, stats: GenerationStats) -> str:
+        response = await self._get_client().post("/chat/completions", json=self._payload(request, False))
+        response.raise_for_status()
+        result = response.json()
+        stats.completion_tokens = result.get("usage", {}).get("completion_tokens", 0)
+        return (result["choices"][0]["message"].get("content") or "").strip()
+
+    async def stream(self, request: GenerationRequest, stats: GenerationStats) -> AsyncIterator[str]:
+        async with self._get_client().stream("POST", "/chat/completions", json=self._payload(request, True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line[6:].strip() == "[DONE]":
+                    continue
+                choices = json.loads(line[6:]).get("choices") or [{}]
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    stats.token()
+                    yield content
+                if choices[0].get("finish_reason"):
+                    break
+
+    async def probe(self) -> bool:
+        response = await self._get_client().get("/models", timeout=3.0)
+        return response.status_code == 200
+
+
+PROVIDER_KINDS = {
+    "llama.cpp": LlamaServerProvider,
+    "ollama": OllamaProvider,
+    "openai": OpenAIProvider,
+}
+
+
+def build_provider(spec: Dict[str, Any], timeout: float) -> Provider:
+    """Create a provider from a config entry: ``{"kind", "url", "model", "name", "api_key"}``."""
+    kind = spec.get("kind")
+    if kind not in PROVIDER_KINDS:
+        raise ValueError(f"Unknown upstream kind: {kind}. Available: {list(PROVIDER_KINDS)}")
+    if not spec.get("url"):
+        raise ValueError(f"Upstream {spec} has no url")
+    if kind != "llama.cpp" and not spec.get("model"):
+        raise ValueError(f"Upstream {spec['url']} of kind {kind} needs a model")
+    headers = {"Authorization": f"Bearer {spec['api_key']}"} if spec.get("api_key") else None
+    name = spec.get("name") or f"{kind}@{spec['url']}"
+    return PROVIDER_KINDS[kind](name, spec["url"], spec.get("model"), timeout=timeout, headers=headers)
+
+
+class ProviderRouter:
+    """Sends each generation to the best available provider, with failover and optional hedging.
+
+    Providers are ranked by availability, then by expected latency. If the
+    chosen one fails, the next one is tried. With ``hedge`` enabled, a
+    duplicate goes to the runner-up when the first has not answered within its
+    own p95 latency (clamped to ``hedge_min_delay``..``hedge_max_delay``); the
+    first answer wins and the other request is cancelled, which closes its
+    connection and so stops the generation upstream.
+    """
+    def __init__(self, providers: List[Provider], *, hedge: bool = False, hedge_quantile: float = 0.95,
+                 hedge_min_delay: float = 0.5, hedge_max_delay: float = 10.0, hedge_min_samples: int = 8,
+                 failure_cooldown: float = 10.0, probe_interval: float = 5.0):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_cooldown = failure_cooldown
+        self.probe_interval = probe_interval
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.failover_wins = 0
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    def ranked(self) -> List[Provider]:
+        """All providers, best first; unavailable ones stay at the end as a last resort."""
+        order = {id(provider): i for i, provider in enumerate(self.providers)}
+        return sorted(self.providers, key=lambda p: (not p.available(), p.expected_seconds(), order[id(p)]))
+
+    def hedge_delay(self, provider: Provider, window: LatencyWindow) -> Optional[float]:
+        """Seconds to wait for ``provider`` before sending a duplicate elsewhere; None disables hedging."""
+        if not self.hedge:
+            return None
+        if len(window.samples) < self.hedge_min_samples:
+            return self.hedge_max_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, window.quantile(self.hedge_quantile)))
+
+    async def _attempt(self, provider: Provider, call, stats: GenerationStats) -> Any:
+        """Run ``call`` against ``provider`` with in-flight and outcome bookkeeping."""
+        provider.inflight += 1
+        started = time()
+        try:
+            result = await call(stats)
+        except asyncio.CancelledError:
+            # A hedged loser took at least this long; without the sample a backend
+            # that always loses the race would keep looking fast and stay first
+            provider.latency.observe(time() - started)
+            UPSTREAM_REQUESTS.labels(provider.name, "cancelled").inc()
+            raise
+        except Exception as e:
+            provider.record_failure(e, self.failure_cooldown)
+            raise
+        finally:
+            provider.inflight -= 1
+        return result, stats, time() - started
+
+    async def _race(self, request: GenerationRequest, make_call, window_of) -> Tuple[Provider, Any, GenerationStats, float]:
+        """Run attempts until one succeeds: fail over on errors, hedge on slowness.
+
+        ``make_call(provider)`` returns the coroutine function to run with the
+        attempt's stats; ``window_of(provider)`` the latency window its hedge
+        delay is based on. Each attempt records into its own stats, so a
+        cancelled loser does not mix into the winner's numbers.
+        """
+        candidates = self.ranked()
+        tasks: Dict[asyncio.Task, Provider] = {}
+        # Why each attempt was started: "primary", "hedge" (the primary was slow) or "failover"
+        reasons: Dict[asyncio.Task, str] = {}
+        errors: List[str] = []
+        hedged = False
+
+        def launch(reason: str) -> Provider:
+            provider = candidates.pop(0)
+            stats = GenerationStats(prompt_tokens=request.prompt_tokens)
+            task = asyncio.create_task(self._attempt(provider, make_call(provider), stats))
+            tasks[task] = provider
+            reasons[task] = reason
+            return provider
+
+        primary = launch("primary")
+        primary_task = next(iter(tasks))
+        started = time()
+        try:
+            while tasks:
+                timeout = None
+                if not hedged and candidates and candidates[0].available():
+                    delay = self.hedge_delay(primary, window_of(primary))
+                    if delay is not None:
+                        timeout = max(0.0, delay - (time() - started))
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedged += 1
+                    provider = launch("hedge")
+                    UPSTREAM_HEDGES.labels(provider.name).inc()
+                    logging.info(f"No answer from {primary.name} after {time() - started:.2f}s, hedging to {provider.name}")
+                    continue
+                for task in done:
+                    provider = tasks.pop(task)
+                    if task.exception() is None:
+                        result, stats, seconds = task.result()
+                        if reasons[task] == "hedge" and primary_task in tasks:
+                            # Beat a primary that was still running: the hedge saved latency
+                            self.hedge_wins += 1
+                        elif reasons[task] != "primary":
+                            # Answered after the primary failed: the failover saved the request
+                            self.failover_wins += 1
+                        return provider, result, stats, seconds
+                    errors.append(f"{provider.name}: {task.exception()}")
+                if not tasks and candidates:
+                    self.failovers += 1
+                    provider = launch("failover")
+                    UPSTREAM_FAILOVERS.labels(provider.name).inc()
+                    logging.info(f"Failing over to {provider.name}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        raise ProviderError("All inference backends failed: " + "; ".join(errors))
+
+    async def complete(self, request: GenerationRequest) -> Tuple[str, Provider, GenerationStats]:
+        """Return the first successful answer, the provider that produced it and its stats."""
+        def make_call(provider: Provider):
+            async def call(stats: GenerationStats) -> str:
+                stats.start()
+                text = await provider.complete(request, stats)
+                stats.finish()
+                return text
+            return call
+        provider, text, stats, seconds = await self._race(request, make_call, lambda p: p.latency)
+        provider.record_success(seconds)
+        return text, provider, stats
+
+    async def stream(self, request: GenerationRequest) -> Tuple[Provider, AsyncIterator[str], GenerationStats]:
+        """Open a stream on the provider that delivers the first chunk first.
+
+        Hedging and failover happen only before the first chunk; once text has
+        been sent to the client, an upstream error ends the stream. The stats
+        are complete once the returned iterator is exhausted or closed.
+        """
+        def make_call(provider: Provider):
+            async def first_chunk(stats: GenerationStats):
+                stats.start()
+                stream = provider.stream(request, stats)
+                try:
+                    return stream, await stream.__anext__()
+                except BaseException:
+                    await stream.aclose()
+                    raise
+            return first_chunk
+
+        provider, (stream, first), stats, first_seconds = await self._race(request, make_call, lambda p: p.first_token)
+        started = time() - first_seconds
+
+        async def chunks() -> AsyncIterator[str]:
+            provider.inflight += 1
+            outcome = "success"
+            try:
+                yield first
+                async for chunk in stream:
+                    yield chunk
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            except Exception as e:
+                outcome = "error"
+                provider.record_failure(e, self.failure_cooldown)
+                raise
+            finally:
+                provider.inflight -= 1
+                stats.finish()
+                await stream.aclose()
+                # Closed early by the consumer (answer complete) counts as a success
+                if outcome == "success":
+                    provider.record_success(time() - started, first_seconds)
+                elif outcome == "cancelled":
+                    UPSTREAM_REQUESTS.labels(provider.name, "cancelled").inc()
+        return provider, chunks(), stats
+
+    async def probe_all(self):
+        """Refresh readiness of every provider; a recovered one is eligible again at once."""
+        async def probe(provider: Provider):
+            try:
+                ready = await provider.probe()
+            except Exception as e:
+                ready = False
+                provider.last_error = str(e) or type(e).__name__
+            if ready and not provider.ready:
+                logging.info(f"Provider {provider.name} is ready")
+                provider.down_until = 0.0
+            elif not ready and provider.ready:
+                logging.warning(f"Provider {provider.name} is not ready: {provider.last_error}")
+            provider.ready = ready
+        await asyncio.gather(*(probe(provider) for provider in self.providers))
+
+    async def _monitor(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self):
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def aclose(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        for provider in self.providers:
+            await provider.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "hedge": self.hedge,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "failover_wins": self.failover_wins,
+            "providers": [provider.status() for provider in self.ranked()],
+        }
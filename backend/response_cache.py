@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from uuid import uuid4
+
+
+class ResponseCache:
+    """Content-addressed LRU cache of generated responses with optional disk persistence.
+
+    Keys are hashes of (model, normalized prompt, sampling params), so identical
+    requests map to the same entry regardless of whitespace differences in the DOM.
+    Entries expire after ``ttl`` seconds. With ``persist_dir`` every entry is also
+    written to disk and reloaded on a memory miss, so the cache survives restarts;
+    file I/O runs in worker threads so it does not block the event loop.
+    """
+    def __init__(self, max_entries: int = 512, ttl: float = 86400.0, persist_dir: Optional[str] = None,
+                 max_disk_entries: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_dir = Path(persist_dir) if persist_dir else None
+        self.max_disk_entries = max_disk_entries or max_entries * 8
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts_since_prune = 0
+        if self.persist_dir:
+            try:
+                self.persist_dir.mkdir(parents=True, exist_ok=True)
+                self._prune_disk()
+            except OSError as e:
+                logging.warning(f"Response cache persistence disabled: {e}")
+                self.persist_dir = None
+
+    @staticmethod
+    def make_key(model: Optional[str], prompt: str, params: dict) -> str:
+        """Hash a request into a cache key."""
+        normalized = " ".join(prompt.split())
+        material = json.dumps({"model": model, "prompt": normalized, "params": params}, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return the cached value for key, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry is None and self.persist_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self._store(key, entry)
+        if entry is not None and time() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            if self.persist_dir:
+                await asyncio.to_thread(self._delete_disk, key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def put(self, key: str, value: str):
+        """Store a value, evicting the least recently used entries beyond max_entries."""
+        if not value or self.max_entries <= 0:
+            return
+        entry = (time(), value)
+        self._store(key, entry)
+        if self.persist_dir and await asyncio.to_thread(self._write_disk, key, entry):
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= 64:
+                self._puts_since_prune = 0
+                await asyncio.to_thread(self._prune_disk)
+
+    async def clear(self):
+        self._entries.clear()
+        if self.persist_dir:
+            await asyncio.to_thread(self._clear_disk)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "persistent": self.persist_dir is not None,
+        }
+
+    def _store(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _path(self, key: str) -> Path:
+        return self.persist_dir / f"{key}.json"
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        try:
+            data = json.loads(self._path(key).read_text(encoding="utf-8"))
+            return data["created"], data["value"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug(f"Unreadable cache entry {key}: {e}")
+            return None
+
+    def _write_disk(self, key: str, entry: tuple) -> bool:
+        path = self._path(key)
+        # Unique temp name: two writers of the same key may run in different threads
+        tmp = path.with_name(f"{key}.{uuid4().hex}.tmp")
+        try:
+            tmp.write_text(json.dumps({"created": entry[0], "value": entry[1]}), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning(f"Could not persist cache entry: {e}")
+            tmp.unlink(missing_ok=True)
+            return False
+        return True
+
+    def _delete_disk(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def _clear_disk(self):
+        for path in self.persist_dir.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+    def _prune_disk(self):
+        """Drop expired files and the oldest ones beyond max_disk_entries."""
+        try:
+            files = sorted(self.persist_dir.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+        except OSError as e:
+            logging.debug(f"Cache prune skipped: {e}")
+            return
+        now = time()
+        for index, path in enumerate(files):
+            try:
+                if index >= self.max_disk_entries or now - path.stat().st_mtime > self.ttl:
+                    path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent identical requests into one in-flight computation.
+
+    The first caller for a key starts the work in its own task; callers that
+    arrive while it runs wait for the same result (or exception). A caller
+    that is cancelled, e.g. because its client disconnected, only stops
+    waiting: the work goes on for the others and is cancelled once no caller
+    is left. Keys are the same hashes as the response cache uses.
+    """
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    async def run(self, key: str, work: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, shared): shared is True when another caller's work was reused."""
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.create_task(work()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.waiters += 1
+        try:
+            # shield: cancelling this caller must not cancel the shared task
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self.abandoned += 1
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+        }
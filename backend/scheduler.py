@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import math
+from contextlib import asynccontextmanager
+from time import time
+from typing import AsyncIterator, List, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when a request cannot be queued; ``retry_after`` is a hint in seconds."""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueTimeoutError(QueueFullError):
+    """Raised when a queued request waited longer than the allowed maximum."""
+
+
+class RequestScheduler:
+    """Admission control in front of a llama-server: bounded concurrency and a bounded wait queue.
+
+    At most ``capacity`` requests (the number of llama-server slots) run at once.
+    Others wait in a priority queue ordered by prompt size, so short prompts are
+    served first; ``aging_rate`` (cost units per second of waiting) keeps large
+    prompts from starving. When ``max_queue`` requests are already waiting, new
+    ones are rejected immediately instead of timing out downstream.
+    """
+    def __init__(self, capacity: int = 1, max_queue: int = 32, aging_rate: float = 2000.0, max_wait: float = 30.0):
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.aging_rate = aging_rate
+        self.max_wait = max_wait
+        self.running = 0
+        self._heap: List[list] = []  # [priority, seq, future]
+        self._queued = 0
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+        self.avg_service_time = 5.0
+
+    def set_capacity(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._wake()
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a new request could start."""
+        backlog = self._queued + 1
+        return max(1, math.ceil(backlog / self.capacity * self.avg_service_time))
+
+    def check_admission(self):
+        """Raise QueueFullError if a request arriving now would be rejected."""
+        if self.running >= self.capacity and self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(f"Request queue is full ({self._queued} waiting)", self.retry_after())
+
+    async def acquire(self, cost: float) -> float:
+        """Wait for a free slot; return the time spent waiting."""
+        if self.running < self.capacity and not self._queued:
+            self.running += 1
+            self.admitted += 1
+            return 0.0
+        self.check_admission()
+
+        enqueued = time()
+        future = asyncio.get_running_loop().create_future()
+        entry = [cost + self.aging_rate * enqueued, next(self._seq), future]
+        heapq.heappush(self._heap, entry)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait or None)
+        except asyncio.TimeoutError:
+            self._abandon(future)
+            self.timed_out += 1
+            raise QueueTimeoutError(f"Request waited more than {self.max_wait:.0f}s in queue", self.retry_after())
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        waited = time() - enqueued
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_observed_wait = max(self.max_observed_wait, waited)
+        return waited
+
+    def release(self, service_time: Optional[float] = None):
+        self.running -= 1
+        if service_time is not None:
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, cost: float) -> AsyncIterator[float]:
+        """Hold a slot for the duration of the block; yields the queue wait time."""
+        waited = await self.acquire(cost)
+        started = time()
+        try:
+            yield waited
+        finally:
+            self.release(time() - started)
+
+    def _abandon(self, future: asyncio.Future):
+        """Handle a waiter that gave up: drop it from the queue or hand its slot back."""
+        if future.done() and not future.cancelled():
+            # The slot was granted just as the waiter gave up
+            self.release()
+        elif not future.done():
+            future.cancel()
+            self._queued -= 1
+
+    def _wake(self):
+        while self.running < self.capacity and self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self._queued -= 1
+            self.running += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        waited = self.admitted and self.total_wait / self.admitted
+        return {
+            "capacity": self.capacity,
+            "running": self.running,
+            "queued": self._queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_seconds": round(waited, 3),
+            "max_wait_seconds": round(self.max_observed_wait, 3),
+        }
@@ -0,0 +1,53 @@
+import gzip
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import main_ollama
+from decompression import DecompressionMiddleware
+
+CORS = {"Origin": "chrome-extension://abc"}
+
+
+@pytest.mark.parametrize("app", [main.app, main_ollama.app])
+def test_decompression_errors_carry_cors_headers(app):
+    client = TestClient(app)
+
+    corrupt = client.post("/cache-nonexistent", content=b"not gzip",
+                          headers={**CORS, "Content-Encoding": "gzip", "Content-Type": "application/json"})
+    unsupported = client.post("/cache-nonexistent", content=b"x",
+                              headers={**CORS, "Content-Encoding": "br", "Content-Type": "application/json"})
+
+    assert corrupt.status_code == 400
+    assert unsupported.status_code == 415
+    assert corrupt.headers["access-control-allow-origin"] == "*"
+    assert unsupported.headers["access-control-allow-origin"] == "*"
+
+
+def test_large_body_is_decoded_in_a_thread(monkeypatch):
+    threads = []
+
+    async def to_thread(func, *args):
+        threads.append(func)
+        return func(*args)
+
+    monkeypatch.setattr("decompression.asyncio.to_thread", to_thread)
+    received = {}
+
+    async def app(scope, receive, send):
+        received.update(json.loads((await receive())["body"]))
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    client = TestClient(DecompressionMiddleware(app, thread_threshold=1024))
+    small = client.post("/", content=gzip.compress(b'{"a": 1}'), headers={"Content-Encoding": "gzip"})
+    dom = os.urandom(4096).hex()
+    large = client.post("/", content=gzip.compress(json.dumps({"dom": dom}).encode()),
+                        headers={"Content-Encoding": "gzip"})
+
+    assert small.status_code == large.status_code == 204
+    assert len(threads) == 1
+    assert received["dom"] == dom
@@ -0,0 +1,18 @@
+from metrics import GenerationStats
+
+
+def test_usage_reports_counted_prompt_tokens():
+    stats = GenerationStats(prompt_tokens=120, completion_tokens=30)
+
+    assert stats.usage() == {"completion_tokens": 30, "prompt_tokens": 120, "total_tokens": 150}
+
+
+def test_uncounted_prompt_is_null_not_estimated():
+    stats = GenerationStats(completion_tokens=30)
+
+    assert stats.usage() == {"completion_tokens": 30, "prompt_tokens": None, "total_tokens": None}
+
+
+def test_fallback_is_used_only_without_a_count():
+    assert GenerationStats(completion_tokens=5).usage(10)["total_tokens"] == 15
+    assert GenerationStats(prompt_tokens=7, completion_tokens=5).usage(10)["prompt_tokens"] == 7
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from json_stream import JsonCompletionTracker
+
+ANSWER = '{"primary_xpath": "//button[@id=\'buy\']", "alternative_xpath": "//form//button[1]", "explanation": "id"}'
+
+
+def feed_all(tracker: JsonCompletionTracker, text: str, chunk_size: int = 3) -> str:
+    return "".join(tracker.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size))
+
+
+def test_object_mode_stops_after_the_closing_brace():
+    tracker = JsonCompletionTracker("object")
+    feed_all(tracker, ANSWER + "\n\nNote: the id is stable.")
+
+    assert tracker.done
+    assert json.loads(tracker.text()) == json.loads(ANSWER)
+
+
+def test_brackets_in_prose_before_the_json_are_ignored():
+    tracker = JsonCompletionTracker("object")
+
+    assert tracker.feed("See [1] below: ") == "See [1] below: "
+    assert not tracker.done
+
+    feed_all(tracker, ANSWER + " trailing")
+    assert tracker.done
+    assert tracker.text() == "See [1] below: " + ANSWER
+
+
+def test_closing_bracket_in_prose_before_the_json_is_ignored():
+    tracker = JsonCompletionTracker("object")
+    feed_all(tracker, "a) first] then " + ANSWER)
+
+    assert tracker.done
+    assert tracker.text().endswith(ANSWER)
+
+
+def test_braces_inside_strings_do_not_close_the_object():
+    answer = '{"primary_xpath": "//div[contains(@class, \'}{\')]", "explanation": "a } inside text"}'
+    tracker = JsonCompletionTracker("object")
+    feed_all(tracker, answer + " more")
+
+    assert tracker.done
+    assert tracker.text() == answer
+
+
+def test_escaped_quotes_keep_the_string_open():
+    answer = r'{"primary_xpath": "//a[text()=\"Buy }\"]", "explanation": "quoted \\"}"}'
+    tracker = JsonCompletionTracker("object")
+    feed_all(tracker, answer + " more", chunk_size=1)
+
+    assert tracker.done
+    assert json.loads(tracker.text())["primary_xpath"] == '//a[text()="Buy }"]'
+
+
+def test_primary_xpath_mode_stops_after_its_value_and_closes_the_object():
+    tracker = JsonCompletionTracker("primary_xpath")
+    feed_all(tracker, 'Answer [draft]: ' + ANSWER)
+
+    assert tracker.done
+    text = tracker.text()
+    assert text.startswith("Answer [draft]: ")
+    assert json.loads(text[len("Answer [draft]: "):]) == {"primary_xpath": "//button[@id='buy']"}
+
+
+def test_primary_xpath_mode_ignores_the_key_inside_nested_values():
+    answer = '{"meta": {"primary_xpath": "//x"}, "primary_xpath": "//y", "explanation": "e"}'
+    tracker = JsonCompletionTracker("primary_xpath")
+    feed_all(tracker, answer)
+
+    assert tracker.done
+    assert json.loads(tracker.text())["primary_xpath"] == "//y"
+
+
+def test_none_mode_passes_everything_through():
+    tracker = JsonCompletionTracker("none")
+    text = ANSWER + " trailing"
+
+    assert feed_all(tracker, text) == text
+    assert not tracker.done
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        JsonCompletionTracker("array")
@@ -0,0 +1,16 @@
+import pytest
+from fastapi.middleware.cors import CORSMiddleware
+
+import main
+import main_ollama
+from cancellation import CancellationMiddleware
+from decompression import DecompressionMiddleware
+from metrics import MetricsMiddleware
+
+
+@pytest.mark.parametrize("app", [main.app, main_ollama.app])
+def test_error_producing_middlewares_run_inside_cors(app):
+    # user_middleware lists the outermost middleware first
+    order = [middleware.cls for middleware in app.user_middleware]
+
+    assert order == [MetricsMiddleware, CORSMiddleware, CancellationMiddleware, DecompressionMiddleware]
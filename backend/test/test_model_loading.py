@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import ModelLoad, ModelRequest
+
+
+@pytest.fixture
+def slow_load(monkeypatch):
+    """A load that does not finish while the test runs."""
+    load = ModelLoad("big.gguf", expected_seconds=300)
+    monkeypatch.setattr(main.model_manager, "get_available_models", lambda: ["big.gguf"])
+    monkeypatch.setattr(main.model_loader, "ensure", lambda model: load)
+    monkeypatch.setattr(main.settings, "load_wait_timeout", 0.05)
+    return load
+
+
+def test_switching_to_a_loading_model_answers_503_with_progress(slow_load):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.set_model(ModelRequest(model="big.gguf")))
+
+    assert error.value.status_code == 503
+    assert error.value.detail["model"] == "big.gguf"
+    assert int(error.value.headers["Retry-After"]) > 0
+    assert main.model_manager.current_model != "big.gguf"
+
+
+def test_switch_completes_once_the_load_is_done(slow_load, monkeypatch):
+    monkeypatch.setattr(main.model_manager, "current_model", None)
+    slow_load.done.set()
+
+    response = asyncio.run(main.set_model(ModelRequest(model="big.gguf")))
+
+    assert response == {"message": "Switched to model: big.gguf"}
+    assert main.model_manager.current_model == "big.gguf"
@@ -0,0 +1,50 @@
+import asyncio
+
+import main_ollama
+from main_ollama import AIMessage, AIRequest, _ollama_payload, parse_keep_alive
+
+
+def test_numeric_keep_alive_is_sent_as_a_number():
+    assert parse_keep_alive("-1") == -1
+    assert parse_keep_alive("300") == 300
+    assert parse_keep_alive("5m") == "5m"
+
+
+def test_pinned_model_payload_keeps_the_model_loaded(monkeypatch):
+    monkeypatch.setattr(main_ollama, "CURRENT_MODEL", "qwen2.5:3b")
+    monkeypatch.setattr(main_ollama, "OLLAMA_PIN_KEEP_ALIVE", parse_keep_alive("-1"))
+    request = AIRequest(model="qwen2.5:3b", messages=[AIMessage(role="user", content="find the button")])
+
+    keep_alive = _ollama_payload(request)["keep_alive"]
+
+    assert keep_alive == -1 and isinstance(keep_alive, int)
+
+
+def test_other_models_use_the_regular_keep_alive(monkeypatch):
+    monkeypatch.setattr(main_ollama, "CURRENT_MODEL", "qwen2.5:3b")
+    monkeypatch.setattr(main_ollama, "OLLAMA_KEEP_ALIVE", parse_keep_alive("5m"))
+    request = AIRequest(model="llama3.2:1b", messages=[AIMessage(role="user", content="find the button")])
+
+    assert _ollama_payload(request)["keep_alive"] == "5m"
+
+
+def test_preload_sends_numeric_keep_alive(monkeypatch):
+    sent = []
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"done": True}
+
+    class Client:
+        async def post(self, path, json, timeout):
+            sent.append(json)
+            return Response()
+
+    monkeypatch.setattr(main_ollama, "get_client", lambda: Client())
+    asyncio.run(main_ollama.preload_model("qwen2.5:3b", parse_keep_alive("-1")))
+
+    assert [payload["keep_alive"] for payload in sent] == [-1, -1]
+    assert all(isinstance(payload["keep_alive"], int) for payload in sent)
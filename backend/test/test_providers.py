@@ -0,0 +1,99 @@
+import asyncio
+from time import time
+
+import pytest
+
+from providers import GenerationRequest, Provider, ProviderError, ProviderRouter
+
+
+class FakeProvider(Provider):
+    """Answers after ``delay`` seconds, or fails then when ``error`` is set."""
+    kind = "fake"
+
+    def __init__(self, name: str, delay: float = 0.0, error: str = None):
+        super().__init__(name)
+        self.delay = delay
+        self.error = error
+        self.cancelled = False
+
+    async def complete(self, request, stats):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise RuntimeError(self.error)
+        return self.name
+
+    async def stream(self, request, stats):
+        yield await self.complete(request, stats)
+
+
+def complete(router: ProviderRouter):
+    return asyncio.run(router.complete(GenerationRequest(prompt="find the button")))
+
+
+def test_provider_must_implement_generation():
+    class Incomplete(Provider):
+        async def complete(self, request, stats):
+            return ""
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete")
+
+
+def test_hedge_that_beats_a_running_primary_is_a_hedge_win():
+    slow, fast = FakeProvider("slow", delay=1.0), FakeProvider("fast", delay=0.01)
+    router = ProviderRouter([slow, fast], hedge=True, hedge_max_delay=0.05)
+
+    text, provider, _ = complete(router)
+
+    assert (text, provider) == ("fast", fast)
+    assert slow.cancelled
+    assert (router.hedged, router.hedge_wins, router.failovers, router.failover_wins) == (1, 1, 0, 0)
+
+
+def test_answer_after_the_primary_failed_is_a_failover_win():
+    broken, backup = FakeProvider("broken", error="connection refused"), FakeProvider("backup")
+    router = ProviderRouter([broken, backup])
+
+    text, provider, _ = complete(router)
+
+    assert provider is backup
+    assert (router.hedged, router.hedge_wins, router.failovers, router.failover_wins) == (0, 0, 1, 1)
+
+
+def test_hedge_answering_after_the_primary_failed_is_not_a_hedge_win():
+    failing, hedge = FakeProvider("failing", delay=0.1, error="model reloading"), FakeProvider("hedge", delay=0.2)
+    router = ProviderRouter([failing, hedge], hedge=True, hedge_max_delay=0.05)
+
+    _, provider, _ = complete(router)
+
+    assert provider is hedge
+    assert (router.hedged, router.hedge_wins, router.failover_wins) == (1, 0, 1)
+
+
+def test_failed_provider_cools_down_and_drops_to_the_end():
+    broken, backup = FakeProvider("broken", error="connection refused"), FakeProvider("backup")
+    router = ProviderRouter([broken, backup], failure_cooldown=10.0)
+
+    complete(router)
+
+    assert not broken.available()
+    assert broken.down_until == pytest.approx(time() + 10.0, abs=1.0)
+    assert (broken.failures, broken.last_error) == (1, "connection refused")
+    assert router.ranked() == [backup, broken]
+
+
+def test_all_providers_failing_raises_provider_error():
+    first, second = FakeProvider("first", error="timeout"), FakeProvider("second", error="HTTP 500")
+    router = ProviderRouter([first, second])
+
+    with pytest.raises(ProviderError) as excinfo:
+        complete(router)
+
+    assert "first: timeout" in str(excinfo.value)
+    assert "second: HTTP 500" in str(excinfo.value)
+    assert not first.available() and not second.available()
+    assert router.failover_wins == 0
@@ -0,0 +1,39 @@
+import asyncio
+
+from response_cache import ResponseCache
+
+
+def test_entries_survive_a_restart(tmp_path):
+    async def run():
+        first = ResponseCache(persist_dir=str(tmp_path))
+        await first.put("k", '{"primary_xpath": "//a"}')
+        second = ResponseCache(persist_dir=str(tmp_path))
+        return await second.get("k"), await second.get("missing"), second.stats()
+
+    value, missing, stats = asyncio.run(run())
+
+    assert value == '{"primary_xpath": "//a"}'
+    assert missing is None
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert [path.name for path in tmp_path.iterdir()] == ["k.json"]
+
+
+def test_expired_disk_entry_is_a_miss_and_is_deleted(tmp_path):
+    async def run():
+        cache = ResponseCache(ttl=3600, persist_dir=str(tmp_path))
+        cache._write_disk("k", (0.0, "v"))
+        return await cache.get("k")
+
+    assert asyncio.run(run()) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_clear_removes_memory_and_disk_entries(tmp_path):
+    async def run():
+        cache = ResponseCache(persist_dir=str(tmp_path))
+        await cache.put("k", "v")
+        await cache.clear()
+        return await cache.get("k")
+
+    assert asyncio.run(run()) is None
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from main import _queue_error
+from scheduler import QueueFullError, QueueTimeoutError, RequestScheduler
+
+
+async def hold(scheduler: RequestScheduler, cost: float, order: list, release: asyncio.Event):
+    async with scheduler.slot(cost):
+        order.append(cost)
+        await release.wait()
+
+
+def test_short_prompts_are_served_first():
+    async def run():
+        scheduler = RequestScheduler(capacity=1, aging_rate=0.0)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(scheduler, 1, order, release))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(hold(scheduler, cost, order, release)) for cost in (5000, 100, 2000)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, *waiting)
+        return order
+
+    assert asyncio.run(run()) == [1, 100, 2000, 5000]
+
+
+def test_aging_lets_an_old_large_prompt_go_first(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("scheduler.time", lambda: now[0])
+
+    async def run():
+        scheduler = RequestScheduler(capacity=1, aging_rate=2000.0)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(scheduler, 1, order, release))
+        await asyncio.sleep(0)
+        large = asyncio.create_task(hold(scheduler, 10000, order, release))
+        await asyncio.sleep(0)
+        now[0] += 10  # 10s of waiting is worth 20000 cost units
+        small = asyncio.create_task(hold(scheduler, 100, order, release))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, large, small)
+        return order
+
+    assert asyncio.run(run()) == [1, 10000, 100]
+
+
+def test_full_queue_is_rejected_with_429():
+    async def run():
+        scheduler = RequestScheduler(capacity=1, max_queue=1)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, 1, order, release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(QueueFullError) as excinfo:
+                await scheduler.acquire(1)
+        finally:
+            release.set()
+            await asyncio.gather(*tasks)
+        return scheduler, excinfo.value
+
+    scheduler, error = asyncio.run(run())
+
+    assert not isinstance(error, QueueTimeoutError)
+    assert scheduler.rejected == 1
+    http_error = _queue_error(error)
+    assert http_error.status_code == 429
+    assert int(http_error.headers["Retry-After"]) >= 1
+
+
+def test_wait_timeout_is_a_503_with_retry_after():
+    async def run():
+        scheduler = RequestScheduler(capacity=1, max_wait=0.05)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(scheduler, 1, order, release))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(QueueTimeoutError) as excinfo:
+                await scheduler.acquire(1)
+        finally:
+            release.set()
+            await running
+        return scheduler, excinfo.value
+
+    scheduler, error = asyncio.run(run())
+
+    assert scheduler.timed_out == 1
+    assert scheduler.stats()["queued"] == 0 and scheduler.running == 0
+    http_error = _queue_error(error)
+    assert http_error.status_code == 503
+    assert int(http_error.headers["Retry-After"]) >= 1
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import LlamaCppServer, ServerPool
+
+
+@pytest.fixture
+def fake_servers(monkeypatch):
+    """LlamaCppServer whose launch takes a moment and whose stops are recorded."""
+    calls = {"start": 0, "close": 0}
+
+    async def start_server(self, model_name, extra_args=None):
+        calls["start"] += 1
+        await asyncio.sleep(0.05)
+        self.process = SimpleNamespace(returncode=None, pid=1)
+        self.current_model = model_name
+
+    async def aclose(self):
+        calls["close"] += 1
+        self.process = None
+
+    monkeypatch.setattr(LlamaCppServer, "start_server", start_server)
+    monkeypatch.setattr(LlamaCppServer, "aclose", aclose)
+    monkeypatch.setattr(main.settings, "replicas", 1)
+    return calls
+
+
+def test_concurrent_callers_share_one_launch(fake_servers):
+    async def run():
+        pool = ServerPool("llama-server", "/models", base_port=18900, max_models=2, memory_budget_mb=0)
+        return await asyncio.gather(pool.get("a.gguf"), pool.get("a.gguf"), pool.get("a.gguf"))
+
+    servers = asyncio.run(run())
+
+    assert servers[0] is servers[1] is servers[2]
+    assert servers[0].is_alive()
+    assert fake_servers == {"start": 1, "close": 0}
+
+
+def test_starting_server_is_not_evicted_for_another_model(fake_servers):
+    async def run():
+        pool = ServerPool("llama-server", "/models", base_port=18900, max_models=1, memory_budget_mb=0)
+        first = asyncio.create_task(pool.get("a.gguf"))
+        await asyncio.sleep(0)
+        with pytest.raises(main.PoolBusyError):
+            await pool.get("b.gguf")
+        return await first
+
+    assert asyncio.run(run()).is_alive()
+    assert fake_servers["close"] == 0
+
+
+def test_failed_launch_reaches_every_caller(fake_servers, monkeypatch):
+    async def start_server(self, model_name, extra_args=None):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("model file is corrupt")
+
+    monkeypatch.setattr(LlamaCppServer, "start_server", start_server)
+
+    async def run():
+        pool = ServerPool("llama-server", "/models", base_port=18900, max_models=2, memory_budget_mb=0)
+        results = await asyncio.gather(pool.get("a.gguf"), pool.get("a.gguf"), return_exceptions=True)
+        return pool, results
+
+    pool, results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert pool.servers == {}
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from response_cache import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.run("k", work), flights.run("k", work), flights.run("k", work))
+        return flights, results
+
+    flights, results = asyncio.run(run())
+
+    assert calls == [1]
+    assert [result for result, _ in results] == ["answer"] * 3
+    assert [shared for _, shared in results] == [False, True, True]
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "followers": 2, "abandoned": 0}
+
+
+def test_cancelled_caller_does_not_stop_the_others():
+    release = None
+
+    async def work():
+        await release.wait()
+        return "answer"
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        flights = SingleFlight()
+        leader = asyncio.create_task(flights.run("k", work))
+        follower = asyncio.create_task(flights.run("k", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flights, await follower
+
+    flights, result = asyncio.run(run())
+
+    assert result == ("answer", True)
+    assert flights.abandoned == 0
+
+
+def test_last_caller_cancelling_cancels_the_work():
+    state = {}
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def run():
+        flights = SingleFlight()
+        callers = [asyncio.create_task(flights.run("k", work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flights
+
+    flights = asyncio.run(run())
+
+    assert state == {"cancelled": True}
+    assert flights.stats()["in_flight"] == 0
+    assert flights.abandoned == 1
+
+
+def test_exception_reaches_every_waiter():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream failed")
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.run("k", work), flights.run("k", work), return_exceptions=True)
+        return flights, results
+
+    flights, results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flights.stats()["in_flight"] == 0
@@ -0,0 +1,202 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from lxml import etree
+
+from answer_schema import parse_answer
+from dom_window import ElementSpec
+from locators import find_target, parse_page
+
+
+# Outcomes from best to worst; a repair is only kept when it ranks higher than the answer it replaces
+RESULTS = ("unique", "unverified", "wrong_target", "ambiguous", "not_found", "invalid", "unparsed")
+
+REPAIR_INSTRUCTIONS = (
+    "\n\nThis answer was checked against the DOM above: {failure}\n"
+    "Return ONLY the corrected JSON object with primary_xpath, alternative_xpath and explanation. "
+    "The primary_xpath must match exactly the requested element.\n"
+)
+
+
+class CompiledXPaths:
+    """LRU cache of compiled XPath expressions, including ones that failed to compile.
+
+    Models return the same handful of locator shapes over and over; compiling
+    each expression once saves re-parsing it for every answer and repair.
+    """
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Union[etree.XPath, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, expression: str) -> Union[etree.XPath, str]:
+        """The compiled expression, or the syntax error message when it does not compile."""
+        with self._lock:
+            entry = self._entries.get(expression)
+            if entry is not None:
+                self._entries.move_to_end(expression)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        try:
+            entry = etree.XPath(expression)
+        except etree.XPathSyntaxError as e:
+            entry = f"syntax error: {e}"
+        with self._lock:
+            self._entries[expression] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+compiled_xpaths = CompiledXPaths()
+
+
+@dataclass
+class XPathCheck:
+    """How one XPath behaves on the submitted DOM.
+
+    ``hits_target`` is None when the clicked element could not be identified in the DOM.
+    """
+    xpath: str
+    matches: int = 0
+    error: Optional[str] = None
+    hits_target: Optional[bool] = None
+
+    @property
+    def result(self) -> str:
+        if self.error:
+            return "invalid"
+        if self.matches == 0:
+            return "not_found"
+        if self.matches > 1:
+            return "ambiguous"
+        if self.hits_target is None:
+            # One match, but the clicked element is unknown (e.g. several identical buttons)
+            return "unverified"
+        return "unique" if self.hits_target else "wrong_target"
+
+    def problem(self, field_name: str) -> str:
+        """One-line description of what is wrong, for the repair prompt."""
+        xpath = json.dumps(self.xpath)
+        result = self.result
+        if result == "invalid":
+            return f"{field_name} {xpath} is not a valid XPath 1.0 node-set expression ({self.error})."
+        if result == "not_found":
+            return f"{field_name} {xpath} matches no element."
+        if result == "ambiguous":
+            return f"{field_name} {xpath} matches {self.matches} elements instead of one."
+        if result == "wrong_target":
+            return f"{field_name} {xpath} matches a single element, but not the requested one."
+        return ""
+
+    def as_dict(self) -> dict:
+        return {"xpath": self.xpath, "result": self.result, "matches": self.matches, "error": self.error}
+
+
+@dataclass
+class AnswerValidation:
+    """Checks of the primary and alternative XPaths of one model answer."""
+    primary: Optional[XPathCheck] = None
+    alternative: Optional[XPathCheck] = None
+
+    @property
+    def result(self) -> str:
+        return self.primary.result if self.primary else "unparsed"
+
+    @property
+    def ok(self) -> bool:
+        return self.result == "unique"
+
+    @property
+    def repairable(self) -> bool:
+        """Whether asking the model again could do better: an unverified answer cannot be checked after a repair either."""
+        return self.result not in ("unique", "unverified")
+
+    def rank(self) -> int:
+        return RESULTS.index(self.result)
+
+    def failure(self) -> str:
+        if self.primary is None:
+            return "it is not a JSON object with a primary_xpath string."
+        return self.primary.problem("primary_xpath")
+
+    def as_dict(self) -> dict:
+        return {
+            "result": self.result,
+            "primary": self.primary.as_dict() if self.primary else None,
+            "alternative": self.alternative.as_dict() if self.alternative else None,
+        }
+
+
+class DomChecker:
+    """Evaluates answer XPaths against one submitted DOM, parsed once per request.
+
+    With ``root`` an already parsed page is reused; ``lock`` is then held
+    around every evaluation, since the tree may be shared with other requests.
+    """
+    def __init__(self, dom: str, spec: Optional[ElementSpec] = None, root: Optional[etree._Element] = None,
+                 lock: Optional[threading.Lock] = None):
+        self.root = root if root is not None else parse_page(dom)
+        self.lock = lock or nullcontext()
+        with self.lock:
+            self.target = find_target(self.root, spec) if spec else None
+
+    def check_xpath(self, xpath: str) -> XPathCheck:
+        check = XPathCheck(xpath=xpath)
+        compiled = compiled_xpaths.get(xpath)
+        if isinstance(compiled, str):
+            check.error = compiled
+            return check
+        try:
+            with self.lock:
+                matches = compiled(self.root)
+        except etree.XPathError as e:
+            check.error = f"evaluation error: {e}"
+            return check
+        if not isinstance(matches, list) or not all(isinstance(m, etree._Element) for m in matches):
+            check.error = "does not select elements"
+            return check
+        check.matches = len(matches)
+        if self.target is not None and check.matches == 1:
+            check.hits_target = matches[0] is self.target
+        return check
+
+    def check(self, text: str) -> AnswerValidation:
+        answer = parse_answer(text)
+        if answer is None:
+            return AnswerValidation()
+        validation = AnswerValidation(primary=self.check_xpath(answer["primary_xpath"].strip()))
+        alternative = answer.get("alternative_xpath")
+        if isinstance(alternative, str) and alternative.strip():
+            validation.alternative = self.check_xpath(alternative.strip())
+        return validation
+
+
+def make_checker(dom: str, spec: Optional[ElementSpec] = None, root: Optional[etree._Element] = None,
+                 lock: Optional[threading.Lock] = None) -> Optional[DomChecker]:
+    """A DomChecker for the DOM, or None when it cannot be parsed."""
+    try:
+        return DomChecker(dom, spec, root, lock)
+    except (etree.ParserError, ValueError) as e:
+        logging.warning(f"Could not parse DOM for XPath validation: {e}")
+        return None
+
+
+def repair_prompt(prompt: str, answer: str, validation: AnswerValidation) -> str:
+    """The original prompt followed by the rejected answer and what is wrong with it.
+
+    Keeping the original prompt as the prefix lets llama.cpp reuse the slot's KV
+    cache, so only the answer and the short correction are prefilled.
+    """
+    return prompt + answer.strip() + REPAIR_INSTRUCTIONS.format(failure=validation.failure())
@@ -7,6 +7,8 @@ let settings = {
     modelName: 'gpt-3.5-turbo',
     maxPromptLength: 70000,
     requestTimeout: 60, // seconds
+    serverSideDom: false, // send DOM and element separately so the XPathAI backend builds the prompt
+    selectedTemplate: 'custom',
     defaultPromptTemplate: `Generate an XPath that uniquely identifies this element:
 {element}
 
@@ -119,12 +121,79 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     }
 });
 
+// Built-in templates from extension/prompts, keyed by their options page id
+const SERVER_TEMPLATE_IDS = {
+    template1: 'prompt_template',
+    template2: 'prompt_template2',
+    template3: 'prompt_template3',
+    template4: 'prompt_template4',
+    template5: 'prompt_template5'
+};
+
+// Pages the backend's DOM store is known to hold, by SHA-256 of the DOM (oldest first)
+const storedDomHashes = new Set();
+const MAX_STORED_DOM_HASHES = 50;
+
+async function sha256Hex(text) {
+    const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function rememberStoredDom(domHash) {
+    storedDomHashes.delete(domHash);
+    storedDomHashes.add(domHash);
+    if (storedDomHashes.size > MAX_STORED_DOM_HASHES) {
+        storedDomHashes.delete(storedDomHashes.values().next().value);
+    }
+}
+
+async function gzip(text) {
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+    return await new Response(stream).arrayBuffer();
+}
+
 async function getAIGeneratedXPath(dom, element, prompt_template_override) {
-    const prompt = generatePromptForAI(dom, element, prompt_template_override);
     if (!settings.apiServiceUrl || !settings.apiKey) {
         throw new Error("API Service URL or API Key is not configured. Please check the extension options.");
     }
-    const aiResponseText = await callAIModelAPI(prompt);
+    let aiResponseText;
+    if (settings.serverSideDom) {
+        // The backend windows the DOM around the element and fills the template itself
+        const template = prompt_template_override || settings.defaultPromptTemplate;
+        const extraPayload = {
+            element: { html: element.html, tag: element.tag, attributes: element.attributes }
+        };
+        // The backend keeps every DOM it receives: later clicks on the same page send only its hash
+        const domHash = await sha256Hex(dom);
+        if (storedDomHashes.has(domHash)) {
+            extraPayload.dom_hash = domHash;
+        } else {
+            extraPayload.dom = dom;
+        }
+        // Built-in templates are preloaded on the server, which keeps their
+        // instruction prefix cached instead of re-reading it on every request
+        const templateId = SERVER_TEMPLATE_IDS[settings.selectedTemplate];
+        if (templateId && !prompt_template_override) {
+            extraPayload.template_id = templateId;
+        }
+        try {
+            aiResponseText = await callAIModelAPI(template, extraPayload, { xpathBackend: true });
+        } catch (error) {
+            if (error.status !== 404 || !extraPayload.dom_hash) {
+                throw error;
+            }
+            // The backend restarted or evicted the page: send it in full
+            console.log("XPath AI: DOM no longer stored on the backend, sending it again");
+            storedDomHashes.delete(domHash);
+            delete extraPayload.dom_hash;
+            extraPayload.dom = dom;
+            aiResponseText = await callAIModelAPI(template, extraPayload, { xpathBackend: true });
+        }
+        rememberStoredDom(domHash);
+    } else {
+        const prompt = generatePromptForAI(dom, element, prompt_template_override);
+        aiResponseText = await callAIModelAPI(prompt);
+    }
     return parseAIResponse(aiResponseText, dom);
 }
 
@@ -191,7 +260,7 @@ function generatePromptForAI(domString, elementData, promptTemplateOverride) {
     return prompt;
 }
 
-async function callAIModelAPI(prompt) {
+async function callAIModelAPI(prompt, extraPayload = {}, options = {}) {
     const headers = {
         "Authorization": `Bearer ${settings.apiKey}`,
         "Content-Type": "application/json",
@@ -208,7 +277,8 @@ async function callAIModelAPI(prompt) {
         top_k: 0,
         frequency_penalty: 0.5,
         n: 1,
-        response_format: {"type": "text"}
+        response_format: {"type": "text"},
+        ...extraPayload
     };
 
     console.log("XPath AI: Sending request to AI API:", settings.apiServiceUrl, "Headers:", JSON.stringify(headers), "Payload (preview):", JSON.stringify(payload).substring(0, 1000));
@@ -221,10 +291,21 @@ async function callAIModelAPI(prompt) {
             console.warn("XPath AI: API request aborted due to timeout.");
         }, settings.requestTimeout * 1000);
 
+        // Only the XPathAI backend is known to accept compressed request bodies
+        let body = JSON.stringify(payload);
+        if (options.xpathBackend && typeof CompressionStream !== 'undefined') {
+            body = await gzip(body);
+            headers["Content-Encoding"] = "gzip";
+        }
+        if (options.xpathBackend) {
+            // The backend stops generating once this request would have timed out here anyway
+            headers["X-Request-Timeout"] = String(settings.requestTimeout);
+        }
+
         const response = await fetch(settings.apiServiceUrl, {
             method: 'POST',
             headers: headers,
-            body: JSON.stringify(payload),
+            body: body,
             signal: controller.signal
         });
 
@@ -234,12 +315,20 @@ async function callAIModelAPI(prompt) {
         if (!response.ok) {
             const errorBody = await response.text();
             console.error("XPath AI: API Error Response Status:", response.status, "Body:", errorBody);
-            throw new Error(`AI API request failed: ${response.status} ${response.statusText}. ${errorBody}`);
+            const error = new Error(`AI API request failed: ${response.status} ${response.statusText}. ${errorBody}`);
+            error.status = response.status;
+            throw error;
         }
 
         const responseData = await response.json();
         console.log("XPath AI: AI API Full Response:", responseData);
 
+        // The XPathAI backend constrains decoding to the answer schema and returns it already parsed
+        if (responseData.answer && typeof responseData.answer.primary_xpath === 'string') {
+            console.log("XPath AI: Using structured answer from backend:", responseData.answer);
+            return JSON.stringify(responseData.answer);
+        }
+
         // Extract content - this is highly dependent on the API provider's response structure
         let aiGeneratedText = "";
         if (responseData.choices && responseData.choices[0] && responseData.choices[0].message && responseData.choices[0].message.content) {
@@ -8,6 +8,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const checkEndpointButton = document.getElementById('checkEndpoint');
     const maxPromptLengthInput = document.getElementById('maxPromptLength');
     const requestTimeoutInput = document.getElementById('requestTimeout');
+    const serverSideDomInput = document.getElementById('serverSideDom');
     const defaultPromptTemplateTextarea = document.getElementById('defaultPromptTemplate');
     const templateSelector = document.getElementById('templateSelector');
     const templateDescription = document.getElementById('templateDescription');
@@ -189,6 +190,7 @@ document.addEventListener('DOMContentLoaded', () => {
             'modelName',
             'maxPromptLength',
             'requestTimeout',
+            'serverSideDom',
             'defaultPromptTemplate',
             'selectedTemplate'
         ], (settings) => {
@@ -203,6 +205,7 @@ document.addEventListener('DOMContentLoaded', () => {
             modelNameInput.value = settings.modelName || 'gpt-4';
             maxPromptLengthInput.value = settings.maxPromptLength || 10000;
             requestTimeoutInput.value = settings.requestTimeout || 60;
+            serverSideDomInput.checked = Boolean(settings.serverSideDom);
             const savedTemplate = settings.selectedTemplate || 'custom';
             templateSelector.value = savedTemplate;
             updateTemplateDescription(savedTemplate);
@@ -238,6 +241,7 @@ document.addEventListener('DOMContentLoaded', () => {
             modelName: modelNameInput.value.trim(),
             maxPromptLength: parseInt(maxPromptLengthInput.value, 10) || 70000,
             requestTimeout: parseInt(requestTimeoutInput.value, 10) || 60,
+            serverSideDom: serverSideDomInput.checked,
             defaultPromptTemplate: defaultPromptTemplateTextarea.value.trim() || defaultTemplateValue,
             selectedTemplate: templateSelector.value
         };